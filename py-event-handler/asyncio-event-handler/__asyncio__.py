@@ -1,225 +1,905 @@
+import argparse
 import logging
-from typing import List, Dict
-from dataclasses import dataclass, field
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, List, NamedTuple, Union
 import asyncio
-from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel
-import uvicorn
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from models import Event, Stream
+from events import SSH, SUDO
+from directory import USERS_RELOAD_INTERVAL, Directory, open_directory
+from credentials import VERIFIER
+from shm_users import SharedUserTable, SharedCurrentUser
+from parse import iter_streams
+from decode import DecodeError, decode_stream, decode_batch, decode_events, try_decode_stream
+from logs import setup_logging
+from session_table import SessionTable, handle_event
+from detector import open_detector
+from tracing import PROFILE, STAGES, TRACER, open_tracer, window_seconds
+from wal import WAL_COMMIT_TIMEOUT, WAL_DIR, SNAPSHOT_INTERVAL, EventLog, capture, open_log, processed
+from wire import TCP_PORT, FrameProtocol
+from metrics import (Metrics, SharedMetrics, WindowReporter, CONTENT_TYPE, render, summary, STREAMS_ACCEPTED,
+                     REJECTED_DECODE, REJECTED_LIMIT, REJECTED_QUEUE_FULL, REJECTED_SHUTDOWN,
+                     STREAMS_OFFLOADED, REQUEST_STREAM, REQUEST_BATCH, LOOP_LAG, STAGE_DECODE)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(levelname)s: %(message)s'
 )
 logger = logging.getLogger()
 
-class Event:
-    def __init__(self, type_: str, name: str = "", passwd: str = ""):
-        self.type = type_
-        self.name = name
-        self.passwd = passwd
-
-    def __repr__(self):
-        return f"Event(type='{self.type}', name='{self.name}', passwd='{self.passwd}')"
-
-class Stream:
-    def __init__(self, stream_id: str, events: List[Event]):
-        self.stream_id = stream_id
-        self.events = events if events is not None else []
-
-    def __repr__(self):
-        return f"Stream(stream_id='{self.stream_id}', events={self.events})"
-
-@dataclass
-class User:
-    name: str
-    passwd: str
-    authd: str = ""
-    auth_retries: int = 0
-    mu: asyncio.Lock = field(default_factory=asyncio.Lock)
-
-USERS: Dict[int, User] = {
-    0: User(name="superadmin", passwd="P@ssw0rd!"),
-    1: User(name="auditor", passwd="Secur3!2023"),
-    2: User(name="dev_user", passwd="d3v3l0p3r"),
-    3: User(name="tester", passwd="t3st3r!123"),
-    4: User(name="analyst", passwd="Data2023!"),
-    5: User(name="support", passwd="HelpDesk!"),
-    6: User(name="reports", passwd="R3port$"),
-    7: User(name="backup", passwd="B@ckUp123"),
-    8: User(name="api_user", passwd="Ap1K3y!2023"),
-    9: User(name="guest", passwd="T3mpPass!")
-}
+# пользователи - из каталога USERS_FILE (CSV, JSON или SQLite), в памяти только
+# горячие; каталог открывает точка входа (init_server), а не импорт модуля
+USERS: Directory = None
+
+# Цикл событий не ждёт ни занятой user.mu (её держит поток пула), ни каталога
+# (SQLite при промахе кэша). Обработчик в цикле в таком случае бросает
+# Offload до того, как что-то поменял, и поток (или событие сессии)
+# доделывается в пуле с того же события. Выход из пользователя (logout,
+# смена пользователя) прервать уже нельзя: при занятой блокировке он
+# целиком уходит в пул.
+
+# поток цикла событий сервера; None до конца восстановления из журнала и в
+# режиме --file, где запросов нет и порядок обработки важнее
+loop_thread = None
+
+class Offload(Exception):
+    """Событие заблокировало бы цикл событий: его место - в пуле."""
+
+def on_loop() -> bool:
+    return threading.get_ident() == loop_thread
+
+def lookup(name: str) -> int:
+    if on_loop():
+        uid = USERS.peek(name)
+        if uid is None:
+            raise Offload
+        return uid
+    return USERS.lookup(name)
+
+def user_of(uid: int):
+    if on_loop():
+        user = USERS.peek_user(uid)
+        if user is None:
+            raise Offload
+        return user
+    return USERS[uid]
+
+def release_authd(uid: int, stream_id: str) -> None:
+    """Снять вход stream_id с пользователя uid."""
+    if on_loop():
+        user = USERS.peek_user(uid)
+        if user is None or not user.mu.acquire(False):
+            executor.submit(release_authd, uid, stream_id)
+            return
+    else:
+        user = USERS[uid]
+        user.mu.acquire()
+    try:
+        if user.authd == stream_id:
+            user.authd = ""
+            USERS.mark(uid, user)
+    finally:
+        user.mu.release()
 
 class CurrentUser:
     def __init__(self):
         self.cuid = -1
+        self.ssh_failures = 0
+        self.sudo_failures = 0
+        self.lockouts = 0
 
-    async def handle_ssh(self, stream_id: str, event: Event) -> None:
+    def handle_ssh(self, stream_id: str, event: Event) -> None:
         prevCuid = self.cuid
-        for uid, user in USERS.items():
-            if event.name == user.name:
-                self.cuid = uid
-                break
+        uid = lookup(event.name)
+        cuid = uid if uid != -1 else self.cuid
 
-        if self.cuid == -1:
-            logger.error(f"Couldn't find a user with a name {event.name} ({stream_id})")
+        if cuid == -1:
+            logger.error("Couldn't find a user with a name %s (%s)", event.name, stream_id)
             return
 
-        user = USERS[self.cuid]
-        async with user.mu:
-
+        user = user_of(cuid)
+        # PBKDF2 - до захвата блокировки и только если пароль понадобится
+        passwd_ok = None
+        if not user.authd and user.auth_retries < 3:
+            passwd_ok = VERIFIER.verify(cuid, user.cred, event.passwd)
+        # ожидание занятой user.mu - этап lock_wait трассировки (tracing.py)
+        if not user.mu.acquire(False):
+            if on_loop():
+                raise Offload
+            TRACER.wait(user.mu)
+        self.cuid = cuid
+        try:
             if user.authd == stream_id:
-                logger.info(f"You are already logged in ({stream_id})")
+                logger.info("You are already logged in (%s)", stream_id)
                 return
 
             if user.authd:
-                logger.error(f"User {user.name} already authd from {user.authd} ({stream_id})")
+                logger.error("User %s already authd from %s (%s)", user.name, user.authd, stream_id)
                 self.cuid = -1
                 return
 
             if user.auth_retries >= 3:
-                logger.error(f"Can't access user {user.name}, user is blocked ({stream_id})")
+                logger.error("Can't access user %s, user is blocked (%s)", user.name, stream_id)
                 self.cuid = -1
                 return
 
-            if event.passwd != user.passwd:
+            if passwd_ok is None:
+                passwd_ok = VERIFIER.verify(self.cuid, user.cred, event.passwd)
+            if not passwd_ok:
                 user.auth_retries += 1
-                logger.error(f"Wrong password for user {user.name} ({stream_id})")
+                USERS.mark(self.cuid, user)
+                self.ssh_failures += 1
+                if user.auth_retries == 3:
+                    self.lockouts += 1
+                logger.error("Wrong password for user %s (%s)", user.name, stream_id)
                 self.cuid = -1
                 return
 
-            if not user.authd:
-                if (prevCuid != -1):
-                    USERS[prevCuid].authd = ""
-                user.authd = stream_id
-                user.auth_retries = 0
-                logger.info(f"User {user.name} authd ({stream_id})")
-                return
+            user.authd = stream_id
+            user.auth_retries = 0
+            USERS.mark(self.cuid, user)
+            logger.info("User %s authd (%s)", user.name, stream_id)
+        finally:
+            user.mu.release()
+
+        # выходим из предыдущего пользователя после освобождения текущей
+        # блокировки, чтобы не держать две сразу
+        if prevCuid != -1 and prevCuid != self.cuid:
+            release_authd(prevCuid, stream_id)
+
+    def logout(self, stream_id: str) -> None:
+        if self.cuid != -1:
+            release_authd(self.cuid, stream_id)
+        self.cuid = -1
 
-    async def handle_sudo(self, stream_id: str, event: Event) -> None:
+    def handle_sudo(self, stream_id: str, event: Event) -> None:
         if self.cuid == -1:
             return
 
-        user = USERS[self.cuid]
-        if event.passwd == user.passwd:
-            logger.info(f"Accepted sudo on user {user.name} ({stream_id})")
+        user = user_of(self.cuid)
+        if VERIFIER.verify(self.cuid, user.cred, event.passwd):
+            logger.info("Accepted sudo on user %s (%s)", user.name, stream_id)
         else:
-            logger.error(f"Bad password for sudo on user {user.name} ({stream_id})")
+            self.sudo_failures += 1
+            logger.error("Bad password for sudo on user %s (%s)", user.name, stream_id)
 
-    async def handle_dir(self, stream_id: str, event: Event) -> None:
+    def handle_dir(self, stream_id: str, event: Event) -> None:
         if self.cuid == -1:
             return
-        logger.info(f"Accepted dir on user {USERS[self.cuid].name} ({stream_id})")
-
-async def handle_stream(stream: Stream) -> None:
+        logger.info("Accepted dir on user %s (%s)", user_of(self.cuid).name, stream_id)
+
+# фабрика CurrentUser; воркеры заменяют её на SharedCurrentUser над общей таблицей
+new_user = CurrentUser
+
+# метрики пишет только поток цикла событий: в пуле поток лишь обрабатывается,
+# а итоги записываются после await; у воркеров - строка SharedMetrics
+METRICS = Metrics()
+
+class Resume(NamedTuple):
+    """Поток, прерванный Offload в цикле событий: продолжение для пула."""
+    cu: Any
+    counts: List[int]
+    first: int
+    elapsed_ns: int
+
+def process_stream(stream: Stream, resume: Resume = None):
+    """Синхронная обработка потока: в цикле событий или в пуле потоков.
+
+    В цикле событий может вернуть Resume - остаток потока для пула.
+    """
+    start_ns = time.perf_counter_ns()
+    if resume is None:
+        cu, first, elapsed_ns = new_user(), 0, 0
+        counts = None
+    else:
+        cu, counts, first, elapsed_ns = resume
+    handlers = TRACER.handlers(type(cu), stream)
+    if counts is None:
+        counts = [0] * len(handlers)
+    events = stream.events
+    i = first
     try:
-        cu = CurrentUser()
         stream_id = stream.stream_id
 
-        for event in stream.events:
-            if event.type == "ssh":
-                await cu.handle_ssh(stream_id, event)
-            elif event.type == "sudo":
-                await cu.handle_sudo(stream_id, event)
-            elif event.type == "dir":
-                await cu.handle_dir(stream_id, event)
+        for i in range(first, len(events)):
+            event = events[i]
+            code = event.code
+            counts[code] += 1
+            handlers[code](cu, stream_id, event)
+    except Offload:
+        counts[events[i].code] -= 1
+        return Resume(cu, counts, i, elapsed_ns + time.perf_counter_ns() - start_ns)
     except Exception as e:
-        logger.error(f"Ошибка в потоке {stream.stream_id}: {e}")
-
-MAX_STREAMS = 50
+        logger.error("Ошибка в потоке %s: %s", stream.stream_id, e)
+    return elapsed_ns + time.perf_counter_ns() - start_ns, counts, cu
+
+async def handle_stream(stream: Stream) -> int:
+    # большие потоки уходят в пул, чтобы не держать цикл событий (и приём
+    # запросов) на всё время обработки; мелкие дешевле обработать на месте
+    shard = METRICS.shard()
+    if (OFFLOAD_EVENTS and len(stream.events) > OFFLOAD_EVENTS
+            or OFFLOAD_COLD_VERIFY and has_cold_verify(stream)):
+        shard.inc(STREAMS_OFFLOADED)
+        result = await offload(process_stream, stream)
+    else:
+        result = process_stream(stream)
+        if isinstance(result, Resume):
+            shard.inc(STREAMS_OFFLOADED)
+            result = await offload(process_stream, stream, result)
+    elapsed_ns, counts, cu = result
+    shard.stream_done(elapsed_ns, counts, cu)
+    return elapsed_ns
+
+# потоки длиннее OFFLOAD_EVENTS событий обрабатываются в пуле из
+# OFFLOAD_THREADS потоков (0 - всё в цикле событий)
+OFFLOAD_EVENTS = int(os.environ.get("OFFLOAD_EVENTS", 0))
+OFFLOAD_THREADS = int(os.environ.get("OFFLOAD_THREADS", 4))
+# потоки, которым предстоит PBKDF2 (пароля нет в кэше проверок), - тоже в пул
+OFFLOAD_COLD_VERIFY = os.environ.get("OFFLOAD_COLD_VERIFY", "0") == "1"
+# шаг замера задержки цикла событий (0 - не мерить)
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.1))
+executor: ThreadPoolExecutor = None
+
+def has_cold_verify(stream: Stream) -> bool:
+    # грубо повторяет обход событий: sudo проверяется против последнего ssh;
+    # blake2b на событие несравнимо дешевле одного PBKDF2
+    # промах кэша каталога - тоже в пул, не проверяя дальше
+    uid = -1
+    for event in stream.events:
+        if event.code == SSH.code:
+            uid = USERS.peek(event.name)
+            if uid is None:
+                return True
+        if uid != -1 and event.code in (SSH.code, SUDO.code):
+            user = USERS.peek_user(uid)
+            if user is None or not VERIFIER.is_warm(uid, user.cred, event.passwd):
+                return True
+    return False
+
+def offload(fn, *args):
+    """Выполнить дорогой синхронный шаг в пуле, не занимая цикл событий."""
+    return asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+async def monitor_loop_lag():
+    # sleep просыпается позже срока ровно настолько, сколько цикл был занят
+    # чужим кодом; по этой гистограмме подбирается OFFLOAD_EVENTS
+    interval_ns = int(LOOP_LAG_INTERVAL * 1e9)
+    while True:
+        start_ns = time.perf_counter_ns()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        METRICS.shard().observe(LOOP_LAG, max(0, time.perf_counter_ns() - start_ns - interval_ns))
+
+# MAX_STREAMS=0 - режим сервиса: без лимита потоков, работа до SIGTERM
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 50))
+# одновременно обрабатываемые потоки и предел принятых, но не завершённых
+WORKERS = int(os.environ.get("WORKERS", 50))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 1024))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 30))
+REPORT_INTERVAL = float(os.environ.get("REPORT_INTERVAL", 60))
+BATCH_CHUNK = 256
+# PROCS > 1 - несколько процессов uvicorn на одном слушающем сокете;
+# LOOP=auto берёт uvloop, если он установлен
+PROCS = int(os.environ.get("PROCS", 1))
+LOOP = os.environ.get("LOOP", "auto")
 TIMEOUT = 30 * 60
 total_streams = 0
-total_time_ns = 0
-done_event = asyncio.Event()
-semaphore = asyncio.Semaphore(MAX_STREAMS)
-lock = asyncio.Lock()
+# пул, примитивы asyncio и таблица сессий - свои у каждого процесса, см. init_server
+done_event: asyncio.Event = None
+semaphore: asyncio.Semaphore = None
+lock: asyncio.Lock = None
 running_tasks = set()
+# у воркеров: общий счётчик принятых потоков и флаг остановки всех воркеров
+SHARED_TOTAL = None
+STOP = None
+# открытые потоки: CurrentUser живёт между запросами, при закрытии - выход
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 300))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10000))
+# журнал принятых событий и снимки (WAL_DIR, пусто - без журнала; только при PROCS=1)
+WAL: EventLog = None
+# потоки, записанные в журнал и ждущие commit(), - их место среди задач занято
+wal_reserved = 0
+
+def close_session(session):
+    if WAL is None:
+        session.cu.logout(session.stream_id)
+        return
+    # запись о закрытии и сам выход - под блокировкой журнала, чтобы снимок не встал между ними
+    with WAL.lock:
+        WAL.append_close(session.stream_id)
+        session.cu.logout(session.stream_id)
+
+SESSIONS: SessionTable = None
+
+def init_server(users: Directory) -> None:
+    """Каталог, пул и состояние процесса; вызывается в точке входа до приёма потоков."""
+    global USERS, executor, done_event, semaphore, lock, SESSIONS
+    USERS = users
+    executor = ThreadPoolExecutor(OFFLOAD_THREADS, thread_name_prefix="offload")
+    done_event = asyncio.Event()
+    semaphore = asyncio.Semaphore(WORKERS)
+    lock = asyncio.Lock()
+    SESSIONS = SessionTable(lambda: new_user(), SESSION_IDLE_TIMEOUT, MAX_SESSIONS,
+                            on_close=close_session, lock_factory=asyncio.Lock)
+
+async def handle_session_event(session, event, shard):
+    if WAL is not None:
+        WAL.append_event(session.stream_id, event)
+    try:
+        handle_event(session, event, shard)
+    except Offload:
+        # метрики - в шард потока пула; session.lock держит вызывающий
+        await offload(lambda: handle_event(session, event, METRICS.shard()))
 
+def wal_state():
+    return capture(USERS, SESSIONS)
 
-app = FastAPI()
+def wal_processed():
+    return processed(METRICS.snapshot())
 
-class StreamIn(BaseModel):
-    stream_id: str
-    events: list[dict]
 
 async def worker(stream: Stream):
-    global total_time_ns
     async with semaphore:
-        start_ns = time.perf_counter_ns()
-        await handle_stream(stream)
-        dur_ns = time.perf_counter_ns() - start_ns
+        dur_ns = await handle_stream(stream)
 
+    logger.info("Завершение потока %s за %.3f мкс", stream.stream_id, dur_ns/1000)
+
+
+async def accept_streams(streams: List[Union[Stream, DecodeError]]) -> List[tuple]:
+    # вся пачка регистрируется под одним захватом блокировки; с журналом
+    # задачи запускаются после commit()
+    global total_streams, wal_reserved
+    results = []
+    accepted = []
+    shard = METRICS.shard()
+    accepted_ns = TRACER.now()
     async with lock:
-        total_time_ns += dur_ns
+        # воркеры считают потоки вместе: общий счётчик берётся на всю пачку,
+        # await внутри нет, так что межпроцессная блокировка держится недолго
+        with SHARED_TOTAL.get_lock() if SHARED_TOTAL is not None else nullcontext():
+            if SHARED_TOTAL is not None:
+                total_streams = SHARED_TOTAL.value
+            for stream in streams:
+                if isinstance(stream, DecodeError):
+                    shard.inc(REJECTED_DECODE)
+                    results.append(({"error": str(stream)}, 400))
+                    continue
+                if MAX_STREAMS and total_streams >= MAX_STREAMS:
+                    shard.inc(REJECTED_LIMIT)
+                    results.append(({"error": "Maximum streams limit reached", "stream_id": stream.stream_id}, 429))
+                    continue
+                # идёт остановка: новые потоки не берём, доделываем принятые
+                if done_event.is_set():
+                    shard.inc(REJECTED_SHUTDOWN)
+                    results.append(({"error": "Server is shutting down", "stream_id": stream.stream_id}, 503))
+                    continue
+                if len(running_tasks) + len(accepted) + wal_reserved >= QUEUE_SIZE:
+                    shard.inc(REJECTED_QUEUE_FULL)
+                    results.append(({"error": "Stream queue is full", "stream_id": stream.stream_id}, 503))
+                    continue
+                if WAL is not None:
+                    WAL.append_stream(stream)
+                shard.inc(STREAMS_ACCEPTED)
+                total_streams += 1
+                stream.accepted_ns = accepted_ns
+                accepted.append(stream)
+                results.append(({
+                    "status": "processing_started",
+                    "stream_id": stream.stream_id,
+                    "count": f"{total_streams}/{MAX_STREAMS}" if MAX_STREAMS else str(total_streams)
+                }, 200))
+            reached = MAX_STREAMS and total_streams >= MAX_STREAMS
+            if SHARED_TOTAL is not None:
+                SHARED_TOTAL.value = total_streams
+
+    if WAL is not None and accepted:
+        # fsync ждёт поток пула, ждущие запросы делят его
+        wal_reserved += len(accepted)
+        try:
+            if not await asyncio.get_running_loop().run_in_executor(None, WAL.commit):
+                logger.error("Журнал не записан за %.0f с, потоки обрабатываются без него", WAL_COMMIT_TIMEOUT)
+        finally:
+            wal_reserved -= len(accepted)
+
+    for stream in accepted:
+        t = asyncio.create_task(worker(stream))
+        running_tasks.add(t)
+        t.add_done_callback(running_tasks.discard)
+
+    if reached and accepted:
+        asyncio.create_task(trigger_done())
 
-    logger.info(f"Завершение потока {stream.stream_id} за {dur_ns/1000:.3f} мкс")
+    return results
 
 
-@app.post("/")
-async def receive_stream(req: Request):
-    global total_streams
-    payload = await req.json()
-    stream = Stream(
-        stream_id=payload["streamId"],
-        events=[Event(type_=ev.get("type",""), name=ev.get("name",""), passwd=ev.get("passwd",""))
-                for ev in payload.get("events", [])]
-    )
+async def accept_frames(streams: List[Union[Stream, DecodeError]]) -> List[int]:
+    # двоичный приём по TCP (wire.py): клиенту уходят только коды
+    return [code for _, code in await accept_streams(streams)]
 
-    async with lock:
-        if total_streams >= MAX_STREAMS:
-            raise HTTPException(status_code=429, detail="Maximum streams limit reached")
-        total_streams += 1
-        current_count = total_streams
 
-    t = asyncio.create_task(worker(stream))
-    running_tasks.add(t)
-    t.add_done_callback(running_tasks.discard)
+def create_app():
+    # FastAPI (с pydantic и starlette) - больше половины времени старта;
+    # импортируется только для HTTP-сервера, режим --file обходится без него
+    from fastapi import FastAPI, Request, Response, HTTPException, WebSocket
 
-    if current_count == MAX_STREAMS:
-        asyncio.create_task(trigger_done())
+    app = FastAPI()
 
-    return {
-        "status": "processing_started",
-        "stream_id": stream.stream_id,
-        "count": f"{current_count}/{MAX_STREAMS}"
-    }
+    @app.get("/metrics")
+    async def metrics():
+        body = render(METRICS.snapshot(), {"queue_depth": len(running_tasks), "sessions_open": len(SESSIONS)})
+        return Response(body, media_type=CONTENT_TYPE)
+
+    @app.post("/")
+    async def receive_stream(req: Request):
+        start_ns = time.perf_counter_ns()
+        try:
+            try:
+                stream = TRACER.call(STAGE_DECODE, decode_stream, await req.body())
+            except DecodeError as e:
+                METRICS.shard().inc(REJECTED_DECODE)
+                raise HTTPException(status_code=400, detail=str(e))
+
+            body, code = (await accept_streams([stream]))[0]
+            if code != 200:
+                raise HTTPException(status_code=code, detail=body["error"])
+            return body
+        finally:
+            METRICS.shard().observe(REQUEST_STREAM, time.perf_counter_ns() - start_ns)
+
+    @app.post("/batch")
+    async def receive_batch(req: Request):
+        start_ns = time.perf_counter_ns()
+        try:
+            # массив потоков в JSON или NDJSON (по потоку на строку), который
+            # разбирается и регистрируется пачками по мере чтения тела запроса
+            results = []
+            if req.headers.get("content-type", "").startswith("application/x-ndjson"):
+                batch = []
+                tail = b""
+                async for chunk in req.stream():
+                    lines = (tail + chunk).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        if line.strip():
+                            batch.append(TRACER.call(STAGE_DECODE, try_decode_stream, line))
+                    if len(batch) >= BATCH_CHUNK:
+                        results.extend(await accept_streams(batch))
+                        batch = []
+                if tail.strip():
+                    batch.append(TRACER.call(STAGE_DECODE, try_decode_stream, tail))
+                results.extend(await accept_streams(batch))
+            else:
+                try:
+                    streams = TRACER.call(STAGE_DECODE, decode_batch, await req.body())
+                except DecodeError as e:
+                    METRICS.shard().inc(REJECTED_DECODE)
+                    raise HTTPException(status_code=400, detail=str(e))
+                results = await accept_streams(streams)
+
+            return {
+                "accepted": sum(1 for _, code in results if code == 200),
+                "results": [dict(body, code=code) for body, code in results],
+            }
+        finally:
+            METRICS.shard().observe(REQUEST_BATCH, time.perf_counter_ns() - start_ns)
+
+    # --------- поштучная подача событий ---------
+    @app.post("/streams/{stream_id}/events")
+    async def append_events(stream_id: str, req: Request):
+        # события дописываются в открытый поток и обрабатываются сразу;
+        # в NDJSON (в том числе chunked) - по мере прихода строк
+        if done_event.is_set():
+            raise HTTPException(status_code=503, detail="Server is shutting down")
+        session = await SESSIONS.open_locked_async(stream_id)
+        if session is None:
+            raise HTTPException(status_code=503, detail="Too many open streams")
+
+        shard = METRICS.shard()
+        accepted = 0
+        try:
+            if req.headers.get("content-type", "").startswith("application/x-ndjson"):
+                tail = b""
+                async for chunk in req.stream():
+                    check_open(session, accepted)
+                    lines = (tail + chunk).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        # строка - объект или массив событий, как и тело целиком
+                        for event in TRACER.call(STAGE_DECODE, decode_events, line, stream_id, session.events):
+                            await handle_session_event(session, event, shard)
+                            accepted += 1
+                check_open(session, accepted)
+                if tail.strip():
+                    for event in TRACER.call(STAGE_DECODE, decode_events, tail, stream_id, session.events):
+                        await handle_session_event(session, event, shard)
+                        accepted += 1
+            else:
+                body = await req.body()
+                check_open(session, accepted)
+                for event in TRACER.call(STAGE_DECODE, decode_events, body, stream_id, session.events):
+                    await handle_session_event(session, event, shard)
+                    accepted += 1
+        except DecodeError as e:
+            raise HTTPException(status_code=400, detail={"error": str(e), "accepted": accepted})
+        finally:
+            SESSIONS.touch(session)
+            session.lock.release()
+        return {"stream_id": stream_id, "accepted": accepted, "events": session.events}
+
+    def check_open(session, accepted):
+        # asyncio.Lock не удерживает закрытие: DELETE или остановка могли
+        # закрыть поток, пока запрос ждал тело
+        if session.closed:
+            raise HTTPException(status_code=409, detail={"error": "Stream was closed", "accepted": accepted})
+
+    @app.delete("/streams/{stream_id}")
+    async def close_stream(stream_id: str):
+        if not SESSIONS.close(stream_id):
+            raise HTTPException(status_code=404, detail="Stream is not open")
+        return {"stream_id": stream_id, "status": "closed"}
+
+    # --------- трассировка (tracing.py) ---------
+    @app.post("/admin/trace")
+    async def admin_trace(seconds: str = None):
+        return await trace_window(STAGES, seconds)
+
+    @app.post("/admin/profile")
+    async def admin_profile(seconds: str = None):
+        return await trace_window(PROFILE, seconds)
+
+    async def trace_window(mode: int, seconds: str) -> Response:
+        # окно ждёт поток пула, цикл событий тем временем обрабатывает запросы;
+        # при PROCS > 1 окно общее для всех воркеров
+        try:
+            window = window_seconds(seconds)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        body = await asyncio.get_running_loop().run_in_executor(None, TRACER.record, mode, window)
+        if body is None:
+            raise HTTPException(status_code=409, detail="Trace window is already open")
+        return Response(body, media_type="text/plain; charset=utf-8")
+
+    @app.websocket("/streams/{stream_id}/ws")
+    async def stream_socket(ws: WebSocket, stream_id: str):
+        # событие (или массив событий) на сообщение, ответ - номер последнего
+        # обработанного события; поток закрывается вместе с соединением
+        await ws.accept()
+        session = SESSIONS.open(stream_id) if not done_event.is_set() else None
+        if session is None:
+            await ws.close(code=1013)
+            return
+
+        shard = METRICS.shard()
+        try:
+            while True:
+                msg = await ws.receive()
+                if msg["type"] == "websocket.disconnect":
+                    break
+                data = msg.get("bytes") or (msg.get("text") or "").encode()
+                # сессию между сообщениями мог закрыть DELETE: тогда поток открывается заново
+                session = await SESSIONS.open_locked_async(stream_id) if not done_event.is_set() else None
+                if session is None:
+                    await ws.close(code=1013)
+                    return
+                try:
+                    for event in TRACER.call(STAGE_DECODE, decode_events, data, stream_id, session.events):
+                        await handle_session_event(session, event, shard)
+                except DecodeError as e:
+                    await ws.send_json({"error": str(e), "events": session.events})
+                    continue
+                finally:
+                    SESSIONS.touch(session)
+                    session.lock.release()
+                await ws.send_json({"events": session.events})
+        finally:
+            SESSIONS.close(stream_id)
+
+    return app
+
+
+async def sweep_sessions():
+    while not done_event.is_set():
+        await asyncio.sleep(SESSION_IDLE_TIMEOUT / 4)
+        SESSIONS.expire()
+
+
+async def watch_users():
+    # каталог пользователей перечитывается в пуле: импорт и SQLite блокируют
+    loop = asyncio.get_running_loop()
+    while not done_event.is_set():
+        await asyncio.sleep(USERS_RELOAD_INTERVAL)
+        if USERS.store.changed():
+            await loop.run_in_executor(None, USERS.try_reload)
 
 
 async def trigger_done():
     await asyncio.sleep(0.1)
     done_event.set()
+    if STOP is not None:
+        STOP.set()
 
-async def start_server():
-    config = uvicorn.Config(app, host="0.0.0.0", port=8081, log_level="info", loop="asyncio")
-    server = uvicorn.Server(config)
-    await server.serve()
+def draining_server(app):
+    """uvicorn.Server, который по SIGTERM/SIGINT не выходит сам, а будит main().
 
-import contextlib
+    Сигнал не запоминается для повторной отправки после serve(), иначе
+    процесс завершится раньше, чем доработают принятые потоки.
+    """
+    import uvicorn
 
-async def main():
-    config = uvicorn.Config(app, host="0.0.0.0", port=8081, log_level="info", loop="asyncio")
-    server = uvicorn.Server(config)
+    class DrainingServer(uvicorn.Server):
+        stop_signal = None
 
-    server_task = asyncio.create_task(server.serve())
+        def handle_exit(self, sig, frame):
+            if self.stop_signal is not None and sig == signal.SIGINT:
+                # повторный Ctrl+C - выходим, не дожидаясь потоков
+                self.force_exit = True
+            self.stop_signal = sig
+            asyncio.get_running_loop().call_soon_threadsafe(done_event.set)
 
-    try:
-        await asyncio.wait_for(done_event.wait(), timeout=TIMEOUT)
-    finally:
-        server.should_exit = True
+    config = uvicorn.Config(app, host="0.0.0.0", port=8081, log_level="info", loop="asyncio")
+    return DrainingServer(config)
+
+async def main(sock: socket.socket = None, tcp_sock: socket.socket = None, app=None, users: Directory = None):
+    # sock (и tcp_sock при TCP_PORT) передаёт главный процесс при PROCS > 1:
+    # логирование, отчёты и таймаут тогда на нём, воркер только обслуживает
+    # запросы до сигнала; app и каталог users воркер наследует готовыми
+    global WAL, loop_thread
+    is_worker = sock is not None
+    log_listener = None if is_worker else setup_logging()
+    init_server(users if users is not None else open_directory())
+    if WAL_DIR and not is_worker:
+        # до приёма запросов: состояние из снимка и хвоста журнала
+        WAL = open_log(WAL_DIR, USERS, new_user)
+        if SNAPSHOT_INTERVAL:
+            WAL.start_snapshots(SNAPSHOT_INTERVAL, wal_processed, wal_state)
+    # восстановление из журнала шло без Offload: ждать в нём можно
+    loop_thread = threading.get_ident()
+    if not is_worker:
+        # после восстановления; воркерам детектор и трассировка достаются от serve_workers
+        open_detector(METRICS)
+        open_tracer(METRICS)
+    server = draining_server(app if app is not None else create_app())
+
+    server_task = asyncio.create_task(server.serve(sockets=[sock] if is_worker else None))
+    tcp_server = None
+    if TCP_PORT:
+        loop = asyncio.get_running_loop()
+        if is_worker:
+            tcp_server = await loop.create_server(lambda: FrameProtocol(accept_frames), sock=tcp_sock)
+        else:
+            tcp_server = await loop.create_server(lambda: FrameProtocol(accept_frames), "0.0.0.0", TCP_PORT)
+            logger.info("Двоичный приём потоков на :%s", TCP_PORT)
+    sweeper = asyncio.create_task(sweep_sessions())
+    lag_monitor = asyncio.create_task(monitor_loop_lag()) if LOOP_LAG_INTERVAL else None
+    users_watcher = None
+    if not is_worker:
+        # SIGHUP - перечитать каталог пользователей без перезапуска; у воркеров
+        # пользователи в общей памяти, разложенной при старте
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.run_in_executor(None, USERS.try_reload))
+        # SIGUSR1 - открыть или закрыть окно трассировки с профилем
+        loop.add_signal_handler(signal.SIGUSR1, lambda: loop.run_in_executor(None, TRACER.toggle))
+        if USERS_RELOAD_INTERVAL:
+            users_watcher = asyncio.create_task(watch_users())
+
+    # ждём лимита (с таймаутом) или, в режиме сервиса, сигнала
+    reporter = WindowReporter(METRICS.snapshot, REPORT_INTERVAL)
+    deadline = time.monotonic() + TIMEOUT if MAX_STREAMS and not is_worker else None
+    while not done_event.is_set():
+        step = REPORT_INTERVAL or None
+        if is_worker:
+            step = None
+        if deadline is not None:
+            step = min(step or TIMEOUT, max(0.0, deadline - time.monotonic()))
+        try:
+            await asyncio.wait_for(done_event.wait(), timeout=step)
+        except asyncio.TimeoutError:
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info("Таймаут, завершаем работу...")
+                break
+            reporter.report()
+    if server.stop_signal is not None:
+        logger.info("Получен сигнал %s, завершаем работу...", signal.Signals(server.stop_signal).name)
 
+    # перестаём принимать соединения и дорабатываем принятые, но не дольше DRAIN_TIMEOUT
+    done_event.set()
+    server.should_exit = True
+    if tcp_server is not None:
+        # открытые соединения не ждём: новые потоки в них получат 503
+        tcp_server.close()
     await server_task
+    sweeper.cancel()
+    if lag_monitor is not None:
+        lag_monitor.cancel()
+    if users_watcher is not None:
+        users_watcher.cancel()
 
     if running_tasks:
-        await asyncio.gather(*list(running_tasks), return_exceptions=True)
+        _, left = await asyncio.wait(list(running_tasks), timeout=DRAIN_TIMEOUT)
+        for t in left:
+            t.cancel()
+        if left:
+            logger.warning("За %.0f с не доработали %s потоков, они отменены", DRAIN_TIMEOUT, len(left))
+
+    if is_worker:
+        return
+    if WAL is not None:
+        WAL.shutdown(wal_processed, wal_state)
+    logger.info(summary(METRICS.snapshot()))
+    if log_listener:
+        log_listener.stop()
+
+
+def serve_worker(sock: socket.socket, tcp_sock: socket.socket, app, directory: Directory, users: SharedUserTable,
+                 worker_metrics: SharedMetrics, total, stop) -> None:
+    global METRICS, SHARED_TOTAL, STOP, new_user
+    METRICS = worker_metrics
+    SHARED_TOTAL = total
+    STOP = stop
+    new_user = lambda: SharedCurrentUser(users)
+    # трассировку по SIGUSR1 переключает главный процесс
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    run(main(sock, tcp_sock, app, directory))
+
+
+def serve_workers(procs: int) -> None:
+    """PROCS процессов uvicorn на одном сокете, состояние пользователей общее.
+
+    Сокет открывается здесь и наследуется воркерами, соединения между ними
+    раздаёт ядро (accept на общем сокете). Пользователи лежат в
+    SharedUserTable, метрики - строками SharedMetrics, лимит MAX_STREAMS
+    считается общим счётчиком. Главный процесс только ждёт лимита, таймаута
+    или сигнала, отчитывается и останавливает воркеров SIGTERM, после чего
+    каждый доделывает свои потоки.
+    Сессии поштучной подачи у каждого воркера свои: запросы одного потока
+    должны идти по одному соединению (keep-alive или WebSocket).
+    """
+    log_listener = setup_logging(multiprocess=True)
+    if WAL_DIR:
+        logger.warning("WAL_DIR при PROCS > 1 не поддерживается: журнал не ведётся")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", 8081))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    tcp_sock = None
+    if TCP_PORT:
+        tcp_sock = socket.create_server(("0.0.0.0", TCP_PORT), backlog=socket.SOMAXCONN)
+        tcp_sock.set_inheritable(True)
+
+    # каталог нужен воркерам только для OFFLOAD_COLD_VERIFY, состояние - в общей таблице
+    directory = open_directory()
+    users = SharedUserTable.create(directory, capacity=directory.max_uid() + 1)
+    # строка на воркер и одна на главный процесс: в окне трассировки он
+    # пишет время своих записей в лог
+    worker_metrics = SharedMetrics(procs + 1)
+    open_detector(worker_metrics, shared=True)
+    open_tracer(worker_metrics, shared=True)
+    total = multiprocessing.Value("q", 0)
+    stop = multiprocessing.Event()
+    # FastAPI и uvicorn импортируются до fork: воркеры получают их готовыми,
+    # а не грузят каждый заново на одном и том же CPU
+    app = create_app()
+    import uvicorn  # noqa: F401
+    workers = [multiprocessing.Process(target=serve_worker, name=f"asyncio-worker-{i}",
+                                       args=(sock, tcp_sock, app, directory, users, worker_metrics, total, stop))
+               for i in range(procs)]
+    for p in workers:
+        p.start()
+    logger.info("Server starting on :8081 (%s workers, loop %s)", procs, loop_name())
+    if tcp_sock is not None:
+        logger.info("Двоичный приём потоков на :%s", TCP_PORT)
+
+    # обработчик сигнала не трогает multiprocessing.Event (его блокировка
+    # не реентерабельна), а лимит от воркеров ждёт отдельный поток
+    done = threading.Event()
+    stop_signal = []
+    def on_signal(signum, frame):
+        stop_signal.append(signum)
+        done.set()
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=TRACER.toggle, daemon=True).start())
+    # общая таблица пользователей раскладывается один раз (shm_users.py)
+    signal.signal(signal.SIGHUP, lambda signum, frame: logger.warning(
+        "SIGHUP: при PROCS > 1 перечитывание каталога пользователей не поддерживается, нужен перезапуск"))
+    def wait_limit():
+        stop.wait()
+        done.set()
+    threading.Thread(target=wait_limit, daemon=True).start()
+
+    reporter = WindowReporter(worker_metrics.snapshot, REPORT_INTERVAL)
+    if not reporter.wait(done, timeout=TIMEOUT if MAX_STREAMS else None):
+        logger.info("Таймаут, завершаем работу...")
+    elif stop_signal:
+        logger.info("Получен сигнал %s, завершаем работу...", signal.Signals(stop_signal[0]).name)
+    else:
+        logger.info("Достигнут лимит потоков, завершаем работу...")
+
+    for p in workers:
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGTERM)
+    deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+    killed = 0
+    for p in workers:
+        p.join(max(0.0, deadline - time.monotonic()))
+        if p.is_alive():
+            p.kill()
+            p.join()
+            killed += 1
+    if killed:
+        logger.warning("За %.0f с не остановились %s воркеров, они убиты", DRAIN_TIMEOUT, killed)
+    sock.close()
+    if tcp_sock is not None:
+        tcp_sock.close()
+
+    logger.info(summary(worker_metrics.snapshot()))
+    users.close()
+    users.unlink()
+    if log_listener:
+        log_listener.stop()
+
+
+def loop_name() -> str:
+    if LOOP == "asyncio":
+        return "asyncio"
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        if LOOP == "uvloop":
+            raise
+        return "asyncio"
+    return "uvloop"
+
+
+def run(coro):
+    if loop_name() == "uvloop":
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coro)
+
+
+async def process_file(file_path: str):
+    global total_streams
+
+    log_listener = setup_logging()
+    init_server(open_directory())
+    open_detector(METRICS)
+
+    # потоки запускаются по мере разбора файла; не больше QUEUE_SIZE задач сразу
+    pending = set()
+    for stream in iter_streams(file_path):
+        if len(pending) >= QUEUE_SIZE:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.add(asyncio.create_task(worker(stream)))
+        total_streams += 1
+        await asyncio.sleep(0)
 
-    avg_ns = total_time_ns / total_streams if total_streams else 0
-    logger.info(
-        "Полное чистое время обработки: %.3f мкс, среднее на поток: %.3f мкс"
-        % (total_time_ns/1e3, avg_ns/1e3)
-    )
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
 
+    logger.info(summary(METRICS.snapshot()))
+    if log_listener:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", help="Путь к файлу с данными (вместо HTTP-сервера)")
+    args = parser.parse_args()
+    if args.file:
+        run(process_file(args.file))
+    elif PROCS > 1:
+        serve_workers(PROCS)
+    else:
+        run(main())
@@ -0,0 +1,124 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from columnar import analyze, load, messages, per_stream, report, state
+from directory import open_directory
+from parse import iter_streams
+from session import CurrentUser, LockStripes
+
+# Офлайн-анализ файла потоков по столбцам (pkg/columnar.py): сводка по
+# исходам событий и пользователям, при --verify - сверка с эталоном, тем же
+# файлом через CurrentUser поштучно: сообщения по каждому событию в порядке
+# файла, счётчики ошибок по потокам и состояние пользователей в конце.
+#
+#   python bench/analyze.py ../go-data-handler/data/streams50.txt --verify
+#   python bench/analyze.py capture.txt --json report.json --log
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "go-data-handler", "data", "streams50.txt")
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def reference(file_path: str):
+    """Файл через CurrentUser по одному потоку: сообщения, счётчики по потокам, состояние."""
+    users = open_directory()
+    stripes = LockStripes()
+    capture = Capture()
+    root = logging.getLogger()
+    root.addHandler(capture)
+    saved = [h for h in root.handlers if h is not capture]
+    for h in saved:
+        root.removeHandler(h)
+    counters = []
+    try:
+        for stream in iter_streams(file_path):
+            cu = CurrentUser(users, stripes)
+            for event in stream.events:
+                if event.type == "ssh":
+                    cu.handle_ssh(stream.stream_id, event)
+                elif event.type == "sudo":
+                    cu.handle_sudo(stream.stream_id, event)
+                elif event.type == "dir":
+                    cu.handle_dir(stream.stream_id, event)
+            counters.append([cu.ssh_failures, cu.sudo_failures, cu.lockouts])
+    finally:
+        root.removeHandler(capture)
+        for h in saved:
+            root.addHandler(h)
+    return capture.records, counters, sorted(users.dirty())
+
+
+def first_difference(a, b) -> str:
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return f"#{i}: {x} != {y}"
+    return f"длина {len(a)} != {len(b)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-анализ файла потоков по столбцам")
+    parser.add_argument("file", nargs="?", default=DATA)
+    parser.add_argument("--verify", action="store_true", help="сверить с CurrentUser")
+    parser.add_argument("--log", action="store_true", help="вывести сообщения по событиям, как обработчики")
+    parser.add_argument("--json", help="записать сводку в JSON")
+    args = parser.parse_args()
+
+    users = open_directory()
+    start = time.perf_counter()
+    columns = load(args.file)
+    loaded = time.perf_counter()
+    analysis = analyze(columns, users)
+    done = time.perf_counter()
+    summary = report(analysis, users)
+    print(f"{summary['streams']:,} потоков, {len(columns.type):,} событий: разбор {loaded - start:.3f} с, "
+          f"анализ {done - loaded:.3f} с, проверено паролей {summary['passwords_checked']}")
+    print(f"события {summary['events']}")
+    for etype, outcomes in summary["outcomes"].items():
+        print(f"  {etype:<5} {outcomes}")
+    print(f"ошибки ssh {summary['ssh_failures']}, sudo {summary['sudo_failures']}, блокировок {summary['lockouts']}")
+    for name, row in sorted(summary["users"].items()):
+        print(f"  {name:<16} " + " ".join(f"{k}={v}" for k, v in row.items()))
+
+    if args.log:
+        for level, text in messages(analysis, users):
+            print(f"{logging.getLevelName(level)}: {text}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        print(f"сводка: {args.json}")
+    if not args.verify:
+        return
+
+    start = time.perf_counter()
+    ref_messages, ref_counters, ref_state = reference(args.file)
+    elapsed = time.perf_counter() - start
+    print(f"эталон CurrentUser: {elapsed:.3f} с")
+    checks = (
+        ("сообщения", list(messages(analysis, users)), ref_messages),
+        ("счётчики потоков", per_stream(analysis).tolist(), ref_counters),
+        ("состояние пользователей", sorted(state(analysis, users)), ref_state),
+    )
+    failed = False
+    for what, got, want in checks:
+        if got == want:
+            print(f"  {what}: совпадают ({len(want)})")
+        else:
+            failed = True
+            print(f"  {what}: расходятся, {first_difference(got, want)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
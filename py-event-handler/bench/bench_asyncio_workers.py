@@ -0,0 +1,63 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import harness
+
+# Масштабирование asyncio-обработчика по процессам: одна и та же нагрузка
+# харнесса прогоняется с PROCS=1, 2, 4 ... --max-procs (общий сокет,
+# пользователи в общей памяти). Цикл событий задаётся --loop (LOOP сервера).
+# Параллельность клиента растёт вместе с числом воркеров, иначе упрёмся в
+# клиента, а не в сервер. Прирост виден только на многоядерной машине.
+#
+#   python bench/bench_asyncio_workers.py --streams 20000 --max-procs 8
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio: пропускная способность от числа воркеров")
+    parser.add_argument("--max-procs", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--loop", default="auto", help="LOOP сервера: auto, uvloop или asyncio")
+    parser.add_argument("--file", help="файл потоков (по умолчанию синтетика)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--streams", type=int, default=5000, help="синтетика: число потоков (0 - файл)")
+    parser.add_argument("--events", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16, help="на одного воркера")
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--out", default="bench_asyncio_workers.json")
+    args = parser.parse_args()
+
+    if args.streams and not args.file:
+        streams = harness.synthetic_streams(args.streams, args.events, 0.0, 0.1, 1)
+    else:
+        streams = harness.file_streams(args.file or harness.DATA, args.repeat)
+
+    results = []
+    procs = 1
+    while procs <= args.max_procs:
+        run_args = argparse.Namespace(
+            env=[f"PROCS={procs}", f"LOOP={args.loop}"], log_mode="off", warmup=50,
+            concurrency=args.concurrency * procs, batch=args.batch)
+        result = harness.run_engine("asyncio", streams, run_args)
+        result["procs"] = procs
+        results.append(result)
+        base = results[0]["streams_per_s"]
+        lat = result["latency_ms"]
+        print(f"{procs:>3} воркеров: {result['streams_per_s']:>10,.0f} потоков/с  x{result['streams_per_s'] / base:.2f}  "
+              f"p99 {lat['p99']:.2f} мс  CPU {result['cpu_percent']:.0f}%  RSS {result['rss_peak_mb']:.0f} МБ")
+        procs *= 2
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "loop": args.loop,
+            "streams": len(streams),
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"результаты: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
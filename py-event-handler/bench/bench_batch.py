@@ -0,0 +1,75 @@
+import argparse
+import http.client
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from parse import iter_streams
+
+# Пропускная способность приёма: по одному потоку на POST / против POST /batch
+# (JSON-массив и NDJSON). Сервер должен быть запущен с достаточным лимитом:
+#   MAX_STREAMS=1000000 python threading-event-handler/__threading__.py
+# Каждый режим шлёт streams50.txt repeat раз с уникальными streamId.
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "go-data-handler", "data", "streams50.txt")
+
+
+def load(path: str, repeat: int, tag: str):
+    streams = [
+        {"streamId": s.stream_id,
+         "events": [{"type": e.type, "name": e.name, "passwd": e.passwd} for e in s.events]}
+        for s in iter_streams(path)
+    ]
+    return [dict(s, streamId=f"{s['streamId']}-{tag}-{i}") for i in range(repeat) for s in streams]
+
+
+def post(conn, path, body: bytes, content_type: str):
+    conn.request("POST", path, body=body, headers={"Content-Type": content_type})
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status
+
+
+def run_single(conn, streams):
+    for s in streams:
+        post(conn, "/", json.dumps(s).encode(), "application/json")
+
+
+def run_batch(conn, streams, size):
+    for i in range(0, len(streams), size):
+        post(conn, "/batch", json.dumps(streams[i:i + size]).encode(), "application/json")
+
+
+def run_ndjson(conn, streams, size):
+    for i in range(0, len(streams), size):
+        body = "\n".join(json.dumps(s) for s in streams[i:i + size]).encode()
+        post(conn, "/batch", body, "application/x-ndjson")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--file", default=DATA)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=250)
+    args = parser.parse_args()
+
+    conn = http.client.HTTPConnection(args.host, args.port)
+    modes = [
+        ("single", lambda s: run_single(conn, s)),
+        (f"batch x{args.batch}", lambda s: run_batch(conn, s, args.batch)),
+        (f"ndjson x{args.batch}", lambda s: run_ndjson(conn, s, args.batch)),
+    ]
+    for tag, (name, run) in enumerate(modes):
+        streams = load(args.file, args.repeat, str(tag))
+        start = time.perf_counter()
+        run(streams)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: {len(streams)} потоков за {elapsed:.3f} с, {len(streams) / elapsed:,.0f} потоков/с")
+
+
+if __name__ == "__main__":
+    main()
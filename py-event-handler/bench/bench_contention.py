@@ -0,0 +1,179 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from credentials import Credential
+from models import Event
+from session import CurrentUser, LockStripes
+from user_index import UserIndex
+
+# Стресс-тест конкуренции: THREADS потоков гоняют сессии по небольшому
+# набору "горячих" пользователей. Сравниваются прежний CurrentUser (Lock на
+# пользователя, захват на каждый ssh) и session.CurrentUser (полосы
+# блокировок, проверки без блокировок). Логирование выключено.
+
+THREADS = 64
+HOT_USERS = 4
+
+logger = logging.getLogger()
+SESSIONS = 2_000
+
+
+@dataclass
+class OldUser:
+    name: str
+    passwd: str
+    authd: str = ""
+    auth_retries: int = 0
+    mu: threading.Lock = field(default_factory=threading.Lock)
+
+
+@dataclass
+class User:
+    name: str
+    passwd: str
+    authd: str = ""
+    auth_retries: int = 0
+    # PBKDF2 здесь не меряется (см. bench_credentials.py): один раунд
+    cred: Credential = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.cred = Credential.create(self.passwd, iterations=1)
+
+
+class OldCurrentUser:
+    """CurrentUser из __threading__.py до перехода на session.py."""
+
+    def __init__(self, users):
+        self.users = users
+        self.cuid = -1
+        self.waits = 0
+
+    def handle_ssh(self, stream_id, event):
+        prevCuid = self.cuid
+        uid = self.users.lookup(event.name)
+        if uid != -1:
+            self.cuid = uid
+        if self.cuid == -1:
+            logger.error("Couldn't find a user with a name %s (%s)", event.name, stream_id)
+            return
+        user = self.users[self.cuid]
+        if not user.mu.acquire(blocking=False):
+            user.mu.acquire()
+            self.waits += 1
+        try:
+            if user.authd == stream_id:
+                logger.info("You are already logged in (%s)", stream_id)
+                return
+            if user.authd:
+                logger.error("User %s already authd from %s (%s)", user.name, user.authd, stream_id)
+                self.cuid = -1
+                return
+            if user.auth_retries >= 3:
+                logger.error("Can't access user %s, user is blocked (%s)", user.name, stream_id)
+                self.cuid = -1
+                return
+            if event.passwd != user.passwd:
+                user.auth_retries += 1
+                logger.error("Wrong password for user %s (%s)", user.name, stream_id)
+                self.cuid = -1
+                return
+            if prevCuid != -1:
+                self.users[prevCuid].authd = ""
+            user.authd = stream_id
+            user.auth_retries = 0
+            logger.info("User %s authd (%s)", user.name, stream_id)
+        finally:
+            user.mu.release()
+
+    def handle_sudo(self, stream_id, event):
+        if self.cuid == -1:
+            return
+        user = self.users[self.cuid]
+        if event.passwd == user.passwd:
+            logger.info("Accepted sudo on user %s (%s)", user.name, stream_id)
+        else:
+            logger.error("Bad password for sudo on user %s (%s)", user.name, stream_id)
+
+    def handle_dir(self, stream_id, event):
+        if self.cuid == -1:
+            return
+        logger.info("Accepted dir on user %s (%s)", self.users[self.cuid].name, stream_id)
+
+
+def make_sessions(seed: int):
+    rnd = random.Random(seed)
+    sessions = []
+    for _ in range(SESSIONS):
+        a, b = rnd.randrange(HOT_USERS), rnd.randrange(HOT_USERS)
+        sessions.append([
+            Event("ssh", f"hot{a}", f"pw{a}"),
+            Event("sudo", "", f"pw{a}"),
+            Event("ssh", f"hot{a}", f"pw{a}"),
+            Event("dir"),
+            Event("ssh", f"hot{b}", f"pw{b}"),
+            Event("sudo", "", f"pw{b}"),
+            Event("dir"),
+        ])
+    return sessions
+
+
+def run(make_cu, users) -> (float, int):
+    waits = [0]
+    barrier = threading.Barrier(THREADS + 1)
+
+    def work(tid):
+        sessions = make_sessions(tid)
+        barrier.wait()
+        local_waits = 0
+        for i, events in enumerate(sessions):
+            sid = f"s-{tid}-{i}"
+            cu = make_cu()
+            for ev in events:
+                if ev.type == "ssh":
+                    cu.handle_ssh(sid, ev)
+                elif ev.type == "sudo":
+                    cu.handle_sudo(sid, ev)
+                else:
+                    cu.handle_dir(sid, ev)
+            # конец сессии: выходим, чтобы пользователи не залипали
+            if cu.cuid != -1:
+                users[cu.cuid].authd = ""
+            local_waits += getattr(cu, "waits", 0)
+        waits[0] += local_waits
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    events = THREADS * SESSIONS * 7
+    return events / elapsed, waits[0]
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+
+    old_users = UserIndex({i: OldUser(name=f"hot{i}", passwd=f"pw{i}") for i in range(HOT_USERS)})
+    old_rate, old_waits = run(lambda: OldCurrentUser(old_users), old_users)
+
+    users = UserIndex({i: User(name=f"hot{i}", passwd=f"pw{i}") for i in range(HOT_USERS)})
+    stripes = LockStripes()
+    new_rate, _ = run(lambda: CurrentUser(users, stripes), users)
+    acquired, contended = stripes.stats()
+
+    print(f"{THREADS} потоков, {HOT_USERS} горячих пользователя")
+    print(f"Lock на пользователя: {old_rate:,.0f} событий/с, ожиданий блокировки: {old_waits}")
+    print(f"полосы блокировок:    {new_rate:,.0f} событий/с, захватов: {acquired}, с ожиданием: {contended}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import logging
+import os
+import sys
+import time
+from dataclasses import InitVar, dataclass, field
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from credentials import PBKDF2_ITERATIONS, VERIFIER, Credential
+from models import Event
+from session import CurrentUser, LockStripes
+from user_index import UserIndex
+
+# Цена ssh и sudo в session.CurrentUser с паролями в PBKDF2: холодная
+# проверка (кэш проверок пуст) против тёплой (тот же пароль уже проверен).
+# Неверный пароль не кэшируется и всегда стоит полный PBKDF2. Для сравнения -
+# прежнее сравнение открытых строк. Число раундов - PBKDF2_ITERATIONS.
+
+COLD_ROUNDS = 50
+WARM_ROUNDS = 20_000
+STREAM = "bench"
+
+
+@dataclass
+class User:
+    name: str
+    passwd: InitVar[str]
+    authd: str = ""
+    auth_retries: int = 0
+    cred: Credential = field(init=False, repr=False)
+
+    def __post_init__(self, passwd: str):
+        self.cred = Credential.create(passwd)
+
+
+def measure(fn, rounds: int, before=None):
+    timings = []
+    for _ in range(rounds):
+        if before is not None:
+            before()
+        start = time.perf_counter_ns()
+        fn()
+        timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+    return timings[len(timings) // 2] / 1e3, timings[int(len(timings) * 0.99)] / 1e3
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    users = UserIndex({0: User(name="alice", passwd="s3cret!")})
+    user = users[0]
+    cu = CurrentUser(users, LockStripes())
+    ssh = Event("ssh", "alice", "s3cret!")
+    wrong = Event("ssh", "alice", "guess")
+    sudo = Event("sudo", "", "s3cret!")
+
+    def login():
+        cu.handle_ssh(STREAM, ssh)
+
+    def relogin():
+        # выходим, чтобы следующий ssh снова проверял пароль
+        cu.logout(STREAM)
+        user.auth_retries = 0
+
+    def cold():
+        relogin()
+        VERIFIER.cache.clear()
+
+    results = [
+        ("ssh, холодный", measure(login, COLD_ROUNDS, cold)),
+        ("ssh, тёплый", measure(login, WARM_ROUNDS, relogin)),
+        ("ssh, неверный", measure(lambda: cu.handle_ssh(STREAM, wrong), COLD_ROUNDS, relogin)),
+    ]
+    login()
+    results += [
+        ("sudo, холодный", measure(lambda: cu.handle_sudo(STREAM, sudo), COLD_ROUNDS, VERIFIER.cache.clear)),
+        ("sudo, тёплый", measure(lambda: cu.handle_sudo(STREAM, sudo), WARM_ROUNDS)),
+    ]
+    plain = "s3cret!"
+    results.append(("открытый пароль, ==", measure(lambda: plain == sudo.passwd, WARM_ROUNDS)))
+
+    print(f"PBKDF2-SHA256, {PBKDF2_ITERATIONS} раундов")
+    print(f"{'':>22} {'p50, мкс':>12} {'p99, мкс':>12}")
+    for name, (p50, p99) in results:
+        print(f"{name:>22} {p50:>12.2f} {p99:>12.2f}")
+
+
+if __name__ == "__main__":
+    if VERIFIER.cache is None:
+        sys.exit("VERIFY_CACHE_SIZE=0: кэш проверок выключен, сравнивать нечего")
+    main()
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+import decode
+from models import Event, Stream
+
+# Стоимость декодирования тела запроса на одно событие: прежний путь
+# (json.loads + списковое включение с ev.get) против decode.decode_stream
+# (быстрый декодер, если установлен, и проверка схемы за один проход).
+
+SIZES = [10, 100, 1000]
+
+
+def make_body(n: int) -> bytes:
+    events = []
+    for i in range(n):
+        if i % 3 == 0:
+            events.append({"type": "ssh", "name": f"user{i % 10}", "passwd": "P@ssw0rd!"})
+        elif i % 3 == 1:
+            events.append({"type": "sudo", "name": "", "passwd": "P@ssw0rd!"})
+        else:
+            events.append({"type": "dir", "name": "", "passwd": ""})
+    return json.dumps({"streamId": "stream-1", "events": events}).encode()
+
+
+def old_decode(body: bytes) -> Stream:
+    data = json.loads(body)
+    events = [Event(ev.get("type", ""), ev.get("name", ""), ev.get("passwd", "")) for ev in data["events"]]
+    return Stream(data["streamId"], events)
+
+
+def per_event_ns(fn, body: bytes, n: int) -> float:
+    number = max(10, 20_000 // n)
+    return min(timeit.repeat(lambda: fn(body), number=number, repeat=5)) / number / n * 1e9
+
+
+def main():
+    print(f"декодер: {decode.BACKEND}")
+    print(f"{'events':>8} {'до, нс/событие':>16} {'после, нс/событие':>19}")
+    for n in SIZES:
+        body = make_body(n)
+        before = per_event_ns(old_decode, body, n)
+        after = per_event_ns(decode.decode_stream, body, n)
+        print(f"{n:>8} {before:>16.1f} {after:>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
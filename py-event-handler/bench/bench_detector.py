@@ -0,0 +1,221 @@
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import harness
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from detector import Detector, RingCounter, WindowSketch, key_hash
+from events import SSH, SUDO
+from metrics import ALERTS_SPRAY, ALERTS_STREAM, ALERTS_USER, DETECTOR_BLOCKED, Metrics
+from models import Event
+
+# Детектор подбора паролей (pkg/detector.py) на синтетических атаках:
+#   1. цена структур и обёрток - нс на операцию и на событие в обработке;
+#   2. что и когда он ловит: нагрузка идёт по часам детектора с заданным
+#      темпом событий, CurrentUser заменён моделью без PBKDF2;
+#   3. при --engines - обработчики харнесса на смеси обычной нагрузки и
+#      атак с DETECT=off, alert и enforce.
+#
+# Сценарии атак (attack_streams):
+#   brute   - пароли к одному пользователю из многих потоков по нескольку попыток;
+#   spray   - по одной попытке на имя, имена из каталога и выдуманные
+#             (credential stuffing);
+#   hammer  - несколько потоков, в каждом десятки попыток к разным именам;
+#   normal  - обычная нагрузка харнесса (1% неверных паролей).
+#
+#   python bench/bench_detector.py --events-per-s 500
+#   python bench/bench_detector.py --engines threading,asyncio --streams 2000
+
+SCENARIOS = ("normal", "brute", "spray", "hammer")
+OPS = 200_000
+
+
+def attack_streams(kind: str, n: int, seed: int = 1):
+    """n потоков сценария kind в виде словарей харнесса."""
+    rnd = random.Random(seed)
+    if kind == "normal":
+        return harness.synthetic_streams(n, 8, 0.5, 0.01, seed)
+    streams = []
+    for i in range(n):
+        if kind == "brute":
+            name = harness.USERS[0][0]
+            events = [{"type": "ssh", "name": name, "passwd": f"guess-{rnd.randrange(10**6)}"}
+                      for _ in range(rnd.randint(1, 3))]
+        elif kind == "spray":
+            if rnd.random() < 0.5:
+                name = rnd.choice(harness.USERS)[0]
+            else:
+                name = f"user{rnd.randrange(10**5)}"
+            events = [{"type": "ssh", "name": name, "passwd": "Winter2024!"}]
+        elif kind == "hammer":
+            events = [{"type": "ssh", "name": rnd.choice(harness.USERS)[0], "passwd": f"guess-{j}"}
+                      for j in range(40)]
+        else:
+            raise ValueError(f"unknown scenario {kind}")
+        streams.append({"streamId": f"{kind}-{i}", "events": events})
+    return streams
+
+
+class ModelUser:
+    """CurrentUser без PBKDF2 и блокировок: исходы ssh и sudo по таблице паролей."""
+
+    passwords = dict(harness.USERS)
+
+    def __init__(self):
+        self.cuid = -1
+        self.name = ""
+        self.ssh_failures = 0
+        self.sudo_failures = 0
+        self.lockouts = 0
+
+    def handle_ssh(self, stream_id, event):
+        passwd = self.passwords.get(event.name)
+        if passwd is None:
+            return
+        if event.passwd != passwd:
+            self.ssh_failures += 1
+            self.cuid = -1
+            return
+        self.cuid, self.name = 0, event.name
+
+    def handle_sudo(self, stream_id, event):
+        if self.cuid != -1 and event.passwd != self.passwords[self.name]:
+            self.sudo_failures += 1
+
+
+class Clock:
+    def __init__(self):
+        self.now = 10**12
+
+    def __call__(self):
+        return self.now
+
+
+def events_of(streams):
+    return [(s["streamId"], Event(e["type"], e.get("name", ""), e.get("passwd", "")))
+            for s in streams for e in s["events"]]
+
+
+def new_detector(enforce: bool, clock):
+    return Detector(Metrics(), enforce=enforce, clock=clock)
+
+
+# --------- 1. цена ---------
+def per_op(fn, n: int = OPS) -> float:
+    start = time.perf_counter_ns()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter_ns() - start) / n
+
+
+def bench_cost() -> None:
+    # тик не меняется: смена корзины - отдельная строка
+    ring = RingCounter(12)
+    sketch = WindowSketch(4, 4096, 12)
+    keys = [key_hash(f"user{i}") for i in range(4096)]
+    print(f"RingCounter.add            {per_op(lambda i: ring.add(1)):>8.0f} нс")
+    print(f"WindowSketch.add           {per_op(lambda i: sketch.add(keys[i & 4095], 1)):>8.0f} нс")
+    print(f"смена корзины sketch'а     {per_op(lambda i: sketch.add(keys[i & 4095], i + 2), 2000):>8.0f} нс")
+
+    clock = Clock()
+    detector = new_detector(True, clock)
+    names = [f"user{i}" for i in range(4096)]
+    sids = [f"s{i}" for i in range(1024)]
+
+    def fail(i):
+        clock.now += 50_000
+        detector.failure(names[i & 4095], sids[i & 1023], clock.now)
+    print(f"Detector.failure           {per_op(fail):>8.0f} нс (с тревогами и блокировками)")
+
+    # события через обработчики ModelUser без детектора и с обёртками детектора
+    plain = {SSH.code: ModelUser.handle_ssh, SUDO.code: ModelUser.handle_sudo}
+    noop = lambda cu, stream_id, event: None
+    for kind in ("normal", "spray"):
+        events = events_of(attack_streams(kind, 5000))
+        for mode in ("off", "alert", "enforce"):
+            table = plain
+            if mode != "off":
+                d = new_detector(mode == "enforce", time.monotonic_ns)
+                table = {SSH.code: d.wrap_ssh(plain[SSH.code]), SUDO.code: d.wrap_sudo(plain[SUDO.code])}
+            cu = ModelUser()
+            start = time.perf_counter_ns()
+            for stream_id, event in events:
+                table.get(event.code, noop)(cu, stream_id, event)
+            print(f"{kind:>7}, {mode:<7}           {(time.perf_counter_ns() - start) / len(events):>8.0f} нс/событие")
+
+
+# --------- 2. обнаружение ---------
+def bench_detection(rate: float, enforce: bool) -> None:
+    gap = int(1e9 / rate)
+    for kind in SCENARIOS:
+        streams = attack_streams(kind, 3000)
+        clock = Clock()
+        detector = new_detector(enforce, clock)
+        ssh, sudo = detector.wrap_ssh(ModelUser.handle_ssh), detector.wrap_sudo(ModelUser.handle_sudo)
+        first_alert = None
+        attempts = 0
+        for stream_id, event in events_of(streams):
+            clock.now += gap
+            cu = ModelUser()
+            if event.code == SSH.code:
+                attempts += 1
+                ssh(cu, stream_id, event)
+            elif event.code == SUDO.code:
+                sudo(cu, stream_id, event)
+            if first_alert is None and any(detector.metrics.snapshot()[c] for c in (ALERTS_USER, ALERTS_STREAM, ALERTS_SPRAY)):
+                first_alert = attempts
+        snap = detector.metrics.snapshot()
+        print(f"{kind:>7}: ssh {attempts:>6}, тревоги user {snap[ALERTS_USER]:>4} stream {snap[ALERTS_STREAM]:>4} "
+              f"spray {snap[ALERTS_SPRAY]:>3}, отклонено {snap[DETECTOR_BLOCKED]:>6}, "
+              f"первая тревога на попытке {first_alert if first_alert is not None else '-'}")
+
+
+# --------- 3. обработчики ---------
+def bench_engines(args) -> None:
+    rnd = random.Random(args.seed)
+    load = attack_streams("normal", args.streams, args.seed)
+    for kind in ("brute", "spray", "hammer"):
+        load += attack_streams(kind, args.streams // 10, args.seed)
+    rnd.shuffle(load)
+    for name in args.engines.split(","):
+        for mode in ("off", "alert", "enforce"):
+            run_args = SimpleNamespace(concurrency=args.concurrency, batch=args.batch, warmup=0,
+                                       log_mode="off", env=[f"DETECT={mode}"] + args.env)
+            try:
+                result = harness.run_engine(name, load, run_args)
+            except RuntimeError as e:
+                print(f"{name}: пропущен ({e})")
+                break
+            lat = result["latency_ms"]
+            print(f"{name:>10} {mode:<7}: {result['streams_per_s']:>10,.0f} потоков/с  "
+                  f"p50 {lat['p50']:.2f} p99 {lat['p99']:.2f} мс  CPU {result['cpu_percent']:.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="детектор подбора паролей на синтетических атаках")
+    parser.add_argument("--events-per-s", type=float, default=200, help="темп событий для обнаружения")
+    parser.add_argument("--engines", default="", help="прогнать через обработчики харнесса")
+    parser.add_argument("--streams", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для окружения сервера")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    bench_cost()
+    for enforce in (False, True):
+        print(f"\nобнаружение, {'enforce' if enforce else 'alert'}, {args.events_per_s:.0f} событий/с:")
+        bench_detection(args.events_per_s, enforce)
+    if args.engines:
+        print()
+        bench_engines(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import csv
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import harness
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from credentials import Credential
+from directory import Directory, UserStore
+from user_index import UserIndex
+
+# Каталог пользователей (directory.Directory) против словаря в памяти
+# (user_index.UserIndex) на --users пользователях: время первого импорта CSV
+# и повторного старта с готовым импортом, прирост RSS, поиск
+# горячего (в LRU) и холодного (запрос к SQLite) пользователя, reload().
+# В CSV лежат готовые хеши (1 раунд PBKDF2), иначе генерация и загрузка
+# меряли бы PBKDF2, а не каталог.
+#
+#   python bench/bench_directory.py --users 1000000 --cache 100000
+
+LOOKUPS = 100_000
+
+
+def write_csv(path: str, size: int) -> None:
+    # один хеш на всех: разбор строки стоит столько же, а генерация быстрее
+    secret = Credential.create("x", iterations=1).encode()
+    with open(path, "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(("uid", "name", "hash"))
+        for uid in range(size):
+            out.writerow((uid, f"user{uid}", secret))
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def measured(fn):
+    # прирост RSS процесса: tracemalloc замедлил бы сам замер в разы
+    before = harness.rss_bytes([os.getpid()])
+    result, seconds = timed(fn)
+    return result, seconds, (harness.rss_bytes([os.getpid()]) - before) / 2**20
+
+
+def per_lookup_ns(lookup, names) -> float:
+    start = time.perf_counter_ns()
+    for name in names:
+        lookup(name)
+    return (time.perf_counter_ns() - start) / len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="каталог пользователей: старт, память, поиск")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--cache", type=int, default=100_000, help="USERS_CACHE_SIZE")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "users.csv")
+        _, gen_s = timed(lambda: write_csv(source, args.users))
+        print(f"{args.users:,} пользователей, CSV {os.path.getsize(source) / 2**20:.0f} МБ ({gen_s:.1f} с)")
+
+        _, first_s = timed(lambda: UserStore(source, tmp))
+        directory, again_s, dir_mb = measured(lambda: Directory(UserStore(source, tmp), args.cache))
+        print(f"первый импорт в SQLite    {first_s:>8.2f} с")
+        print(f"старт с готовым импортом  {again_s * 1e3:>8.2f} мс, {dir_mb:.1f} МБ")
+
+        rnd = random.Random(1)
+        hot = [f"user{rnd.randrange(args.cache)}" for _ in range(LOOKUPS)]
+        cold = [f"user{rnd.randrange(args.cache, args.users)}" for _ in range(LOOKUPS)]
+
+        def warm():
+            for uid in range(args.cache):
+                directory.lookup(f"user{uid}")
+        _, warm_s, warm_mb = measured(warm)
+        print(f"прогрев LRU               {warm_s:>8.2f} с, {warm_mb:.0f} МБ")
+        hot_ns = per_lookup_ns(directory.lookup, hot)
+        # холодные: каждый раз запрос к SQLite и вытеснение из LRU
+        cold_ns = per_lookup_ns(directory.lookup, cold)
+        cached = directory.cached()
+        _, reload_s = timed(directory.reload)
+        print(f"поиск в LRU               {hot_ns:>8.0f} нс")
+        print(f"поиск в SQLite            {cold_ns / 1e3:>8.1f} мкс")
+        print(f"reload()                  {reload_s * 1e3:>8.2f} мс")
+        print(f"в памяти каталога         {cached:,} пользователей (LRU {args.cache:,})")
+
+        def eager():
+            return UserIndex({uid: user for uid, user in directory.items()})
+
+        index, eager_s, index_mb = measured(eager)
+        index_ns = per_lookup_ns(index.lookup, cold)
+        print(f"UserIndex целиком         {eager_s:>8.2f} с, {index_mb:.0f} МБ, поиск {index_ns:.0f} нс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import random
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from events import EVENT_TYPES, dispatch_table, register
+from models import Event
+
+# Цена выбора обработчика события при разном числе типов:
+#   цепочка if/elif по строке типа, как было в обработчиках до реестра
+#   (каждый новый тип - ещё одно сравнение для всех, кто ниже по цепочке);
+#   словарь имя -> функция;
+#   таблица реестра по коду: dispatch_table(cls)[event.code].
+# Обработчики пустые, меряется выбор, вызов и подсчёт событий по типам
+# (как в handle_stream для метрик). Типы сверх ssh/sudo/dir регистрируются
+# в реестре этого процесса под именами t4, t5, ...
+#
+#   python bench/bench_dispatch.py --types 3,8,16,32 --events 1000000
+
+ROUNDS = 5
+
+
+class User:
+    """Пользователь с пустыми обработчиками; у каждого типа - свой метод."""
+
+    def handle(self, stream_id, event):
+        pass
+
+
+def add_types(n: int) -> None:
+    for i in range(len(EVENT_TYPES), n + 1):
+        name = f"t{i}"
+        register(name, ("name",))
+        setattr(User, f"handle_{name}", User.handle)
+    for name in ("ssh", "sudo", "dir"):
+        setattr(User, f"handle_{name}", User.handle)
+
+
+def make_chain(names):
+    """Функция с цепочкой if/elif по именам типов: та же форма, что была в handle_stream."""
+    lines = ["def run(cu, stream_id, events):", f"    counts = [0] * {len(names)}", "    for event in events:"]
+    for i, name in enumerate(names):
+        lines.append(f"        {'if' if i == 0 else 'elif'} event.type == {name!r}:")
+        lines.append(f"            counts[{i}] += 1")
+        lines.append(f"            cu.handle_{name}(stream_id, event)")
+    scope = {}
+    exec("\n".join(lines), scope)
+    return scope["run"]
+
+
+def run_dict(cu, stream_id, events):
+    handlers = {etype.name: getattr(User, f"handle_{etype.name}") for etype in EVENT_TYPES[1:]}
+    counts = dict.fromkeys(handlers, 0)
+    for event in events:
+        etype = event.type
+        counts[etype] += 1
+        handlers[etype](cu, stream_id, event)
+
+
+def run_table(cu, stream_id, events):
+    handlers = dispatch_table(User)
+    counts = [0] * len(handlers)
+    for event in events:
+        code = event.code
+        counts[code] += 1
+        handlers[code](cu, stream_id, event)
+
+
+def best(fn, cu, events) -> float:
+    times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter_ns()
+        fn(cu, "bench", events)
+        times.append(time.perf_counter_ns() - start)
+    return min(times) / len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="цена выбора обработчика события")
+    parser.add_argument("--types", default="3,8,16,32", help="числа типов через запятую")
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    counts = sorted(int(n) for n in args.types.split(","))
+    print(f"{'типов':>6} {'if/elif':>10} {'словарь':>10} {'таблица':>10}   нс на событие")
+    for n in counts:
+        add_types(n)
+        names = [etype.name for etype in EVENT_TYPES[1:n + 1]]
+        rnd = random.Random(args.seed)
+        # равномерно по типам: в среднем событие проходит половину цепочки
+        events = [Event(rnd.choice(names), "user") for _ in range(args.events)]
+        cu = User()
+        chain = best(make_chain(names), cu, events)
+        mapping = best(run_dict, cu, events)
+        table = best(run_table, cu, events)
+        print(f"{n:>6} {chain:>10.1f} {mapping:>10.1f} {table:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
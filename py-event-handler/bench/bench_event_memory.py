@@ -0,0 +1,56 @@
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from models import Event
+
+# Байт на событие: прежний класс с __dict__ и отдельными копиями строк
+# (как после json-декодирования, где каждая строка - новый объект) против
+# общего Event со __slots__ и интернированием.
+
+N = 1_000_000
+NAMES = ["superadmin", "auditor", "dev_user", "tester", "analyst",
+         "support", "reports", "backup", "api_user", "guest"]
+
+
+class OldEvent:
+    def __init__(self, type_: str, name: str = "", passwd: str = ""):
+        self.type = type_
+        self.name = name
+        self.passwd = passwd
+
+
+def fresh(s: str) -> str:
+    # новая копия строки, как её отдаёт json.loads для каждого события
+    return "".join(list(s))
+
+
+def build(cls):
+    events = []
+    for i in range(N):
+        name = NAMES[i % len(NAMES)]
+        events.append(cls(fresh("ssh"), fresh(name), fresh(name + "!pw")))
+    return events
+
+
+def measure(cls) -> float:
+    gc.collect()
+    tracemalloc.start()
+    events = build(cls)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del events
+    return current / N
+
+
+def main():
+    old = measure(OldEvent)
+    new = measure(Event)
+    print(f"до:    {old:.1f} байт на событие")
+    print(f"после: {new:.1f} байт на событие ({old / new:.1f}x меньше)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from credentials import Credential
+from logs import setup_logging
+from parse import read_and_parse_file
+from shm_users import SharedUserTable, SharedCurrentUser
+
+# Время handle_stream при разных режимах логирования: sync (как раньше),
+# queue (очередь и отдельный писатель пачками), off и queue с LOG_LEVEL=ERROR.
+# THREADS потоков одновременно гоняют потоки из streams50.txt; вывод логов
+# идёт в /dev/null.
+
+THREADS = 8
+ROUNDS = 200
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "go-data-handler", "data", "streams50.txt")
+
+
+class User:
+    def __init__(self, name, passwd):
+        self.name = name
+        # PBKDF2 здесь не меряется (см. bench_credentials.py): один раунд
+        self.cred = Credential.create(passwd, iterations=1)
+        self.auth_retries = 0
+
+
+USERS_INIT = {
+    0: User("superadmin", "P@ssw0rd!"), 1: User("auditor", "Secur3!2023"),
+    2: User("dev_user", "d3v3l0p3r"), 3: User("tester", "t3st3r!123"),
+    4: User("analyst", "Data2023!"), 5: User("support", "HelpDesk!"),
+    6: User("reports", "R3port$"), 7: User("backup", "B@ckUp123"),
+    8: User("api_user", "Ap1K3y!2023"), 9: User("guest", "T3mpPass!"),
+}
+
+
+def handle_stream(users, stream, stream_id):
+    cu = SharedCurrentUser(users)
+    for event in stream.events:
+        if event.type == "ssh":
+            cu.handle_ssh(stream_id, event)
+        elif event.type == "sudo":
+            cu.handle_sudo(stream_id, event)
+        elif event.type == "dir":
+            cu.handle_dir(stream_id, event)
+    # выходим, чтобы следующий раунд снова проходил авторизацию
+    if cu.cuid != -1:
+        users.set_authd(cu.cuid, "")
+
+
+def run(mode: str, users, streams, level=logging.INFO) -> float:
+    devnull = open(os.devnull, "w")
+    listener = setup_logging(mode, level=level, stream=devnull)
+    timings = []
+
+    def work(tid):
+        local = []
+        for r in range(ROUNDS):
+            for s in streams:
+                start = time.perf_counter_ns()
+                handle_stream(users, s, f"{s.stream_id}-{tid}-{r}")
+                local.append(time.perf_counter_ns() - start)
+        timings.extend(local)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if listener:
+        listener.stop()
+    devnull.close()
+    for uid in range(users.capacity):
+        users.set_retries(uid, 0)
+    return sum(timings) / len(timings)
+
+
+def main():
+    streams = read_and_parse_file(DATA)
+    users = SharedUserTable.create(USERS_INIT)
+    try:
+        results = [(mode, run(mode, users, streams)) for mode in ("sync", "queue", "off")]
+        results.append(("queue+ERROR", run("queue", users, streams, logging.ERROR)))
+    finally:
+        users.close()
+        users.unlink()
+    setup_logging("sync")
+    for mode, avg_ns in results:
+        print(f"{mode:>12}: {avg_ns/1e3:.3f} мкс на handle_stream ({THREADS} потоков)")
+
+
+if __name__ == "__main__":
+    main()
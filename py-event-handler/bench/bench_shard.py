@@ -0,0 +1,120 @@
+import logging
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from credentials import Credential
+from models import Event, Stream
+from pool import ProcessWorkerPool, ThreadWorkerPool
+from session import CurrentUser, LockStripes
+from shard import ShardedEngine
+from shm_users import SharedCurrentUser, SharedUserTable
+from user_index import UserIndex
+
+# Пропускная способность без HTTP: одни и те же синтетические потоки
+# обрабатываются пулом потоков (session.CurrentUser), пулом процессов над
+# общей памятью (SharedCurrentUser) и ShardedEngine с 1..MAX_SHARDS шардами.
+# Логирование выключено. Масштабирование видно только на многоядерной машине.
+
+STREAMS = 20_000
+EVENTS = 8
+USERS_N = 1000
+MAX_SHARDS = os.cpu_count() or 4
+
+
+@dataclass
+class User:
+    name: str
+    passwd: str
+    authd: str = ""
+    auth_retries: int = 0
+    # PBKDF2 здесь не меряется (см. bench_credentials.py): один раунд
+    cred: Credential = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.cred = Credential.create(self.passwd, iterations=1)
+
+
+def make_users():
+    return {i: User(name=f"user{i}", passwd=f"pw{i}") for i in range(USERS_N)}
+
+
+def make_streams():
+    rnd = random.Random(1)
+    streams = []
+    for i in range(STREAMS):
+        events = []
+        for k in range(EVENTS):
+            # ssh в начале и ещё один в середине, чтобы потоки переходили между шардами
+            if k in (0, EVENTS // 2):
+                uid = rnd.randrange(USERS_N)
+                passwd = f"pw{uid}" if rnd.random() > 0.1 else "wrong"
+                events.append(Event("ssh", f"user{uid}", passwd))
+            elif rnd.random() < 0.5:
+                events.append(Event("sudo", "", f"pw{uid}"))
+            else:
+                events.append(Event("dir"))
+        streams.append(Stream(f"stream-{i}", events))
+    return streams
+
+
+def thread_stream(stream, users, locks):
+    cu = CurrentUser(users, locks)
+    for event in stream.events:
+        if event.type == "ssh":
+            cu.handle_ssh(stream.stream_id, event)
+        elif event.type == "sudo":
+            cu.handle_sudo(stream.stream_id, event)
+        elif event.type == "dir":
+            cu.handle_dir(stream.stream_id, event)
+
+
+def process_stream(stream, users):
+    cu = SharedCurrentUser(users)
+    for event in stream.events:
+        if event.type == "ssh":
+            cu.handle_ssh(stream.stream_id, event)
+        elif event.type == "sudo":
+            cu.handle_sudo(stream.stream_id, event)
+        elif event.type == "dir":
+            cu.handle_dir(stream.stream_id, event)
+
+
+def run(pool, streams) -> float:
+    pool.start()
+    start = time.perf_counter()
+    for s in streams:
+        pool.submit(s, block=True)
+    pool.shutdown()
+    return len(streams) / (time.perf_counter() - start)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    streams = make_streams()
+    workers = MAX_SHARDS
+
+    rate = run(ThreadWorkerPool(thread_stream, workers, 1024,
+                                args=(UserIndex(make_users()), LockStripes())), streams)
+    print(f"{'потоки':>12} ({workers}): {rate:,.0f} потоков/с")
+
+    table = SharedUserTable.create(make_users())
+    try:
+        rate = run(ProcessWorkerPool(process_stream, workers, 1024, args=(table,)), streams)
+    finally:
+        table.close()
+        table.unlink()
+    print(f"{'процессы':>12} ({workers}): {rate:,.0f} потоков/с")
+
+    shards = 1
+    while shards <= MAX_SHARDS:
+        rate = run(ShardedEngine(UserIndex(make_users()), shards, 4096), streams)
+        print(f"{'шарды':>12} ({shards}): {rate:,.0f} потоков/с")
+        shards *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from multiprocessing import Manager, Process, Queue
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from credentials import Credential
+from shm_users import SharedUserTable, SharedCurrentUser
+
+# Задержка на событие в воркер-процессе: старый путь через Manager().dict
+# (каждое чтение USERS[uid] - IPC к процессу менеджера) против таблицы
+# в общей памяти. Логирование отключено, меряется только работа с состоянием.
+
+ROUNDS = 20_000
+
+
+@dataclass
+class User:
+    name: str
+    passwd: str
+    authd: str = ""
+    auth_retries: int = 0
+    # PBKDF2 здесь не меряется (см. bench_credentials.py): один раунд
+    cred: Credential = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.cred = Credential.create(self.passwd, iterations=1)
+
+
+class Ev:
+    def __init__(self, type_, name="", passwd=""):
+        self.type = type_
+        self.name = name
+        self.passwd = passwd
+
+
+USERS_INIT = {uid: User(name=f"user{uid}", passwd=f"pw{uid}") for uid in range(100)}
+INDEX = {user.name: uid for uid, user in USERS_INIT.items()}
+EVENTS = [Ev("ssh", "user42", "pw42"), Ev("sudo", "", "pw42"), Ev("dir")]
+
+
+def manager_worker(users, out):
+    logging.disable(logging.CRITICAL)
+    start = time.perf_counter_ns()
+    for _ in range(ROUNDS):
+        cuid = -1
+        for ev in EVENTS:
+            if ev.type == "ssh":
+                cuid = INDEX.get(ev.name, -1)
+                user = users[cuid]
+                if ev.passwd == user.passwd:
+                    user.authd = "bench"
+            elif ev.type == "sudo":
+                user = users[cuid]
+                _ = ev.passwd == user.passwd
+            elif ev.type == "dir":
+                _ = users[cuid].name
+    out.put((time.perf_counter_ns() - start) / (ROUNDS * len(EVENTS)))
+
+
+def shm_worker(users, out):
+    logging.disable(logging.CRITICAL)
+    start = time.perf_counter_ns()
+    for i in range(ROUNDS):
+        cu = SharedCurrentUser(users)
+        sid = f"bench-{i}"
+        for ev in EVENTS:
+            if ev.type == "ssh":
+                cu.handle_ssh(sid, ev)
+            elif ev.type == "sudo":
+                cu.handle_sudo(sid, ev)
+            elif ev.type == "dir":
+                cu.handle_dir(sid, ev)
+        users.set_authd(cu.cuid, "")
+    out.put((time.perf_counter_ns() - start) / (ROUNDS * len(EVENTS)))
+
+
+def run(target, users):
+    out = Queue()
+    p = Process(target=target, args=(users, out))
+    p.start()
+    result = out.get()
+    p.join()
+    return result
+
+
+def main():
+    manager = Manager()
+    manager_users = manager.dict(USERS_INIT)
+    shm_users = SharedUserTable.create(USERS_INIT)
+    try:
+        manager_ns = run(manager_worker, manager_users)
+        shm_ns = run(shm_worker, shm_users)
+    finally:
+        shm_users.close()
+        shm_users.unlink()
+        manager.shutdown()
+
+    print(f"Manager().dict: {manager_ns/1e3:.3f} мкс на событие")
+    print(f"shared_memory:  {shm_ns/1e3:.3f} мкс на событие (с проверкой хеша пароля и блокировками)")
+
+
+if __name__ == "__main__":
+    main()
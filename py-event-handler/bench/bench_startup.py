@@ -0,0 +1,129 @@
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import harness
+
+# Время старта обработчиков и fork их воркеров:
+#   1. импорт скрипта движка в свежем интерпретаторе (runpy, не как
+#      __main__): секунды, число модулей и загружен ли HTTP-фреймворк;
+#   2. холодный старт режима --file на пустом файле - от запуска
+#      интерпретатора до выхода, напрямую и через python -m event_handler;
+#   3. готовность сервера - от запуска до первого ответа /metrics;
+#   4. fork после импорта движка: старт и join процесса-пустышки и RSS
+#      родителя, который наследует каждый воркер пула.
+# Все замеры - медиана по --rounds запускам.
+#
+# --root - каталог py-event-handler другого дерева, например до изменений:
+#   mkdir /tmp/old && git archive HEAD~1 | tar -x -C /tmp/old
+#   python bench/bench_startup.py --root /tmp/old/py-event-handler
+#   python bench/bench_startup.py --rounds 10 --env WORKERS=4
+
+SCRIPTS = {
+    "threading": os.path.join("threading-event-handler", "__threading__.py"),
+    "process": os.path.join("multiprocessing-event-handler", "__multiprocessing__.py"),
+    "asyncio": os.path.join("asyncio-event-handler", "__asyncio__.py"),
+    "sharded": os.path.join("sharded-event-handler", "__sharded__.py"),
+}
+FRAMEWORKS = ("flask", "fastapi", "uvicorn")
+
+PROBE = """
+import json, multiprocessing, runpy, sys, time
+start = time.perf_counter()
+runpy.run_path(sys.argv[1], run_name="engine")
+imported = time.perf_counter() - start
+forks = []
+for _ in range(int(sys.argv[2])):
+    start = time.perf_counter()
+    p = multiprocessing.Process(target=int)
+    p.start()
+    p.join()
+    forks.append(time.perf_counter() - start)
+rss = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmRSS:"))
+print(json.dumps({"import": imported, "fork": min(forks), "rss_kb": rss, "modules": len(sys.modules),
+                  "frameworks": [m for m in %r if m in sys.modules]}))
+""" % (FRAMEWORKS,)
+
+
+def median(fn, rounds: int) -> float:
+    return statistics.median(fn() for _ in range(rounds))
+
+
+def probe(root: str, script: str, env) -> dict:
+    out = subprocess.run([sys.executable, "-c", PROBE, os.path.join(root, script), "5"], cwd=root, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def cold_start(root: str, cmd, env) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + cmd, cwd=root, env=env, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def time_to_ready(root: str, script: str, env, timeout: float = 60) -> float:
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(root, script)], cwd=root, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        while time.perf_counter() - start < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with code {proc.returncode}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", harness.PORT, timeout=1)
+                conn.request("GET", "/metrics")
+                conn.getresponse().read()
+                conn.close()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError(f"server did not answer /metrics in {timeout}s")
+    finally:
+        harness.stop_engine(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="время старта обработчиков и fork воркеров")
+    parser.add_argument("--root", default=harness.ROOT, help="каталог py-event-handler")
+    parser.add_argument("--engines", default=",".join(SCRIPTS))
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--no-server", action="store_true", help="без замера готовности сервера")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для окружения обработчиков")
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    env = dict(os.environ, MAX_STREAMS="0", REPORT_INTERVAL="0", LOG_MODE="off",
+               **dict(kv.split("=", 1) for kv in args.env))
+    cli = os.path.isdir(os.path.join(root, "event_handler"))
+    empty = tempfile.NamedTemporaryFile(suffix=".txt")
+    print(f"{root}, медиана по {args.rounds}")
+    print(f"{'':<10}{'импорт':>9}{'модулей':>9}{'--file':>9}{'-m':>9}{'сервер':>9}"
+          f"{'fork':>9}{'RSS':>8}   фреймворки при импорте")
+    for name in args.engines.split(","):
+        script = SCRIPTS[name]
+        probes = [probe(root, script, env) for _ in range(args.rounds)]
+        imported = statistics.median(p["import"] for p in probes)
+        fork = statistics.median(p["fork"] for p in probes)
+        rss = statistics.median(p["rss_kb"] for p in probes)
+        file_mode = median(lambda: cold_start(root, [script, "--file", empty.name], env), args.rounds)
+        via_cli = "-"
+        if cli:
+            cmd = ["-m", "event_handler", "--engine", name, "--file", empty.name]
+            via_cli = f"{median(lambda: cold_start(root, cmd, env), args.rounds):.3f}"
+        ready = "-"
+        if not args.no_server:
+            ready = f"{median(lambda: time_to_ready(root, script, env), args.rounds):.3f}"
+        print(f"{name:<10}{imported:>9.3f}{probes[0]['modules']:>9}{file_mode:>9.3f}{via_cli:>9}{ready:>9}"
+              f"{fork * 1e3:>7.1f}мс{rss / 1024:>6.0f}МБ   {','.join(probes[0]['frameworks']) or '-'}")
+    print("секунды, кроме fork и RSS")
+
+
+if __name__ == "__main__":
+    main()
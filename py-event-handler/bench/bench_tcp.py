@@ -0,0 +1,176 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import harness
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from wire import ACK, encode_stream
+
+# Двоичный приём по TCP (pkg/wire.py) против HTTP на одной нагрузке.
+# Сервер запускается харнессом с TCP_PORT; HTTP прогоняется как в
+# bench/harness.py (по потоку в / и пачками в /batch), TCP - --concurrency
+# долгими соединениями, в каждом до --window потоков без ответа.
+#
+#   python bench/bench_tcp.py --engines threading,process,asyncio --repeat 20
+#   python bench/bench_tcp.py --streams 20000 --events 8 --window 64
+
+TCP_PORT = 8082
+
+
+def connect(port: int, timeout: float = 10) -> socket.socket:
+    # харнесс ждёт только HTTP-порт, TCP открывается следом
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def recv_exactly(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if not k:
+            raise ConnectionError("server closed the connection")
+        got += k
+    return bytes(buf)
+
+
+def replay_tcp(streams, concurrency: int, window: int, port: int = TCP_PORT):
+    """Потоки по concurrency соединениям окнами по window; время, задержки окон, коды."""
+    frames = [encode_stream(s["streamId"], s["events"]) for s in streams]
+    parts = [frames[i::concurrency] for i in range(concurrency)]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def run(part):
+        sock = connect(port)
+        local_lat = []
+        local_status = {}
+        try:
+            for i in range(0, len(part), window):
+                chunk = part[i:i + window]
+                start = time.perf_counter()
+                sock.sendall(b"".join(chunk))
+                for (code,) in ACK.iter_unpack(recv_exactly(sock, ACK.size * len(chunk))):
+                    local_status[code] = local_status.get(code, 0) + 1
+                local_lat.append(time.perf_counter() - start)
+        except OSError:
+            local_status["error"] = local_status.get("error", 0) + 1
+        finally:
+            sock.close()
+        with lock:
+            latencies.extend(local_lat)
+            for k, v in local_status.items():
+                statuses[k] = statuses.get(k, 0) + v
+
+    threads = [threading.Thread(target=run, args=(part,)) for part in parts if part]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies, statuses
+
+
+def wait_idle(timeout: float = 120) -> None:
+    """Ждёт, пока сервер разберёт очередь предыдущего прогона (queue_depth в /metrics)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        conn = http.client.HTTPConnection("127.0.0.1", harness.PORT, timeout=5)
+        conn.request("GET", "/metrics")
+        body = conn.getresponse().read().decode()
+        conn.close()
+        depth = next(line.split()[-1] for line in body.splitlines()
+                     if line.startswith("event_handler_queue_depth"))
+        if float(depth) == 0:
+            return
+        time.sleep(0.1)
+
+
+def measure(name: str, streams, args):
+    env = dict(kv.split("=", 1) for kv in args.env)
+    env["TCP_PORT"] = str(TCP_PORT)
+    proc = harness.start_engine(name, args.log_mode, env)
+    rows = []
+    try:
+        for label, batch in (("http /", 0), (f"http /batch {args.batch}", args.batch), (f"tcp окно {args.window}", None)):
+            wait_idle()
+            # свои id на каждый прогон: уже принятые потоки держат пользователей
+            run = [dict(s, streamId=f"{s['streamId']}-{len(rows)}") for s in streams]
+            if batch is None:
+                elapsed, latencies, statuses = replay_tcp(run, args.concurrency, args.window)
+            else:
+                elapsed, latencies, statuses = harness.replay(run, args.concurrency, batch)
+            lat = sorted(latencies)
+            rows.append({
+                "engine": name,
+                "path": label,
+                "streams_per_s": round(len(streams) / elapsed, 1),
+                "p50_ms": round(harness.percentile(lat, 0.5) * 1e3, 3),
+                "p99_ms": round(harness.percentile(lat, 0.99) * 1e3, 3),
+                "statuses": {str(k): v for k, v in statuses.items()},
+            })
+    finally:
+        harness.stop_engine(proc)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TCP-приём против HTTP")
+    parser.add_argument("--engines", default="threading,process,asyncio")
+    parser.add_argument("--file", default=harness.DATA)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--streams", type=int, default=0, help="синтетика вместо файла")
+    parser.add_argument("--events", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--window", type=int, default=64, help="потоков без ответа в одном TCP-соединении")
+    parser.add_argument("--log-mode", default="off")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для окружения сервера")
+    parser.add_argument("--out", default="bench_tcp.json")
+    args = parser.parse_args()
+
+    if args.streams:
+        streams = harness.synthetic_streams(args.streams, args.events, 0.0, 0.1, 1)
+    else:
+        streams = harness.file_streams(args.file, args.repeat)
+
+    results = []
+    for name in args.engines.split(","):
+        if name not in ("threading", "process", "asyncio"):
+            parser.error(f"engine {name} has no TCP ingest")
+        try:
+            rows = measure(name, streams, args)
+        except RuntimeError as e:
+            print(f"{name}: пропущен ({e})")
+            continue
+        for row in rows:
+            print(f"{name:>10} {row['path']:<16}: {row['streams_per_s']:>10,.0f} потоков/с  "
+                  f"p50 {row['p50_ms']:.2f} p99 {row['p99_ms']:.2f} мс  {row['statuses']}")
+        results.extend(rows)
+
+    with open(args.out, "w") as f:
+        json.dump({"streams": len(streams), "concurrency": args.concurrency, "batch": args.batch,
+                   "window": args.window, "python": sys.version.split()[0],
+                   "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results},
+                  f, indent=2, ensure_ascii=False)
+    print(f"результаты: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
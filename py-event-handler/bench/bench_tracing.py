@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import harness
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from decode import decode_stream
+from directory import open_directory
+from events import dispatch_table
+from logs import setup_logging
+from metrics import Metrics, STAGE_DECODE
+from session import CurrentUser, LockStripes
+import tracing
+from tracing import PROFILE, STAGES, TRACER, open_tracer
+
+# Цена хуков трассировки (pkg/tracing.py) вне окна и в окне:
+#   1. сами хуки - TRACER.handlers вместо dispatch_table на поток и
+#      TRACER.call вокруг разбора тела запроса;
+#   2. handle_stream threading-обработчика (session.CurrentUser, логи в
+#      /dev/null) на синтетических потоках без окна, с этапами, с профилем
+#      и с тем и другим; пароли верные, PBKDF2 после первого раунда берётся
+#      из кэша проверок, так что виден вклад самих хуков.
+#
+#   python bench/bench_tracing.py --streams 2000 --rounds 3
+#   TRACE_SAMPLE_MS=1 python bench/bench_tracing.py
+
+OPS = 200_000
+
+
+def per_op(fn, n: int = OPS) -> float:
+    start = time.perf_counter_ns()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter_ns() - start) / n
+
+
+def bench_hooks(stream, body: bytes) -> None:
+    print(f"{'':<28}{'вне окна':>10}{'этапы':>10}   нс")
+    rows = [
+        ("dispatch_table", lambda: dispatch_table(CurrentUser)),
+        ("TRACER.handlers", lambda: TRACER.handlers(CurrentUser, stream)),
+        ("decode_stream", lambda: decode_stream(body)),
+        ("TRACER.call(decode_stream)", lambda: TRACER.call(STAGE_DECODE, decode_stream, body)),
+    ]
+    for name, fn in rows:
+        off = per_op(fn)
+        TRACER.begin(STAGES)
+        on = per_op(fn)
+        TRACER.end()
+        print(f"{name:<28}{off:>10.0f}{on:>10.0f}")
+
+
+def run_streams(users, locks, streams, rounds: int) -> float:
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        for stream in streams:
+            cu = CurrentUser(users, locks)
+            stream_id = stream.stream_id
+            handlers = TRACER.handlers(CurrentUser, stream)
+            for event in stream.events:
+                handlers[event.code](cu, stream_id, event)
+            cu.logout(stream_id)
+        elapsed = (time.perf_counter_ns() - start) / len(streams)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_streams(streams, rounds: int) -> None:
+    users = open_directory()
+    locks = LockStripes(64)
+    # прогрев кэша проверок паролей
+    run_streams(users, locks, streams, 1)
+    base = None
+    print(f"\nhandle_stream, {len(streams)} потоков по {len(streams[0].events)} событий, "
+          f"семплер раз в {tracing.TRACE_SAMPLE_MS:g} мс:")
+    for name, mode in (("вне окна", 0), ("этапы", STAGES), ("профиль", PROFILE), ("этапы и профиль", STAGES | PROFILE)):
+        if mode:
+            TRACER.begin(mode)
+        ns = run_streams(users, locks, streams, rounds)
+        if mode:
+            TRACER.end()
+        base = base or ns
+        print(f"{name:>16}: {ns / 1e3:>9.2f} мкс на поток  {(ns / base - 1) * 100:>+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="цена хуков трассировки")
+    parser.add_argument("--streams", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, "w")
+    setup_logging("sync", stream=devnull)
+    open_tracer(Metrics())
+
+    raw = harness.synthetic_streams(args.streams, args.events, 0.0, 0.0, args.seed)
+    streams = [decode_stream(json.dumps(s).encode()) for s in raw]
+    bench_hooks(streams[0], json.dumps(raw[0]).encode())
+    bench_streams(streams, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
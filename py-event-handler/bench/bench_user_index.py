@@ -0,0 +1,51 @@
+import os
+import sys
+import timeit
+from dataclasses import dataclass
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from user_index import UserIndex
+
+# Сравнение старого линейного поиска по USERS.items() с индексом name -> uid.
+# Ищем последнего пользователя (худший случай для скана) и отсутствующего.
+
+SIZES = [10, 100, 1_000, 10_000, 100_000]
+
+
+@dataclass
+class User:
+    name: str
+    passwd: str
+
+
+def scan(users, name):
+    cuid = -1
+    for uid, user in users.items():
+        if name == user.name:
+            cuid = uid
+            break
+    return cuid
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    print(f"{'users':>8} {'scan, нс':>14} {'index, нс':>12} {'miss scan, нс':>15} {'miss index, нс':>15}")
+    for size in SIZES:
+        users = {uid: User(name=f"user{uid}", passwd="x") for uid in range(size)}
+        index = UserIndex(users)
+        last = f"user{size - 1}"
+        number = max(10, 200_000 // size)
+
+        scan_ns = measure(lambda: scan(users, last), number)
+        index_ns = measure(lambda: index.lookup(last), 200_000)
+        miss_scan_ns = measure(lambda: scan(users, "nobody"), number)
+        miss_index_ns = measure(lambda: index.lookup("nobody"), 200_000)
+
+        print(f"{size:>8} {scan_ns:>14.1f} {index_ns:>12.1f} {miss_scan_ns:>15.1f} {miss_index_ns:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import harness
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from parse import iter_streams
+from wal import EventLog, read_log
+
+# Цена журнала событий (pkg/wal.py):
+#   1. append() на горячем пути - нс на запись;
+#   2. писатель - запись и fsync пачками, МБ/с и записей/с при fsync и без;
+#   3. обработчики харнесса без журнала и с WAL_DIR на одной нагрузке.
+#
+#   python bench/bench_wal.py --engines threading,asyncio --repeat 20 --batch 100
+
+DATA = harness.DATA
+RECORDS = 200_000
+
+
+def bench_append(streams) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        log = EventLog(tmp, 0)
+        start = time.perf_counter_ns()
+        for i in range(RECORDS):
+            log.append_stream(streams[i % len(streams)])
+        return (time.perf_counter_ns() - start) / RECORDS
+
+
+def bench_writer(streams, fsync: bool):
+    with tempfile.TemporaryDirectory() as tmp:
+        log = EventLog(tmp, 0, fsync_interval=0.01, fsync=fsync)
+        log.start()
+        start = time.perf_counter()
+        for i in range(RECORDS):
+            log.append_stream(streams[i % len(streams)])
+            # темп, при котором писатель успевает за очередью и работает окнами
+            if i % 1000 == 999:
+                time.sleep(0.001)
+        log.close()
+        elapsed = time.perf_counter() - start
+        assert sum(1 for _ in read_log(tmp)) == RECORDS
+        return RECORDS / elapsed, log.bytes_written / elapsed / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description="цена журнала событий")
+    parser.add_argument("--engines", default="threading,asyncio")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--fsync-interval", default="0.05", help="WAL_FSYNC_INTERVAL")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    streams = list(iter_streams(DATA))
+    print(f"append()                  {bench_append(streams):>8.0f} нс/запись")
+    for fsync in (True, False):
+        per_s, mb_s = bench_writer(streams, fsync)
+        print(f"писатель, fsync={'да ' if fsync else 'нет'}      {per_s:>8,.0f} записей/с, {mb_s:.1f} МБ/с")
+
+    load = harness.file_streams(DATA, args.repeat)
+    for name in args.engines.split(","):
+        for wal in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                env = [f"WAL_DIR={tmp}", f"WAL_FSYNC_INTERVAL={args.fsync_interval}"] if wal else []
+                run_args = SimpleNamespace(concurrency=args.concurrency, batch=args.batch, warmup=50,
+                                           log_mode="off", env=env)
+                try:
+                    result = harness.run_engine(name, load, run_args)
+                except RuntimeError as e:
+                    print(f"{name}: пропущен ({e})")
+                    break
+            lat = result["latency_ms"]
+            print(f"{name:>10} {'WAL' if wal else '   '}: {result['streams_per_s']:>10,.0f} потоков/с  "
+                  f"p50 {lat['p50']:.2f} p99 {lat['p99']:.2f} мс  CPU {result['cpu_percent']:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from parse import iter_streams
+
+# Воспроизводимое сравнение обработчиков. Для каждой реализации харнесс
+# запускает сервер, ждёт открытия порта, прогоняет одну и ту же нагрузку с
+# заданной параллельностью и снимает пропускную способность, задержки
+# запросов (p50/p95/p99), CPU и пиковый RSS всего дерева процессов сервера.
+# Результаты пишутся в JSON (--out). Python-обработчики работают в режиме
+# сервиса (MAX_STREAMS=0) и останавливаются SIGTERM.
+#
+#   python bench/harness.py --engines threading,process,asyncio \
+#       --file ../go-data-handler/data/streams50.txt --repeat 20
+#   python bench/harness.py --streams 5000 --events 8 --skew 1.2 --fail-ratio 0.2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+REPO = os.path.join(ROOT, "..")
+DATA = os.path.join(REPO, "go-data-handler", "data", "streams50.txt")
+PORT = 8081
+UNLIMITED = 10 ** 9
+
+ENGINES = {
+    "threading": ([sys.executable, os.path.join(ROOT, "threading-event-handler", "__threading__.py")], ROOT),
+    "process": ([sys.executable, os.path.join(ROOT, "multiprocessing-event-handler", "__multiprocessing__.py")], ROOT),
+    "asyncio": ([sys.executable, os.path.join(ROOT, "asyncio-event-handler", "__asyncio__.py")], ROOT),
+    "sharded": ([sys.executable, os.path.join(ROOT, "sharded-event-handler", "__sharded__.py")], ROOT),
+    "go": (["go", "run", ".", "-max", str(UNLIMITED)], os.path.join(REPO, "go-event-handler")),
+}
+
+# пользователи, которых знают все обработчики
+USERS = [
+    ("superadmin", "P@ssw0rd!"), ("auditor", "Secur3!2023"), ("dev_user", "d3v3l0p3r"),
+    ("tester", "t3st3r!123"), ("analyst", "Data2023!"), ("support", "HelpDesk!"),
+    ("reports", "R3port$"), ("backup", "B@ckUp123"), ("api_user", "Ap1K3y!2023"),
+    ("guest", "T3mpPass!"),
+]
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+# --------- нагрузка ---------
+def file_streams(path: str, repeat: int):
+    streams = [
+        {"streamId": s.stream_id,
+         "events": [{"type": e.type, "name": e.name, "passwd": e.passwd} for e in s.events]}
+        for s in iter_streams(path)
+    ]
+    return [dict(s, streamId=f"{s['streamId']}-{i}") for i in range(repeat) for s in streams]
+
+
+def synthetic_streams(n: int, m: int, skew: float, fail_ratio: float, seed: int):
+    """N потоков по M событий: ssh, затем смесь sudo/dir/ssh.
+
+    Пользователи выбираются по закону Ципфа с показателем skew (0 - равномерно),
+    доля неверных паролей в ssh и sudo - fail_ratio.
+    """
+    rnd = random.Random(seed)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(USERS))]
+
+    def attempt(user):
+        name, passwd = user
+        return passwd if rnd.random() >= fail_ratio else passwd + "-wrong"
+
+    streams = []
+    for i in range(n):
+        user = rnd.choices(USERS, weights)[0]
+        events = [{"type": "ssh", "name": user[0], "passwd": attempt(user)}]
+        while len(events) < m:
+            kind = rnd.random()
+            if kind < 0.4:
+                events.append({"type": "sudo", "name": "", "passwd": attempt(user)})
+            elif kind < 0.8:
+                events.append({"type": "dir", "name": "", "passwd": ""})
+            else:
+                user = rnd.choices(USERS, weights)[0]
+                events.append({"type": "ssh", "name": user[0], "passwd": attempt(user)})
+        streams.append({"streamId": f"syn-{i}", "events": events})
+    return streams
+
+
+# --------- процессы сервера ---------
+def process_tree(root: int):
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # имя процесса в скобках может содержать пробелы
+        fields = stat[stat.rindex(")") + 2:].split()
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(parents.get(pid, []))
+    return tree
+
+
+def cpu_seconds(pids) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        fields = stat[stat.rindex(")") + 2:].split()
+        total += int(fields[11]) + int(fields[12])
+    return total / CLK_TCK
+
+
+def rss_bytes(pids) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class Sampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.cpu = {}
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def sample(self):
+        tree = process_tree(self.pid)
+        self.peak_rss = max(self.peak_rss, rss_bytes(tree))
+        # CPU копится по процессам: завершившиеся дети не теряют своё время
+        for pid in tree:
+            self.cpu[pid] = cpu_seconds([pid])
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+    def total_cpu(self) -> float:
+        return sum(self.cpu.values())
+
+
+def wait_port(proc, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not open :{PORT} in {timeout}s")
+
+
+def start_engine(name: str, log_mode: str, extra_env):
+    cmd, cwd = ENGINES[name]
+    env = dict(os.environ, MAX_STREAMS="0", REPORT_INTERVAL="0", LOG_MODE=log_mode, **extra_env)
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        wait_port(proc, 120 if name == "go" else 30)
+    except Exception:
+        stop_engine(proc)
+        raise
+    return proc
+
+
+def stop_engine(proc) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+    except ProcessLookupError:
+        proc.wait()
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+# --------- прогон ---------
+def replay(streams, concurrency: int, batch: int):
+    if batch:
+        requests = [("/batch", streams[i:i + batch]) for i in range(0, len(streams), batch)]
+    else:
+        requests = [("/", s) for s in streams]
+    bodies = [(path, json.dumps(body).encode()) for path, body in requests]
+    local = threading.local()
+    latencies = [0.0] * len(bodies)
+    statuses = {}
+    status_lock = threading.Lock()
+
+    def send(i):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=30)
+        path, body = bodies[i]
+        start = time.perf_counter()
+        try:
+            conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            local.conn = None
+            status = "error"
+        latencies[i] = time.perf_counter() - start
+        with status_lock:
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(send, range(len(bodies))))
+    return time.perf_counter() - start, latencies, statuses
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def run_engine(name: str, streams, args):
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    proc = start_engine(name, args.log_mode, extra_env)
+    try:
+        if args.warmup:
+            warm = [dict(s, streamId=f"warmup-{s['streamId']}") for s in streams[:args.warmup]]
+            replay(warm, args.concurrency, args.batch)
+        sampler = Sampler(proc.pid)
+        sampler.sample()
+        cpu_before = sampler.total_cpu()
+        sampler.start()
+        elapsed, latencies, statuses = replay(streams, args.concurrency, args.batch)
+        sampler.stop()
+        cpu = sampler.total_cpu() - cpu_before
+    finally:
+        stop_engine(proc)
+
+    lat = sorted(latencies)
+    events = sum(len(s["events"]) for s in streams)
+    return {
+        "engine": name,
+        "streams": len(streams),
+        "events": events,
+        "requests": len(latencies),
+        "elapsed_s": round(elapsed, 6),
+        "streams_per_s": round(len(streams) / elapsed, 1),
+        "events_per_s": round(events / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(lat, 0.50) * 1e3, 3),
+            "p95": round(percentile(lat, 0.95) * 1e3, 3),
+            "p99": round(percentile(lat, 0.99) * 1e3, 3),
+            "max": round(lat[-1] * 1e3, 3) if lat else 0.0,
+        },
+        "cpu_s": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / elapsed, 1),
+        "rss_peak_mb": round(sampler.peak_rss / 2 ** 20, 1),
+        "statuses": {str(k): v for k, v in statuses.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение обработчиков событий")
+    parser.add_argument("--engines", default="threading,process,asyncio",
+                        help="через запятую: " + ",".join(ENGINES))
+    parser.add_argument("--file", help="файл потоков (по умолчанию синтетика, если задан --streams)")
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз повторить файл")
+    parser.add_argument("--streams", type=int, default=0, help="синтетика: число потоков")
+    parser.add_argument("--events", type=int, default=8, help="синтетика: событий в потоке")
+    parser.add_argument("--skew", type=float, default=0.0, help="синтетика: показатель Ципфа для горячих пользователей")
+    parser.add_argument("--fail-ratio", type=float, default=0.1, help="синтетика: доля неверных паролей")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=0, help="потоков на запрос к /batch (0 - по одному в /)")
+    parser.add_argument("--warmup", type=int, default=50, help="потоков на прогрев перед замером")
+    parser.add_argument("--log-mode", default="off", help="LOG_MODE для python-обработчиков")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для окружения сервера")
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    if args.streams:
+        workload = {"kind": "synthetic", "streams": args.streams, "events": args.events,
+                    "skew": args.skew, "fail_ratio": args.fail_ratio, "seed": args.seed}
+        streams = synthetic_streams(args.streams, args.events, args.skew, args.fail_ratio, args.seed)
+    else:
+        path = args.file or DATA
+        workload = {"kind": "file", "file": os.path.abspath(path), "repeat": args.repeat}
+        streams = file_streams(path, args.repeat)
+
+    results = []
+    for name in args.engines.split(","):
+        if name not in ENGINES:
+            parser.error(f"unknown engine {name}")
+        if name == "go" and (shutil.which("go") is None or args.batch):
+            print(f"{name}: пропущен (нет go или нет /batch)")
+            continue
+        try:
+            result = run_engine(name, streams, args)
+        except RuntimeError as e:
+            print(f"{name}: пропущен ({e})")
+            continue
+        results.append(result)
+        lat = result["latency_ms"]
+        print(f"{name:>10}: {result['streams_per_s']:>10,.0f} потоков/с  "
+              f"p50 {lat['p50']:.2f} p95 {lat['p95']:.2f} p99 {lat['p99']:.2f} мс  "
+              f"CPU {result['cpu_percent']:.0f}%  RSS {result['rss_peak_mb']:.0f} МБ  {result['statuses']}")
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "workload": workload,
+            "concurrency": args.concurrency,
+            "batch": args.batch,
+            "log_mode": args.log_mode,
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"результаты: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
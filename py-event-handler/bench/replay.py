@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import harness
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from directory import open_directory
+from events import lookup
+from session import CurrentUser, LockStripes
+from wal import KIND_CLOSE, KIND_EVENT, KIND_STREAM, read_log, replay, segments
+
+# Повтор журнала обработчика (WAL_DIR, см. pkg/wal.py).
+#
+#   --state     восстановить состояние пользователей в этом процессе, как при
+#               запуске сервера, и вывести его (снимок + хвост журнала или
+#               --from-start - весь журнал без снимка);
+#   --export    выгрузить журнал в формат файла потоков (для --file любого
+#               обработчика);
+#   --engines   прогнать журнал через обработчики харнесса на предельной
+#               скорости и снять те же показатели, что bench/harness.py.
+#
+# В --export и --engines события открытых потоков собираются в один поток
+# на stream_id (он отдаётся при закрытии или в конце журнала), так что их
+# порядок относительно целых потоков не сохраняется.
+#
+#   python bench/replay.py /var/lib/event-handler/wal --state
+#   python bench/replay.py /var/lib/event-handler/wal --engines threading,asyncio --batch 100
+
+
+def to_streams(records):
+    """Записи журнала -> потоки в виде словарей харнесса."""
+    streams = []
+    sessions = {}
+    for record in records:
+        if record.kind == KIND_STREAM:
+            streams.append({"streamId": record.stream_id, "events": record.events})
+        elif record.kind == KIND_EVENT:
+            sessions.setdefault(record.stream_id, []).extend(record.events)
+        elif record.kind == KIND_CLOSE and record.stream_id in sessions:
+            streams.append({"streamId": record.stream_id, "events": sessions.pop(record.stream_id)})
+    streams += [{"streamId": stream_id, "events": events} for stream_id, events in sessions.items()]
+    for s in streams:
+        s["events"] = [{"type": e.type, "name": e.name, "passwd": e.passwd} for e in s["events"]]
+    return streams
+
+
+def export(streams, path: str) -> None:
+    with open(path, "w") as f:
+        for s in streams:
+            f.write(f"#{s['streamId']}\n")
+            for e in s["events"]:
+                # поля - в порядке, в каком их разбирает parse типа
+                etype = lookup(e["type"])
+                fields = etype.fields if etype is not None else ()
+                f.write(",".join([e["type"]] + [e[field] for field in fields]) + "\n")
+            f.write("\n")
+
+
+def rebuild_state(directory: str, from_start: bool):
+    users = open_directory()
+    stripes = LockStripes()
+    segs = segments(directory)
+    if from_start and segs and segs[0][0] > 0:
+        sys.exit(f"журнал начинается с записи {segs[0][0]}: начало удалено после снимка")
+    start = time.perf_counter()
+    result = replay(directory, users, lambda: CurrentUser(users, stripes), use_snapshot=not from_start)
+    return users, result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Повтор журнала обработчика")
+    parser.add_argument("wal_dir")
+    parser.add_argument("--state", action="store_true", help="восстановить и вывести состояние пользователей")
+    parser.add_argument("--from-start", action="store_true", help="--state: без снимка, весь журнал")
+    parser.add_argument("--export", help="записать потоки журнала в файл потоков")
+    parser.add_argument("--engines", help="через запятую: " + ",".join(harness.ENGINES))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=0, help="потоков на запрос к /batch (0 - по одному в /)")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--log-mode", default="off")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для окружения сервера")
+    parser.add_argument("--out", default="bench_replay.json")
+    args = parser.parse_args()
+    if not (args.state or args.export or args.engines):
+        parser.error("нужно --state, --export или --engines")
+
+    if args.state:
+        users, result, elapsed = rebuild_state(args.wal_dir, args.from_start)
+        snap = "нет" if result.snapshot_seq is None else f"запись {result.snapshot_seq}"
+        print(f"снимок: {snap}, повторено {result.replayed} записей за {elapsed:.2f} с "
+              f"({result.replayed / elapsed if elapsed else 0:,.0f} записей/с)")
+        print(f"открытых потоков в конце журнала: {len(result.sessions)}")
+        for name, authd, retries in sorted(users.dirty()):
+            print(f"  {name:<16} authd={authd or '-':<20} retries={retries}")
+
+    if not (args.export or args.engines):
+        return
+    streams = to_streams(read_log(args.wal_dir))
+    print(f"{len(streams)} потоков, {sum(len(s['events']) for s in streams)} событий")
+    if args.export:
+        export(streams, args.export)
+        print(f"потоки: {args.export}")
+    if not args.engines:
+        return
+
+    results = []
+    for name in args.engines.split(","):
+        if name not in harness.ENGINES:
+            parser.error(f"unknown engine {name}")
+        try:
+            result = harness.run_engine(name, streams, args)
+        except RuntimeError as e:
+            print(f"{name}: пропущен ({e})")
+            continue
+        results.append(result)
+        lat = result["latency_ms"]
+        print(f"{name:>10}: {result['streams_per_s']:>10,.0f} потоков/с  "
+              f"p50 {lat['p50']:.2f} p99 {lat['p99']:.2f} мс  CPU {result['cpu_percent']:.0f}%  {result['statuses']}")
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "workload": {"kind": "wal", "dir": os.path.abspath(args.wal_dir)},
+            "concurrency": args.concurrency,
+            "batch": args.batch,
+            "python": sys.version.split()[0],
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"результаты: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import os
+
+# Единая точка входа обработчиков (из каталога py-event-handler):
+#   python -m event_handler --engine threading|process|asyncio|sharded [--file ...]
+#
+# Сервер каждого движка остаётся своим скриптом (каталоги с дефисом не
+# импортируются как пакеты), модели, разбор и остальное общее - в pkg/.
+# Пакет только выбирает скрипт и выполняет его как __main__; сам он ничего
+# тяжёлого не импортирует, а Flask, FastAPI и uvicorn скрипты движков грузят
+# лишь для HTTP-сервера (create_app), не в режиме --file и не в воркерах.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ENGINES = {
+    "threading": os.path.join(ROOT, "threading-event-handler", "__threading__.py"),
+    "process": os.path.join(ROOT, "multiprocessing-event-handler", "__multiprocessing__.py"),
+    "asyncio": os.path.join(ROOT, "asyncio-event-handler", "__asyncio__.py"),
+    "sharded": os.path.join(ROOT, "sharded-event-handler", "__sharded__.py"),
+}
+# имя по каталогу скрипта
+ALIASES = {"multiprocessing": "process"}
+
+
+def script(engine: str) -> str:
+    """Путь к скрипту движка по имени или псевдониму."""
+    name = ALIASES.get(engine, engine)
+    if name not in ENGINES:
+        raise ValueError(f"unknown engine {engine}")
+    return ENGINES[name]
@@ -0,0 +1,27 @@
+import argparse
+import os
+import runpy
+import sys
+
+from event_handler import ALIASES, ENGINES, script
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m event_handler",
+        description="обработчик событий на выбранном движке",
+        epilog="остальные аргументы (например, --file) передаются скрипту движка",
+    )
+    parser.add_argument("--engine", default=os.environ.get("ENGINE", "threading"),
+                        choices=sorted(ENGINES) + sorted(ALIASES))
+    args, rest = parser.parse_known_args()
+
+    path = script(args.engine)
+    # скрипт разбирает свои аргументы сам и видит себя как при прямом запуске;
+    # воркеры движков - fork, поэтому функции из его __main__ им доступны
+    sys.argv = [path] + rest
+    runpy.run_path(path, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,141 +1,175 @@
+import argparse
 import logging
+import os
+import signal
+import sys
 import threading
-from multiprocessing import Process, Lock, Event, Value, Manager
 import time
-from typing import List, Dict
-from dataclasses import dataclass, field
-from flask import Flask, request, jsonify
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from models import Stream
+from directory import open_directory
+from pool import ProcessWorkerPool
+from shm_users import SharedUserTable, SharedCurrentUser
+from parse import iter_streams
+from logs import setup_logging
+from session_table import SessionTable
+from detector import open_detector
+from tracing import TRACER, open_tracer
+from wal import WAL_DIR, SNAPSHOT_INTERVAL, capture, open_log, processed
+from wire import TCP_PORT, SelectorServer
+from stream_server import StreamServer
+from metrics import Metrics, SharedMetrics, WindowReporter, merge, summary
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger()
 
-class EventObj:
-    def __init__(self, type_: str, name: str = "", passwd: str = ""):
-        self.type = type_
-        self.name = name
-        self.passwd = passwd
-
-class Stream:
-    def __init__(self, stream_id: str, events: List[EventObj]):
-        self.stream_id = stream_id
-        self.events = events if events else []
-
-@dataclass
-class User:
-    name: str
-    passwd: str
-    authd: str = ""
-    auth_retries: int = 0
-
-manager = Manager()
-USERS: Dict[int, User] = manager.dict({
-    0: User(name="superadmin", passwd="P@ssw0rd!"),
-    1: User(name="auditor", passwd="Secur3!2023"),
-    2: User(name="dev_user", passwd="d3v3l0p3r"),
-    3: User(name="tester", passwd="t3st3r!123"),
-    4: User(name="analyst", passwd="Data2023!"),
-    5: User(name="support", passwd="HelpDesk!"),
-    6: User(name="reports", passwd="R3port$"),
-    7: User(name="backup", passwd="B@ckUp123"),
-    8: User(name="api_user", passwd="Ap1K3y!2023"),
-    9: User(name="guest", passwd="T3mpPass!")
-})
-
-def handle_stream(stream: Stream, total_time: Value, lock: Lock):
-    cu_cuid = -1
+def handle_stream(stream: Stream, users: SharedUserTable, worker_metrics: SharedMetrics):
+    cu = SharedCurrentUser(users)
+    stream_id = stream.stream_id
+    handlers = TRACER.handlers(SharedCurrentUser, stream)
+    counts = [0] * len(handlers)
     start_ns = time.perf_counter_ns()
 
     for event in stream.events:
-        if event.type == "ssh":
-            for uid, user in USERS.items():
-                if event.name == user.name:
-                    cu_cuid = uid
-                    break
-            if cu_cuid != -1:
-                user = USERS[cu_cuid]
-                if event.passwd == user.passwd:
-                    user.authd = stream.stream_id
-                    logger.info(f"User {user.name} authd ({stream.stream_id})")
-                else:
-                    logger.error(f"Wrong password for user {user.name} ({stream.stream_id})")
-        elif event.type == "sudo":
-            if cu_cuid != -1:
-                user = USERS[cu_cuid]
-                if event.passwd == user.passwd:
-                    logger.info(f"Accepted sudo on user {user.name} ({stream.stream_id})")
-                else:
-                    logger.error(f"Bad password for sudo on user {user.name} ({stream.stream_id})")
-        elif event.type == "dir":
-            if cu_cuid != -1:
-                user = USERS[cu_cuid]
-                logger.info(f"Accepted dir on user {user.name} ({stream.stream_id})")
+        code = event.code
+        counts[code] += 1
+        handlers[code](cu, stream_id, event)
 
     elapsed_ns = time.perf_counter_ns() - start_ns
-    with lock:
-        total_time.value += elapsed_ns
-
-    logger.info(f"Завершение потока {stream.stream_id} за {elapsed_ns/1e3:.3f} мс")
-
-app = Flask(__name__)
-MAX_STREAMS = 50
-manager_lock = Lock()
-total_time = Value('L', 0)
-total_streams = Value('i', 0)
-done_event = Event()
-processes: List[Process] = []
-
-@app.route("/", methods=["POST"])
-def receive_stream():
-    data = request.get_json()
-    if not data or "streamId" not in data or "events" not in data:
-        return jsonify({"error": "Invalid JSON"}), 400
-
-    stream_id = data["streamId"]
-    events = [EventObj(ev.get("type", ""), ev.get("name", ""), ev.get("passwd", "")) for ev in data["events"]]
-    stream = Stream(stream_id, events)
-
-    with manager_lock:
-        if total_streams.value >= MAX_STREAMS:
-            return jsonify({"error": "Maximum streams limit reached"}), 429
-        total_streams.value += 1
-        current_count = total_streams.value
-
-    p = Process(target=handle_stream, args=(stream, total_time, manager_lock))
-    p.start()
-    processes.append(p)
-
-    if current_count == MAX_STREAMS:
-        done_event.set()
-
-    return jsonify({
-        "status": "processing_started",
-        "stream_id": stream.stream_id,
-        "count": f"{current_count}/{MAX_STREAMS}",
-    })
+    # строка метрик своя у каждого воркера, общий счётчик под блокировкой не нужен
+    worker_metrics.shard().stream_done(elapsed_ns, counts, cu)
+
+    logger.info("Завершение потока %s за %.3f мкс", stream.stream_id, elapsed_ns/1e3)
+
+# MAX_STREAMS=0 - режим сервиса: без лимита потоков, работа до SIGTERM
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 50))
+TIMEOUT = 30 * 60
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 30))
+REPORT_INTERVAL = float(os.environ.get("REPORT_INTERVAL", 60))
+WORKERS = int(os.environ.get("WORKERS", os.cpu_count() or 4))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 1024))
+# строки общих метрик: по одной на воркер и одна на процесс сервера - в ней
+# события открытых потоков (общий детектор) и этапы трассировки его потоков
+METRIC_ROWS = WORKERS + 1
+# приём идёт в потоках сервера в главном процессе, воркерам событие не нужно
+done_event = threading.Event()
+# приём запросов считается в процессе сервера, обработка - в воркерах
+METRICS = Metrics()
+# открытые потоки: CurrentUser живёт в процессе сервера между запросами и
+# работает с той же общей таблицей пользователей, что и воркеры
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 300))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10000))
 
 def main():
     from werkzeug.serving import make_server
 
-    server = make_server("0.0.0.0", 8081, app)
+    log_listener = setup_logging(multiprocess=True)
+    # пользователи - из каталога USERS_FILE (CSV, JSON или SQLite); их состояние
+    # живёт в общей памяти, воркеры подключаются к ней
+    directory = open_directory()
+    users = SharedUserTable.create(directory, capacity=directory.max_uid() + 1)
+    worker_metrics = SharedMetrics(METRIC_ROWS)
+    pool = ProcessWorkerPool(handle_stream, WORKERS, QUEUE_SIZE, args=(users, worker_metrics))
+    # приём потоков, журнал и HTTP-приложение - общие с threading (stream_server.py)
+    stream_server = StreamServer(pool, METRICS, lambda: merge(METRICS.snapshot(), worker_metrics.snapshot()),
+                                 done_event, MAX_STREAMS, QUEUE_SIZE)
+    sessions = SessionTable(lambda: SharedCurrentUser(users), SESSION_IDLE_TIMEOUT, MAX_SESSIONS,
+                            on_close=stream_server.close_session)
+    stream_server.sessions = sessions
+    # потоки считают воркеры, события открытых потоков - процесс сервера
+    wal_processed = lambda: processed(stream_server.snapshot())
+    wal_state = lambda: capture(users, sessions)
+    if WAL_DIR:
+        # до старта воркеров: состояние из снимка и хвоста журнала
+        stream_server.wal = open_log(WAL_DIR, users, lambda: SharedCurrentUser(users))
+        if SNAPSHOT_INTERVAL:
+            stream_server.wal.start_snapshots(SNAPSHOT_INTERVAL, wal_processed, wal_state)
+    # после восстановления и до fork воркеров: детектор у всех процессов общий
+    open_detector(worker_metrics, shared=True)
+    open_tracer(worker_metrics, shared=True, snapshot=stream_server.snapshot)
+    pool.start()
+    # запросы в своих потоках: долгий chunked-запрос не держит остальные
+    server = make_server("0.0.0.0", 8081, stream_server.create_app(), threaded=True)
     thread = threading.Thread(target=server.serve_forever)
     thread.start()
-    logger.info("Server starting on :8081")
-
-    if not done_event.wait(timeout=30*60):
+    tcp_server = None
+    if TCP_PORT:
+        tcp_server = SelectorServer(TCP_PORT, stream_server.accept_frames)
+        tcp_thread = threading.Thread(target=tcp_server.serve_forever, name="tcp")
+        tcp_thread.start()
+        logger.info("Двоичный приём потоков на :%s", TCP_PORT)
+    sweeper = threading.Thread(target=sessions.sweep_forever, args=(done_event, SESSION_IDLE_TIMEOUT / 4),
+                               daemon=True)
+    sweeper.start()
+    logger.info("Server starting on :8081 (%s workers, queue %s)", WORKERS, QUEUE_SIZE)
+
+    stop_signal = []
+    def on_signal(signum, frame):
+        stop_signal.append(signum)
+        done_event.set()
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    # SIGUSR1 - открыть или закрыть окно трассировки с профилем у всех процессов
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=TRACER.toggle, daemon=True).start())
+    # перечитать каталог на ходу нельзя: общая таблица пользователей
+    # раскладывается один раз при старте (shm_users.py), SIGHUP не роняет сервер
+    signal.signal(signal.SIGHUP, lambda signum, frame: logger.warning(
+        "SIGHUP: перечитывание каталога пользователей не поддерживается, нужен перезапуск"))
+
+    # ждём лимита (с таймаутом) или, в режиме сервиса, сигнала
+    reporter = WindowReporter(stream_server.snapshot, REPORT_INTERVAL)
+    if not reporter.wait(done_event, timeout=TIMEOUT if MAX_STREAMS else None):
         logger.info("Таймаут, завершаем работу...")
+    elif stop_signal:
+        logger.info("Получен сигнал %s, завершаем работу...", signal.Signals(stop_signal[0]).name)
     else:
         logger.info("Достигнут лимит потоков, завершаем работу...")
 
+    # перестаём принимать соединения и дорабатываем очередь, но не дольше DRAIN_TIMEOUT
+    done_event.set()
     server.shutdown()
     thread.join()
-
-    for p in processes:
-        p.join()
-
-    logger.info(
-        f"Полное чистое время обработки: {total_time.value/1e3:.3f} мс, "
-        f"среднее на поток: {(total_time.value/total_streams.value)/1e3:.3f} мс"
-    )
+    if tcp_server is not None:
+        tcp_server.shutdown()
+        tcp_thread.join()
+
+    left = pool.shutdown(DRAIN_TIMEOUT)
+    if left:
+        logger.warning("За %.0f с не доработали %s воркеров, остаток очереди брошен", DRAIN_TIMEOUT, left)
+    if stream_server.wal is not None:
+        stream_server.wal.shutdown(wal_processed, wal_state)
+    users.close()
+    users.unlink()
+
+    logger.info(summary(worker_metrics.snapshot()))
+    if log_listener:
+        log_listener.stop()
+
+def process_file(file_path: str):
+    log_listener = setup_logging(multiprocess=True)
+    directory = open_directory()
+    users = SharedUserTable.create(directory, capacity=directory.max_uid() + 1)
+    worker_metrics = SharedMetrics(METRIC_ROWS)
+    open_detector(worker_metrics, shared=True)
+    pool = ProcessWorkerPool(handle_stream, WORKERS, QUEUE_SIZE, args=(users, worker_metrics))
+    pool.start()
+    # потоки уходят воркерам по мере разбора файла, а не после чтения целиком
+    for stream in iter_streams(file_path):
+        pool.submit(stream, block=True)
+    pool.shutdown()
+    users.close()
+    users.unlink()
+
+    logger.info(summary(worker_metrics.snapshot()))
+    if log_listener:
+        log_listener.stop()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", help="Путь к файлу с данными (вместо HTTP-сервера)")
+    args = parser.parse_args()
+    if args.file:
+        process_file(args.file)
+    else:
+        main()
@@ -0,0 +1,297 @@
+import logging
+from array import array
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+
+import events
+from credentials import VERIFIER
+from parse import iter_events
+
+# Офлайн-анализ файлов потоков (streams*.txt) по столбцам NumPy.
+#
+# События файла раскладываются в массивы: номер потока, код типа, коды
+# имени и пароля (строки хранятся один раз в таблицах). Дальше всё, что не
+# зависит от порядка потоков, считается над столбцами целиком:
+#   - uid имени ищется один раз на каждое имя, а не на событие;
+#   - пользователь, к которому относится событие, - последний ssh с
+#     известным именем в том же потоке (протяжка вперёд через
+#     np.maximum.accumulate с обнулением на границах потоков): текущий
+#     пользователь CurrentUser бывает только им или -1;
+#   - пароль проверяется (PBKDF2) один раз на уникальную пару
+#     (пользователь, пароль), а не на событие, и только если эталон тоже
+#     дошёл бы до проверки;
+#   - исходы sudo и dir и все итоги - маски и np.bincount.
+# Последовательным остаётся только автомат входа: authd и retries общие для
+# всех потоков, и исход ssh зависит от всех предыдущих в файле. Он идёт
+# одним циклом по ssh-событиям над уже готовыми столбцами.
+#
+# Порядок обработки - порядок файла, как у обработчиков с --file без
+# параллелизма (asyncio); потоки в файле не выходят из пользователя.
+# Разбираются только встроенные типы: события типов из EVENT_PLUGINS
+# (events.py) в столбцы не попадают.
+
+SSH, SUDO, DIR = events.SSH.code, events.SUDO.code, events.DIR.code
+TYPE_CODES = {t.name: t.code for t in (events.SSH, events.SUDO, events.DIR)}
+
+# исходы событий
+OUTCOMES = ("skipped", "not_found", "already", "conflict", "blocked", "wrong", "authd", "accepted", "rejected")
+SKIPPED, NOT_FOUND, ALREADY, CONFLICT, BLOCKED, WRONG, AUTHD, ACCEPTED, REJECTED = range(len(OUTCOMES))
+
+# те же сообщения, что пишет CurrentUser
+MESSAGES = {
+    (SSH, NOT_FOUND): (logging.ERROR, "Couldn't find a user with a name %s (%s)"),
+    (SSH, ALREADY): (logging.INFO, "You are already logged in (%s)"),
+    (SSH, CONFLICT): (logging.ERROR, "User %s already authd from %s (%s)"),
+    (SSH, BLOCKED): (logging.ERROR, "Can't access user %s, user is blocked (%s)"),
+    (SSH, WRONG): (logging.ERROR, "Wrong password for user %s (%s)"),
+    (SSH, AUTHD): (logging.INFO, "User %s authd (%s)"),
+    (SUDO, ACCEPTED): (logging.INFO, "Accepted sudo on user %s (%s)"),
+    (SUDO, REJECTED): (logging.ERROR, "Bad password for sudo on user %s (%s)"),
+    (DIR, ACCEPTED): (logging.INFO, "Accepted dir on user %s (%s)"),
+}
+
+
+class Columns(NamedTuple):
+    """События файла по столбцам; i-е событие - stream[i], type[i], name[i], passwd[i].
+
+    stream - номер потока в порядке файла, sid[stream] - код его stream_id
+    (одинаковые stream_id в файле - одна сессия, как у обработчиков).
+    """
+    stream_ids: List[str]
+    names: List[str]
+    passwds: List[str]
+    sid: np.ndarray
+    stream: np.ndarray
+    type: np.ndarray
+    name: np.ndarray
+    passwd: np.ndarray
+
+
+def load(file_path: str) -> Columns:
+    stream_ids: Dict[str, int] = {}
+    names: Dict[str, int] = {}
+    passwds: Dict[str, int] = {}
+    sid = array("i")
+    stream, types, name, passwd = array("i"), array("b"), array("i"), array("i")
+    for stream_id, event in iter_events(file_path):
+        if event is None:
+            sid.append(stream_ids.setdefault(stream_id, len(stream_ids)))
+            continue
+        if event.code > DIR:
+            continue
+        stream.append(len(sid) - 1)
+        types.append(event.code)
+        name.append(names.setdefault(event.name, len(names)))
+        passwd.append(passwds.setdefault(event.passwd, len(passwds)))
+    return Columns(list(stream_ids), list(names), list(passwds),
+                   np.frombuffer(sid, np.intc), np.frombuffer(stream, np.intc),
+                   np.frombuffer(types, np.int8), np.frombuffer(name, np.intc), np.frombuffer(passwd, np.intc))
+
+
+class Analysis(NamedTuple):
+    columns: Columns
+    user: np.ndarray      # uid события: цель ssh, текущий пользователь sudo/dir; -1 - нет
+    outcome: np.ndarray
+    holder: np.ndarray    # CONFLICT: код stream_id, который держит пользователя
+    lockout: np.ndarray   # WRONG, после которой пользователь заблокирован
+    authd: Dict[int, int]     # uid -> код stream_id в конце файла
+    retries: Dict[int, int]   # uid -> число неудачных попыток в конце файла
+    verified: int             # сколько паролей проверено
+
+
+def _fill_forward(mark: np.ndarray, start: np.ndarray) -> np.ndarray:
+    """Для каждого события - номер последнего отмеченного в том же потоке.
+
+    Если в потоке до события отмеченных нет, это начало потока: вызывающий
+    проверяет mark по полученному номеру.
+    """
+    idx = np.arange(len(mark))
+    return np.maximum.accumulate(np.where(mark | start, idx, 0))
+
+
+def analyze(columns: Columns, users) -> Analysis:
+    """Исходы всех событий файла, как при последовательной обработке CurrentUser.
+
+    users - каталог (directory.Directory) или UserIndex: lookup() и [uid].
+    """
+    n = len(columns.type)
+    is_ssh = columns.type == SSH
+    start = np.ones(n, bool)
+    start[1:] = columns.stream[1:] != columns.stream[:-1]
+
+    name_uid = np.array([users.lookup(name) for name in columns.names], np.int64)
+    uid = np.full(n, -1, np.int64)
+    uid[is_ssh] = name_uid[columns.name[is_ssh]]
+    # текущий пользователь CurrentUser - этот кандидат или -1
+    cand = uid[_fill_forward(uid != -1, start)] if n else uid
+
+    # пара (пользователь, пароль) одним числом; PBKDF2 - один раз на пару и
+    # только когда до пароля дошло бы дело (занятым и заблокированным не нужен)
+    npasswds = len(columns.passwds)
+    pair = np.where(cand != -1, cand * npasswds + columns.passwd, -1)
+    verified: Dict[int, bool] = {}
+
+    def check(key: int) -> bool:
+        ok = verified.get(key)
+        if ok is None:
+            u, p = divmod(key, npasswds)
+            ok = verified[key] = VERIFIER.verify(u, users[u].cred, columns.passwds[p])
+        return ok
+
+    user = np.full(n, -1, np.int64)
+    outcome = np.zeros(n, np.int8)
+    holder = np.full(n, -1, np.intc)
+    lockout = np.zeros(n, bool)
+    authd: Dict[int, int] = {}
+    retries: Dict[int, int] = {}
+
+    # автомат входа: скалярный цикл по ssh над списками, без обращений к numpy
+    positions = np.flatnonzero(is_ssh)
+    streams = columns.stream[positions].tolist()
+    sids = columns.sid.tolist()
+    targets = uid[positions].tolist()
+    pairs = pair[positions].tolist()
+    ssh_user, ssh_outcome, ssh_holder, ssh_lockout = [], [], [], []
+    current = -1
+    cuid = -1
+    sid = -1
+    for s, target, key in zip(streams, targets, pairs):
+        if s != current:
+            current, cuid, sid = s, -1, sids[s]
+        if target == -1:
+            target = cuid
+        held = -1
+        locked = False
+        if target == -1:
+            result = NOT_FOUND
+        else:
+            if target not in retries:
+                retries[target] = users[target].auth_retries
+            held = authd.get(target, -1)
+            if held == sid:
+                result = ALREADY
+            elif held != -1:
+                result = CONFLICT
+            elif retries[target] >= 3:
+                result = BLOCKED
+            elif not check(key):
+                result = WRONG
+                retries[target] += 1
+                locked = retries[target] == 3
+            else:
+                result = AUTHD
+                if cuid != -1 and cuid != target and authd.get(cuid) == sid:
+                    del authd[cuid]
+                authd[target] = sid
+                retries[target] = 0
+        ssh_user.append(target)
+        ssh_outcome.append(result)
+        ssh_holder.append(held if result == CONFLICT else -1)
+        ssh_lockout.append(locked)
+        cuid = target if result in (ALREADY, AUTHD) else -1
+
+    user[positions] = ssh_user
+    outcome[positions] = ssh_outcome
+    holder[positions] = ssh_holder
+    lockout[positions] = ssh_lockout
+
+    # sudo и dir - от пользователя после последнего ssh потока
+    if n:
+        last = _fill_forward(is_ssh, start)
+        after = np.where(is_ssh[last] & ((outcome[last] == ALREADY) | (outcome[last] == AUTHD)), user[last], -1)
+        rest = ~is_ssh
+        user[rest] = after[rest]
+        outcome[rest & (after != -1)] = ACCEPTED
+        sudo = np.flatnonzero((columns.type == SUDO) & (after != -1))
+        keys, inverse = np.unique(pair[sudo], return_inverse=True)
+        ok = np.array([check(key) for key in keys.tolist()], bool)
+        outcome[sudo[~ok[inverse.ravel()]]] = REJECTED
+    return Analysis(columns, user, outcome, holder, lockout, authd, retries, len(verified))
+
+
+def state(analysis: Analysis, users) -> List[list]:
+    """[name, authd, retries] занятых или заблокированных в конце, как Directory.dirty()."""
+    stream_ids = analysis.columns.stream_ids
+    out = []
+    for uid, retries in analysis.retries.items():
+        held = analysis.authd.get(uid, -1)
+        if held != -1 or retries:
+            out.append([users[uid].name, stream_ids[held] if held != -1 else "", retries])
+    return out
+
+
+def per_stream(analysis: Analysis) -> np.ndarray:
+    """По потокам: [ssh_failures, sudo_failures, lockouts], как счётчики CurrentUser."""
+    cols = analysis.columns
+    nstreams = len(cols.sid)
+    ssh_wrong = (cols.type == SSH) & (analysis.outcome == WRONG)
+    sudo_bad = (cols.type == SUDO) & (analysis.outcome == REJECTED)
+    return np.stack([
+        np.bincount(cols.stream[ssh_wrong], minlength=nstreams),
+        np.bincount(cols.stream[sudo_bad], minlength=nstreams),
+        np.bincount(cols.stream[analysis.lockout], minlength=nstreams),
+    ], axis=1)
+
+
+def report(analysis: Analysis, users) -> Dict[str, object]:
+    """Сводка: события по типам и исходам, итоги и разбивка по пользователям."""
+    cols = analysis.columns
+    kinds = len(OUTCOMES)
+    by_type = np.bincount(cols.type.astype(np.intp) * kinds + analysis.outcome,
+                          minlength=(DIR + 1) * kinds).reshape(DIR + 1, kinds)
+    outcomes = {t: {OUTCOMES[o]: int(c) for o, c in enumerate(by_type[code]) if c}
+                for t, code in TYPE_CODES.items()}
+
+    has_user = analysis.user != -1
+    uids, inverse = np.unique(analysis.user[has_user], return_inverse=True)
+    codes = (cols.type[has_user].astype(np.intp) * kinds + analysis.outcome[has_user])
+    table = np.zeros((len(uids), (DIR + 1) * kinds), np.int64)
+    np.add.at(table, (inverse.ravel(), codes), 1)
+    lockouts = np.bincount(inverse.ravel(), weights=analysis.lockout[has_user], minlength=len(uids))
+    per_user = {}
+    for row, uid, locked in zip(table.tolist(), uids.tolist(), lockouts.tolist()):
+        per_user[users[uid].name] = {
+            "logins": row[SSH * kinds + AUTHD],
+            "ssh_failures": row[SSH * kinds + WRONG],
+            "blocked": row[SSH * kinds + BLOCKED],
+            "conflicts": row[SSH * kinds + CONFLICT],
+            "lockouts": int(locked),
+            "sudo_accepted": row[SUDO * kinds + ACCEPTED],
+            "sudo_rejected": row[SUDO * kinds + REJECTED],
+            "dirs": row[DIR * kinds + ACCEPTED],
+        }
+    return {
+        "streams": len(cols.sid),
+        "events": {t: int(by_type[code].sum()) for t, code in TYPE_CODES.items()},
+        "outcomes": outcomes,
+        "ssh_failures": outcomes["ssh"].get("wrong", 0),
+        "sudo_failures": outcomes["sudo"].get("rejected", 0),
+        "lockouts": int(analysis.lockout.sum()),
+        "passwords_checked": analysis.verified,
+        "users": per_user,
+    }
+
+
+def messages(analysis: Analysis, users) -> Iterator[Tuple[int, str]]:
+    """(уровень, текст) каждого события в порядке файла - то, что записал бы CurrentUser."""
+    cols = analysis.columns
+    names: Dict[int, str] = {}
+    for i, (s, t, o) in enumerate(zip(cols.stream.tolist(), cols.type.tolist(), analysis.outcome.tolist())):
+        msg = MESSAGES.get((t, o))
+        if msg is None:
+            continue
+        level, fmt = msg
+        stream_id = cols.stream_ids[cols.sid[s]]
+        if o == NOT_FOUND:
+            yield level, fmt % (cols.names[cols.name[i]], stream_id)
+        elif o == ALREADY:
+            yield level, fmt % (stream_id,)
+        else:
+            uid = int(analysis.user[i])
+            if uid not in names:
+                names[uid] = users[uid].name
+            if o == CONFLICT:
+                yield level, fmt % (names[uid], cols.stream_ids[analysis.holder[i]], stream_id)
+            else:
+                yield level, fmt % (names[uid], stream_id)
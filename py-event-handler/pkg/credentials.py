@@ -0,0 +1,147 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Пароли пользователей хранятся только как PBKDF2-HMAC-SHA256 с солью.
+# Честная проверка стоит PBKDF2_ITERATIONS раундов (миллисекунды), поэтому
+# успешные проверки запоминаются в VerifyCache: повторный sudo или ssh с тем
+# же паролем сводится к одному ключевому blake2b и поиску в словаре.
+#
+# Ключ кэша - (uid, blake2b(соль + попытка) с секретом процесса): пароль в
+# открытом виде в кэше не лежит, а смена пароля меняет соль и тем самым
+# сама делает старые записи недостижимыми. Неудачные проверки не кэшируются,
+# подбор пароля всегда платит полную цену. Записи живут VERIFY_CACHE_TTL
+# секунд, всего их не больше VERIFY_CACHE_SIZE (0 - без кэша).
+
+PBKDF2_ITERATIONS = int(os.environ.get("PBKDF2_ITERATIONS", 100_000))
+VERIFY_CACHE_SIZE = int(os.environ.get("VERIFY_CACHE_SIZE", 4096))
+VERIFY_CACHE_TTL = float(os.environ.get("VERIFY_CACHE_TTL", 300))
+SALT_SIZE = 16
+DIGEST_SIZE = 32
+SCHEME = "pbkdf2_sha256"
+
+
+def derive(salt: bytes, passwd: str, iterations: int) -> bytes:
+    # hashlib отпускает GIL на время PBKDF2, так что пул потоков помогает
+    return hashlib.pbkdf2_hmac("sha256", passwd.encode(), salt, iterations)
+
+
+class Credential:
+    __slots__ = ("salt", "digest", "iterations")
+
+    def __init__(self, salt: bytes, digest: bytes, iterations: int):
+        self.salt = salt
+        self.digest = digest
+        self.iterations = iterations
+
+    @classmethod
+    def create(cls, passwd: str, iterations: int = PBKDF2_ITERATIONS) -> "Credential":
+        salt = os.urandom(SALT_SIZE)
+        return cls(salt, derive(salt, passwd, iterations), iterations)
+
+    def check(self, passwd: str) -> bool:
+        return hmac.compare_digest(derive(self.salt, passwd, self.iterations), self.digest)
+
+    # текстовый вид для каталогов пользователей: pbkdf2_sha256$раунды$соль$хеш
+    def encode(self) -> str:
+        return f"{SCHEME}${self.iterations}${self.salt.hex()}${self.digest.hex()}"
+
+    @classmethod
+    def parse(cls, text: str) -> "Credential":
+        try:
+            scheme, iterations, salt, digest = text.split("$")
+            if scheme != SCHEME:
+                raise ValueError(f"unknown scheme {scheme}")
+            return cls(bytes.fromhex(salt), bytes.fromhex(digest), int(iterations))
+        except ValueError as e:
+            raise ValueError(f"bad credential {text[:32]!r}: {e}") from None
+
+
+class VerifyCache:
+    """Недавние успешные проверки: ключ -> момент истечения.
+
+    Срок у всех записей одинаковый и при попадании не продлевается, так что
+    порядок вставки совпадает с порядком истечения: просроченные и лишние
+    записи снимаются с начала за O(1).
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries: "OrderedDict[Tuple[int, bytes], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, uid: int, cred: Credential, passwd: str) -> Tuple[int, bytes]:
+        h = hashlib.blake2b(cred.salt + passwd.encode(), key=self._secret, digest_size=16)
+        return uid, h.digest()
+
+    def hit(self, key: Tuple[int, bytes]) -> bool:
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is not None and expires > time.monotonic():
+                self.hits += 1
+                return True
+            if expires is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def peek(self, key: Tuple[int, bytes]) -> bool:
+        """Как hit, но без учёта в статистике и без удаления."""
+        with self._lock:
+            expires = self._entries.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def add(self, key: Tuple[int, bytes]) -> None:
+        now = time.monotonic()
+        entries = self._entries
+        with self._lock:
+            entries.pop(key, None)
+            entries[key] = now + self.ttl
+            while entries:
+                first, expires = next(iter(entries.items()))
+                if len(entries) <= self.size and expires > now:
+                    break
+                del entries[first]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class Verifier:
+    def __init__(self, cache: Optional[VerifyCache]):
+        self.cache = cache
+
+    def verify(self, uid: int, cred: Credential, passwd: str) -> bool:
+        cache = self.cache
+        if cache is None:
+            return cred.check(passwd)
+        key = cache.key(uid, cred, passwd)
+        if cache.hit(key):
+            return True
+        if not cred.check(passwd):
+            return False
+        cache.add(key)
+        return True
+
+    def is_warm(self, uid: int, cred: Credential, passwd: str) -> bool:
+        """Проверка обойдётся без PBKDF2 (для решения, уводить ли её в пул)."""
+        cache = self.cache
+        if cache is None:
+            return False
+        return cache.peek(cache.key(uid, cred, passwd))
+
+
+# кэш на процесс: у воркеров multiprocessing и шардов он свой
+VERIFIER = Verifier(VerifyCache(VERIFY_CACHE_SIZE, VERIFY_CACHE_TTL) if VERIFY_CACHE_SIZE else None)
@@ -0,0 +1,111 @@
+import json
+from typing import List, Union
+
+from events import lookup
+from models import Event, Stream
+
+# Декодирование входящих потоков: быстрый JSON-декодер, если установлен
+# (orjson, затем msgspec), иначе стандартный json. Проверка схемы и сборка
+# Event/Stream делаются за один проход; некорректное событие - DecodeError
+# (сервер отвечает 400), а не молчаливый Event("").
+
+try:
+    import orjson
+
+    loads = orjson.loads
+    BACKEND = "orjson"
+    JSON_ERRORS = (ValueError,)
+except ImportError:
+    try:
+        import msgspec
+
+        loads = msgspec.json.Decoder().decode
+        BACKEND = "msgspec"
+        JSON_ERRORS = (ValueError, msgspec.DecodeError)
+    except ImportError:
+        loads = json.loads
+        BACKEND = "json"
+        JSON_ERRORS = (ValueError,)
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def stream_from_obj(data) -> Stream:
+    if not isinstance(data, dict):
+        raise DecodeError("stream must be an object")
+    stream_id = data.get("streamId")
+    if not isinstance(stream_id, str) or not stream_id:
+        raise DecodeError("streamId must be a non-empty string")
+    raw_events = data.get("events")
+    if not isinstance(raw_events, list):
+        raise DecodeError(f"events must be a list ({stream_id})")
+
+    return Stream(stream_id, [event_from_obj(ev, i, stream_id) for i, ev in enumerate(raw_events)])
+
+
+def event_from_obj(ev, i: int, stream_id: str) -> Event:
+    if not isinstance(ev, dict):
+        raise DecodeError(f"event {i} must be an object ({stream_id})")
+    type_ = ev.get("type")
+    etype = lookup(type_) if isinstance(type_, str) else None
+    if etype is None:
+        raise DecodeError(f"event {i} has unknown type {type_!r} ({stream_id})")
+    error = etype.validate(ev)
+    if error:
+        raise DecodeError(f"event {i} ({type_}) {error} ({stream_id})")
+    name = ev.get("name", "")
+    passwd = ev.get("passwd", "")
+    if not isinstance(name, str) or not isinstance(passwd, str):
+        raise DecodeError(f"event {i} has non-string name/passwd ({stream_id})")
+    return Event(type_, name, passwd)
+
+
+def decode_events(body: bytes, stream_id: str, first: int = 0) -> List[Event]:
+    """События для открытого потока: один объект или JSON-массив объектов.
+
+    first - номер первого события в потоке, только для текста ошибки.
+    """
+    try:
+        data = loads(body)
+    except JSON_ERRORS as e:
+        raise DecodeError(f"invalid JSON: {e}") from None
+    if isinstance(data, dict):
+        return [event_from_obj(data, first, stream_id)]
+    if not isinstance(data, list):
+        raise DecodeError("events must be an object or a list")
+    return [event_from_obj(ev, first + i, stream_id) for i, ev in enumerate(data)]
+
+
+def decode_stream(body: bytes) -> Stream:
+    try:
+        data = loads(body)
+    except JSON_ERRORS as e:
+        raise DecodeError(f"invalid JSON: {e}") from None
+    return stream_from_obj(data)
+
+
+def try_decode_stream(body: bytes) -> Union[Stream, DecodeError]:
+    try:
+        return decode_stream(body)
+    except DecodeError as e:
+        return e
+
+
+def decode_batch(body: bytes) -> List[Union[Stream, DecodeError]]:
+    """JSON-массив потоков; ошибка в одном потоке не отменяет остальные."""
+    try:
+        data = loads(body)
+    except JSON_ERRORS as e:
+        raise DecodeError(f"invalid JSON: {e}") from None
+    if not isinstance(data, list):
+        raise DecodeError("batch must be a list of streams")
+
+    streams = []
+    for item in data:
+        try:
+            streams.append(stream_from_obj(item))
+        except DecodeError as e:
+            streams.append(e)
+    return streams
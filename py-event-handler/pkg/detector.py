@@ -0,0 +1,336 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Optional
+
+from events import SSH, SUDO, wrap
+from metrics import ALERTS_SPRAY, ALERTS_STREAM, ALERTS_USER, DETECTOR_BLOCKED
+
+logger = logging.getLogger()
+
+# Детектор подбора паролей поверх всех потоков (DETECT: off, alert, enforce).
+#
+# Единственная защита CurrentUser - блокировка после трёх неверных паролей
+# подряд: она не снимается и не видит атак, размазанных по пользователям и
+# потокам. Детектор считает неверные пароли ssh и sudo и входы под
+# несуществующими именами за скользящее окно DETECT_WINDOW:
+#   - по пользователю (имени) - подбор пароля к одной учётной записи;
+#   - по потоку - один источник перебирает пароли или имена;
+#   - сколько разных имён ошибалось за окно - перебор по списку учётных
+#     данных (credential stuffing): по одной-две попытки на имя, но много имён.
+# Достигнутый порог - предупреждение в лог и в detector_alerts_total. При
+# DETECT=enforce пользователь и поток ещё и блокируются: первый раз на
+# DETECT_LOCKOUT секунд, каждый следующий - вдвое дольше, до
+# DETECT_LOCKOUT_MAX; после DETECT_LOCKOUT_MAX без блокировок счёт повторов
+# забывается. При DETECT=alert срок блокировки - только пауза до
+# следующего предупреждения о том же ключе. Заблокированный вход
+# отклоняется до проверки пароля, то есть и без PBKDF2.
+#
+# Память постоянная при любом числе имён и потоков:
+#   - окно - DETECT_BUCKETS корзин по кругу (RingCounter): устаревшая
+#     корзина обнуляется, когда время до неё доходит снова;
+#   - счётчики по имени и по потоку - count-min sketch из таких же корзин
+#     (WindowSketch): DETECT_SKETCH_DEPTH строк по DETECT_SKETCH_WIDTH
+#     ячеек, оценка - минимум по строкам, ошибается только вверх;
+#   - блокировки - таблица из DETECT_LOCK_SLOTS слотов по хешу ключа
+#     (LockTable): при совпадении слотов новая блокировка вытесняет старую.
+# На событие - O(1): несколько обращений к массивам. Исключение - смена
+# корзины sketch'а, которая вычитает её из итогов целиком; она бывает раз в
+# DETECT_WINDOW / DETECT_BUCKETS секунд.
+#
+# Встраивается обёрткой обработчиков ssh и sudo в реестре (events.wrap),
+# поэтому работает во всех обработчиках с таблицей вызовов, включая сессии
+# (журнал повторяется при запуске до того, как детектор встроен). Удачный
+# вход стоит monotonic_ns и одного сравнения (есть ли вообще действующие
+# блокировки), удачный sudo - только сравнения счётчика ошибок.
+# Запись под блокировкой детектора - только на неверных паролях. Процессы
+# multiprocessing и asyncio с PROCS > 1 делят один детектор в общей памяти
+# (shared=True): его массивы создаются до fork, а хеши строк воркеры
+# наследуют от родителя.
+
+DETECT = os.environ.get("DETECT", "off")
+DETECT_WINDOW = float(os.environ.get("DETECT_WINDOW", 60))
+DETECT_BUCKETS = int(os.environ.get("DETECT_BUCKETS", 12))
+# неверных попыток за окно: к одному имени, из одного потока; разных имён с ошибками
+DETECT_USER_FAILURES = int(os.environ.get("DETECT_USER_FAILURES", 10))
+DETECT_STREAM_FAILURES = int(os.environ.get("DETECT_STREAM_FAILURES", 20))
+DETECT_SPRAY_USERS = int(os.environ.get("DETECT_SPRAY_USERS", 20))
+DETECT_LOCKOUT = float(os.environ.get("DETECT_LOCKOUT", 60))
+DETECT_LOCKOUT_MAX = float(os.environ.get("DETECT_LOCKOUT_MAX", 3600))
+# степень двойки, см. WindowSketch
+DETECT_SKETCH_WIDTH = int(os.environ.get("DETECT_SKETCH_WIDTH", 4096))
+DETECT_SKETCH_DEPTH = 4
+DETECT_LOCK_SLOTS = int(os.environ.get("DETECT_LOCK_SLOTS", 65536))
+
+MODES = ("off", "alert", "enforce")
+MASK = 2**63 - 1
+# повторов блокировки, после которых срок уже не растёт
+MAX_STRIKES = 32
+
+
+def new_array(n: int, shared: bool):
+    return multiprocessing.RawArray("q", n) if shared else [0] * n
+
+
+def key_hash(key: str) -> int:
+    # 0 - пустой слот в LockTable
+    return (hash(key) & MASK) or 1
+
+
+class RingCounter:
+    """Сумма за последние buckets тиков; тик - номер корзины времени."""
+
+    __slots__ = ("buckets", "counts")
+
+    def __init__(self, buckets: int, shared: bool = False):
+        self.buckets = buckets
+        # [0] - последний тик, [1] - сумма по окну, дальше корзины
+        self.counts = new_array(buckets + 2, shared)
+
+    def _advance(self, tick: int) -> None:
+        c = self.counts
+        last = c[0]
+        if tick <= last:
+            return
+        nb = self.buckets
+        for t in range(last + 1, min(tick, last + nb) + 1):
+            i = 2 + t % nb
+            c[1] -= c[i]
+            c[i] = 0
+        c[0] = tick
+
+    def add(self, tick: int, n: int = 1) -> int:
+        """Добавляет n в корзину тика; возвращает сумму по окну."""
+        c = self.counts
+        if tick != c[0]:
+            self._advance(tick)
+        c[2 + tick % self.buckets] += n
+        c[1] += n
+        return c[1]
+
+    def total(self, tick: int) -> int:
+        self._advance(tick)
+        return self.counts[1]
+
+
+class WindowSketch:
+    """Count-min sketch за окно из buckets корзин.
+
+    Каждая корзина - свой sketch depth x width, totals - их сумма; оценка
+    ключа читает только totals. Ячейка строки row - 16 бит хеша начиная с
+    16 * row, поэтому width - степень двойки не больше 2**16, а depth - не
+    больше 4 (хеш 63-битный).
+    """
+
+    __slots__ = ("depth", "width", "buckets", "totals", "cells", "tick", "rows")
+
+    def __init__(self, depth: int, width: int, buckets: int, shared: bool = False):
+        if width & (width - 1) or not 0 < width <= 1 << 16 or not 0 < depth <= 4:
+            raise ValueError(f"sketch {depth}x{width}: width must be a power of two up to 65536, depth up to 4")
+        self.depth = depth
+        self.width = width
+        self.buckets = buckets
+        # (начало строки, сдвиг хеша)
+        self.rows = tuple((row * width, 16 * row) for row in range(depth))
+        self.totals = new_array(depth * width, shared)
+        self.cells = new_array(buckets * depth * width, shared)
+        self.tick = new_array(1, shared)
+
+    def _advance(self, tick: int) -> None:
+        last = self.tick[0]
+        if tick <= last:
+            return
+        size = self.depth * self.width
+        totals, cells = self.totals, self.cells
+        for t in range(last + 1, min(tick, last + self.buckets) + 1):
+            base = (t % self.buckets) * size
+            old = cells[base:base + size]
+            if any(old):
+                totals[:] = [a - b for a, b in zip(totals[:], old)]
+                cells[base:base + size] = [0] * size
+        self.tick[0] = tick
+
+    def add(self, h: int, tick: int) -> int:
+        """Учитывает ключ с хешем h; возвращает оценку его числа за окно."""
+        if tick != self.tick[0]:
+            self._advance(tick)
+        mask = self.width - 1
+        totals, cells = self.totals, self.cells
+        base = (tick % self.buckets) * len(totals)
+        estimate = MASK
+        for start, shift in self.rows:
+            i = start + (h >> shift & mask)
+            n = totals[i] + 1
+            totals[i] = n
+            cells[base + i] += 1
+            if n < estimate:
+                estimate = n
+        return estimate
+
+
+class LockTable:
+    """Блокировки ключей со сроком и счётом повторов, слот - хеш % slots."""
+
+    __slots__ = ("slots", "table")
+
+    def __init__(self, slots: int, shared: bool = False):
+        self.slots = slots
+        # на слот: хеш ключа, конец блокировки (нс), блокировок подряд
+        self.table = new_array(3 * slots, shared)
+
+    def until(self, h: int) -> int:
+        i = 3 * (h % self.slots)
+        t = self.table
+        return t[i + 1] if t[i] == h else 0
+
+    def lock(self, h: int, now: int, base_ns: int, max_ns: int) -> int:
+        """Блокирует ключ; возвращает срок, нс."""
+        i = 3 * (h % self.slots)
+        t = self.table
+        strikes = t[i + 2] if t[i] == h and now - t[i + 1] < max_ns else 0
+        duration = min(base_ns << strikes, max_ns)
+        t[i], t[i + 1], t[i + 2] = h, now + duration, min(strikes + 1, MAX_STRIKES)
+        return duration
+
+
+class Detector:
+    def __init__(self, metrics, enforce: bool = False, shared: bool = False,
+                 window: float = DETECT_WINDOW, buckets: int = DETECT_BUCKETS,
+                 user_failures: int = DETECT_USER_FAILURES, stream_failures: int = DETECT_STREAM_FAILURES,
+                 spray_users: int = DETECT_SPRAY_USERS, lockout: float = DETECT_LOCKOUT,
+                 lockout_max: float = DETECT_LOCKOUT_MAX, width: int = DETECT_SKETCH_WIDTH,
+                 depth: int = DETECT_SKETCH_DEPTH, slots: int = DETECT_LOCK_SLOTS,
+                 clock=time.monotonic_ns):
+        # metrics - Metrics или SharedMetrics: алерты пишутся в шард процесса
+        self.metrics = metrics
+        self.enforce = enforce
+        # часы в нс; бенчмарк подставляет свои
+        self.clock = clock
+        self.window = window
+        self.bucket_ns = max(1, int(window * 1e9 / buckets))
+        self.user_failures = user_failures
+        self.stream_failures = stream_failures
+        self.spray_users = spray_users
+        self.lockout_ns = int(lockout * 1e9)
+        self.lockout_max_ns = int(lockout_max * 1e9)
+        self.by_user = WindowSketch(depth, width, buckets, shared)
+        self.by_stream = WindowSketch(depth, width, buckets, shared)
+        self.failures = RingCounter(buckets, shared)
+        self.spray = RingCounter(buckets, shared)
+        self.user_locks = LockTable(slots, shared)
+        self.stream_locks = LockTable(slots, shared)
+        # конец самой поздней блокировки: пока он в прошлом, проверять нечего
+        self.active = new_array(1, shared)
+        self.lock = multiprocessing.Lock() if shared else threading.Lock()
+
+    def memory_bytes(self) -> int:
+        cells = 2 * (len(self.by_user.totals) + len(self.by_user.cells))
+        return 8 * (cells + 2 * len(self.failures.counts) + 2 * len(self.user_locks.table) + 1)
+
+    # --------- горячий путь ---------
+    def blocked(self, name: str, stream_id: str, now: int) -> int:
+        """Сколько ещё (нс) заблокирован вход name из потока stream_id; 0 - не заблокирован."""
+        if now >= self.active[0]:
+            return 0
+        left = max(self.user_locks.until(key_hash(name)), self.stream_locks.until(key_hash(stream_id))) - now
+        return left if left > 0 else 0
+
+    def failure(self, name: Optional[str], stream_id: str, now: int) -> None:
+        """Неверный пароль (name - имя при ssh, None при sudo) или вход под несуществующим именем."""
+        tick = now // self.bucket_ns
+        user_n = spray_n = user_lock = stream_lock = 0
+        with self.lock:
+            h = key_hash(stream_id)
+            stream_n = self.by_stream.add(h, tick)
+            total = self.failures.add(tick)
+            # оценка sketch'а растёт скачками, если в её ячейки пишут чужие
+            # ключи, поэтому порог - "не меньше", а повтор тревоги гасит
+            # запись в таблице блокировок (при alert она ничего не блокирует)
+            if stream_n >= self.stream_failures and self.stream_locks.until(h) <= now:
+                stream_lock = self._lock(self.stream_locks, h, now)
+            if name is not None:
+                h = key_hash(name)
+                user_n = self.by_user.add(h, tick)
+                if user_n >= self.user_failures and self.user_locks.until(h) <= now:
+                    user_lock = self._lock(self.user_locks, h, now)
+                # первая ошибка имени за окно - ещё одно разное имя
+                if user_n == 1:
+                    spray_n = self.spray.add(tick)
+        if user_lock:
+            self._alert(ALERTS_USER, "%s неудачных входов пользователя %s за %.0f с" % (user_n, name, self.window),
+                        user_lock, stream_id)
+        if stream_lock:
+            self._alert(ALERTS_STREAM, "%s неудачных попыток в потоке за %.0f с" % (stream_n, self.window),
+                        stream_lock, stream_id)
+        if spray_n == self.spray_users:
+            self._alert(ALERTS_SPRAY, "ошибки входа у %s разных имён за %.0f с, всего ошибок %s"
+                        % (spray_n, self.window, total), 0, stream_id)
+
+    def _lock(self, table: LockTable, h: int, now: int) -> int:
+        # под self.lock
+        duration = table.lock(h, now, self.lockout_ns, self.lockout_max_ns)
+        if self.enforce and now + duration > self.active[0]:
+            self.active[0] = now + duration
+        return duration
+
+    def _alert(self, counter: int, text: str, lock_ns: int, stream_id: str) -> None:
+        self.metrics.shard().inc(counter)
+        if self.enforce and lock_ns:
+            logger.warning("Детектор: %s, блокировка на %.0f с (%s)", text, lock_ns / 1e9, stream_id)
+        else:
+            logger.warning("Детектор: %s (%s)", text, stream_id)
+
+    # --------- обёртки обработчиков ---------
+    def wrap_ssh(self, handler):
+        detector = self
+        clock = self.clock
+
+        def ssh(cu, stream_id: str, event) -> None:
+            now = clock()
+            if now < detector.active[0]:
+                left = detector.blocked(event.name, stream_id, now)
+                if left:
+                    detector.metrics.shard().inc(DETECTOR_BLOCKED)
+                    logger.error("Can't access user %s, blocked by detector for %.0f s (%s)",
+                                 event.name, left / 1e9, stream_id)
+                    cu.cuid = -1
+                    return
+            failures = cu.ssh_failures
+            handler(cu, stream_id, event)
+            # неверный пароль, несуществующее имя (перебор по списку) или
+            # попытка к уже заблокированному пользователю: его блокировка
+            # после трёх ошибок не снимается, а попытки продолжают идти
+            if cu.cuid == -1 or cu.ssh_failures != failures:
+                detector.failure(event.name, stream_id, now)
+        return ssh
+
+    def wrap_sudo(self, handler):
+        detector = self
+        clock = self.clock
+
+        def sudo(cu, stream_id: str, event) -> None:
+            failures = cu.sudo_failures
+            handler(cu, stream_id, event)
+            if cu.sudo_failures != failures:
+                detector.failure(None, stream_id, clock())
+        return sudo
+
+
+def open_detector(metrics, shared: bool = False, mode: str = DETECT) -> Optional[Detector]:
+    """Детектор по DETECT, встроенный в таблицы вызовов; None, если выключен.
+
+    shared=True - для процессов-воркеров: вызывать до их запуска.
+    """
+    if mode not in MODES:
+        raise ValueError(f"DETECT must be one of {', '.join(MODES)}, got {mode!r}")
+    if mode == "off":
+        return None
+    detector = Detector(metrics, enforce=mode == "enforce", shared=shared)
+    wrap(SSH, detector.wrap_ssh)
+    wrap(SUDO, detector.wrap_sudo)
+    logger.info("Детектор подбора паролей: %s, окно %.0f с, пороги %s/%s/%s, %.1f МБ",
+                mode, detector.window, detector.user_failures, detector.stream_failures,
+                detector.spray_users, detector.memory_bytes() / 2**20)
+    return detector
@@ -0,0 +1,461 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from credentials import Credential
+from models import User
+
+logger = logging.getLogger()
+
+# Каталог пользователей вместо зашитого в код словаря USERS.
+#
+# Источник (USERS_FILE) - CSV, JSON (массив объектов), JSON Lines или база
+# SQLite. Поля: name, uid (необязательно, иначе номер строки с нуля) и
+# passwd либо hash (credentials.Credential.encode). CSV и JSON один раз
+# импортируются в SQLite-файл в USERS_IMPORT_DIR; пока исходник не изменился,
+# следующий запуск берёт готовый импорт, так что старт не зависит от размера
+# каталога. Базу SQLite сервер открывает как есть, на чтение, со схемой
+#   users(uid INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, passwd TEXT, hash TEXT)
+#
+# В памяти только горячие пользователи: LRU на USERS_CACHE_SIZE записей,
+# промах - запрос к SQLite по индексу. Неизвестные имена запоминаются
+# (USERS_NEGATIVE_CACHE последних), чтобы перебор выдуманных имён не шёл
+# каждый раз в SQLite под общей блокировкой хранилища.
+#
+# Состояние авторизации (authd, auth_retries) есть только в памяти, а
+# CurrentUser держит лишь uid. Поэтому "грязных" пользователей (вошли или
+# есть неудачные попытки) каталог держит сильными ссылками вне LRU: после
+# каждой смены состояния обработчик под блокировкой пользователя вызывает
+# mark(). Вытесненный из LRU объект, который ещё жив, при следующем
+# обращении возвращается тот же, а не загружается второй копией.
+#
+# reload() перечитывает источник без перезапуска: LRU и неизвестные имена
+# сбрасываются, грязные пользователи остаются, и у них обновляется пароль,
+# если он изменился. Живые объекты из прежнего кэша сверяются с новым
+# каталогом при следующем обращении. uid существующих пользователей
+# меняться не должен.
+#
+# Пароли в открытом виде хешируются при первой загрузке пользователя; для
+# больших каталогов храните hash. credentials() отдаёт каталог целиком без
+# хеширования - для общей таблицы (shm_users), которая хеширует такие пароли
+# при первой проверке, читая их через plain_passwd().
+
+USERS_FILE = os.environ.get("USERS_FILE", os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", "users.csv")))
+USERS_CACHE_SIZE = int(os.environ.get("USERS_CACHE_SIZE", 100_000))
+USERS_NEGATIVE_CACHE = int(os.environ.get("USERS_NEGATIVE_CACHE", 10_000))
+USERS_IMPORT_DIR = os.environ.get("USERS_IMPORT_DIR", tempfile.gettempdir())
+USERS_RELOAD_INTERVAL = float(os.environ.get("USERS_RELOAD_INTERVAL", 0))
+IMPORT_BATCH = 10_000
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+SCHEMA = (
+    "CREATE TABLE users (uid INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, passwd TEXT, hash TEXT)",
+    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+)
+
+Row = Tuple[int, str, Optional[str], Optional[str]]
+
+
+def _signature(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def _read_rows(path: str) -> Iterator[Tuple[Optional[int], str, Optional[str], Optional[str]]]:
+    lower = path.lower()
+    if lower.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            records = csv.DictReader(f)
+            for rec in records:
+                yield _row_of(rec, records.line_num)
+    elif lower.endswith((".jsonl", ".ndjson")):
+        with open(path, encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                if line.strip():
+                    yield _row_of(json.loads(line), n)
+    elif lower.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            records = json.load(f)
+        if not isinstance(records, list):
+            raise ValueError(f"{path}: expected a JSON array of users")
+        for n, rec in enumerate(records, 1):
+            yield _row_of(rec, n)
+    else:
+        raise ValueError(f"{path}: unknown user directory format")
+
+
+def _row_of(rec: Dict[str, Any], n: int):
+    name = rec.get("name")
+    if not isinstance(name, str) or not name:
+        raise ValueError(f"user #{n}: name must be a non-empty string")
+    passwd = rec.get("passwd") or None
+    secret = rec.get("hash") or None
+    if passwd is None and secret is None:
+        raise ValueError(f"user {name}: passwd or hash is required")
+    uid = rec.get("uid")
+    return (int(uid) if uid not in (None, "") else None), name, passwd, secret
+
+
+def import_users(source: str, import_dir: str = USERS_IMPORT_DIR) -> str:
+    """SQLite-копия CSV/JSON-каталога; готовая копия переиспользуется."""
+    signature = _signature(source)
+    key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:16]
+    path = os.path.join(import_dir, f"users-{key}.sqlite")
+    if os.path.exists(path):
+        try:
+            with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as conn:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            if row is not None and row[0] == signature:
+                return path
+        except sqlite3.Error:
+            pass
+
+    # пишем рядом и подменяем атомарно: открытые соединения дочитывают старый файл
+    tmp = f"{path}.{os.getpid()}.tmp"
+    # в импорте могут быть пароли в открытом виде
+    os.close(os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600))
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        for stmt in SCHEMA:
+            conn.execute(stmt)
+        batch = []
+        count = 0
+        for uid, name, passwd, secret in _read_rows(source):
+            batch.append((count if uid is None else uid, name, passwd, secret))
+            count += 1
+            if len(batch) >= IMPORT_BATCH:
+                conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?)", batch)
+                batch = []
+        conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?)", batch)
+        conn.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        conn.commit()
+    except sqlite3.IntegrityError as e:
+        conn.close()
+        os.unlink(tmp)
+        raise ValueError(f"{source}: duplicate user name or uid ({e})") from None
+    except BaseException:
+        conn.close()
+        os.unlink(tmp)
+        raise
+    conn.close()
+    os.replace(tmp, path)
+    logger.info("Каталог пользователей %s импортирован: %s записей", source, count)
+    return path
+
+
+class UserStore:
+    """Пользователи в SQLite: поиск по имени и uid без загрузки всего каталога."""
+
+    def __init__(self, source: str, import_dir: str = USERS_IMPORT_DIR):
+        self.source = source
+        self.import_dir = import_dir
+        self.path = ""
+        self._signature = ""
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.open()
+
+    def open(self) -> None:
+        signature = _signature(self.source)
+        if self.source.lower().endswith(SQLITE_SUFFIXES):
+            path = self.source
+        else:
+            path = import_users(self.source, self.import_dir)
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        with self._lock:
+            old, self._conn = self._conn, conn
+            self.path = path
+            self._signature = signature
+        if old is not None:
+            old.close()
+
+    def changed(self) -> bool:
+        try:
+            return _signature(self.source) != self._signature
+        except OSError:
+            return False
+
+    def by_name(self, name: str) -> Optional[Row]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT uid, name, passwd, hash FROM users WHERE name = ?", (name,)).fetchone()
+
+    def by_uid(self, uid: int) -> Optional[Row]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT uid, name, passwd, hash FROM users WHERE uid = ?", (uid,)).fetchone()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM users").fetchone()[0]
+
+    def max_uid(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT max(uid) FROM users").fetchone()
+        return -1 if row[0] is None else row[0]
+
+    def rows(self) -> Iterator[Row]:
+        # отдельное соединение, чтобы долгий обход не держал блокировку поиска
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            yield from conn.execute("SELECT uid, name, passwd, hash FROM users ORDER BY uid")
+        finally:
+            conn.close()
+
+
+def plain_passwd(path: str, uid: int) -> Optional[str]:
+    """Пароль в открытом виде из SQLite-каталога path; None - нет такого uid или пароля."""
+    # своё соединение: вызывается и в воркерах после fork
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT passwd FROM users WHERE uid = ?", (uid,)).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else row[0]
+
+
+class Directory:
+    """Интерфейс UserIndex (lookup, [uid], items) поверх UserStore с LRU."""
+
+    def __init__(self, store: UserStore, cache_size: int = USERS_CACHE_SIZE,
+                 factory: Callable[..., Any] = User, negative_size: int = USERS_NEGATIVE_CACHE):
+        self.store = store
+        self.cache_size = cache_size
+        self.factory = factory
+        self.negative_size = negative_size
+        self.hits = 0
+        self.misses = 0
+        self._by_name: Dict[str, int] = {}
+        self._users: "OrderedDict[int, Any]" = OrderedDict()
+        # имена, которых нет в каталоге; старые выбрасываются первыми
+        self._unknown: "OrderedDict[str, None]" = OrderedDict()
+        # грязные пользователи, см. mark
+        self._dirty: Dict[int, Any] = {}
+        # (passwd, hash) живых объектов: reload обновляет cred, только если он изменился
+        self._records: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        # записи объектов из кэша до reload: сверяются при возвращении объекта
+        self._stale: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        self._evicted: "weakref.WeakValueDictionary[int, Any]" = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def lookup(self, name: str) -> int:
+        uid = self.peek(name)
+        if uid is not None:
+            return uid
+        with self._lock:
+            self.misses += 1
+        row = self.store.by_name(name)
+        if row is None:
+            with self._lock:
+                self._unknown[name] = None
+                if len(self._unknown) > self.negative_size:
+                    self._unknown.popitem(last=False)
+            return -1
+        return self._admit(row)[0]
+
+    def peek(self, name: str) -> Optional[int]:
+        """lookup() только по кэшу: uid, -1 для известного отсутствующего, None - промах."""
+        with self._lock:
+            uid = self._by_name.get(name)
+            if uid is not None:
+                self._users.move_to_end(uid)
+                self.hits += 1
+                return uid
+            if name in self._unknown:
+                self.hits += 1
+                return -1
+        return None
+
+    def peek_user(self, uid: int) -> Optional[Any]:
+        """Пользователь из кэша или None, если __getitem__ пошёл бы в каталог."""
+        return self._users.get(uid)
+
+    def __getitem__(self, uid: int) -> Any:
+        user = self._users.get(uid)
+        if user is not None:
+            return user
+        row = self.store.by_uid(uid)
+        if row is None:
+            # пропал из каталога при reload, но ещё в работе
+            user = self._dirty.get(uid)
+            if user is None:
+                raise KeyError(uid)
+            return user
+        return self._admit(row)[1]
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._users or self.store.by_uid(uid) is not None
+
+    def __len__(self) -> int:
+        return self.store.count()
+
+    def max_uid(self) -> int:
+        return self.store.max_uid()
+
+    def cached(self) -> int:
+        return len(self._users)
+
+    def name(self, uid: int) -> str:
+        return self[uid].name
+
+    def mark(self, uid: int, user: Any) -> None:
+        """Отметить смену authd или auth_retries; вызывать под блокировкой пользователя.
+
+        Грязный пользователь держится сильной ссылкой, пока не станет
+        чистым, даже если LRU его уже вытеснил: иначе объект с состоянием
+        собрал бы GC, и следующий поиск загрузил бы чистую копию - второй
+        вход и сброс блокировки после трёх ошибок.
+        """
+        with self._lock:
+            if user.authd or user.auth_retries:
+                self._dirty[uid] = user
+            elif self._dirty.get(uid) is user:
+                del self._dirty[uid]
+
+    def dirty(self) -> List[list]:
+        """[name, authd, auth_retries] пользователей с состоянием (для снимков wal)."""
+        with self._lock:
+            return [[user.name, user.authd, user.auth_retries] for user in self._dirty.values()]
+
+    def restore(self, name: str, authd: str, retries: int) -> bool:
+        uid = self.lookup(name)
+        if uid == -1:
+            return False
+        user = self[uid]
+        user.authd = authd
+        user.auth_retries = retries
+        self.mark(uid, user)
+        return True
+
+    def items(self) -> Iterator[Tuple[int, Any]]:
+        """Весь каталог: для обработчиков, которые раскладывают его целиком."""
+        for row in self.store.rows():
+            uid = row[0]
+            user = self._users.get(uid)
+            yield uid, user if user is not None else self._make(row)
+
+    def credentials(self) -> Iterator[Tuple[int, str, Optional[Credential]]]:
+        """Весь каталог без хеширования: uid, имя и Credential, None - пароль в открытом виде."""
+        for uid, name, _, secret in self.store.rows():
+            user = self._users.get(uid)
+            if user is not None:
+                yield uid, name, user.cred
+            else:
+                yield uid, name, Credential.parse(secret) if secret else None
+
+    def _make(self, row: Row) -> Any:
+        _, name, passwd, secret = row
+        return self.factory(name=name, passwd=passwd or "",
+                            cred=Credential.parse(secret) if secret else None)
+
+    def _alive(self, uid: int) -> Any:
+        # под self._lock: уже загруженный объект, если он где-то ещё есть
+        user = self._users.get(uid)
+        if user is None:
+            user = self._dirty.get(uid)
+        if user is None:
+            user = self._evicted.get(uid)
+        return user
+
+    def _admit(self, row: Row) -> Tuple[int, Any]:
+        uid = row[0]
+        record = (row[2], row[3])
+        with self._lock:
+            user = self._alive(uid)
+            if user is not None and self._stale.get(uid, record) == record:
+                self._stale.pop(uid, None)
+                if uid not in self._users:
+                    self._insert(uid, user, row)
+                return uid, user
+        # хеширование пароля в открытом виде - вне блокировки
+        fresh = self._make(row)
+        with self._lock:
+            user = self._alive(uid)
+            if user is None:
+                user = fresh
+            elif self._stale.pop(uid, record) != record:
+                # объект пережил reload, а пароль в каталоге сменился
+                user.cred = fresh.cred
+            if uid not in self._users:
+                self._insert(uid, user, row)
+            else:
+                self._records[uid] = record
+        return uid, user
+
+    def _insert(self, uid: int, user: Any, row: Row) -> None:
+        # под self._lock; грязных LRU вытесняет наравне с чистыми - их держит _dirty
+        self._users[uid] = user
+        self._by_name[user.name] = uid
+        self._records[uid] = (row[2], row[3])
+        users = self._users
+        while len(users) > self.cache_size:
+            old_uid, old = users.popitem(last=False)
+            del self._by_name[old.name]
+            self._evicted[old_uid] = old
+        records = self._records
+        if len(records) > 2 * self.cache_size + len(self._dirty):
+            # записи умерших объектов
+            self._records = {k: v for k, v in records.items()
+                             if k in users or k in self._dirty or k in self._evicted}
+
+    def reload(self) -> None:
+        with self._reload_lock:
+            self.store.open()
+            with self._lock:
+                # грязные - под той же блокировкой, что и mark: вошедший или
+                # ошибившийся паролем, пока идёт reload, не потеряется
+                kept = list(self._dirty.items())
+                evicted = weakref.WeakValueDictionary(self._evicted)
+                evicted.update(self._users)
+                self._stale = {uid: rec for uid, rec in self._records.items()
+                               if uid in evicted and uid not in self._dirty}
+                self._users = OrderedDict(kept)
+                self._by_name = {user.name: uid for uid, user in kept}
+                self._evicted = evicted
+                self._unknown.clear()
+            # пароли оставшихся в памяти сверяются с новым каталогом после подмены:
+            # запросы к SQLite и PBKDF2 идут без блокировки
+            for uid, user in kept:
+                row = self.store.by_uid(uid)
+                if row is None or row[1] != user.name:
+                    logger.warning("Пользователь %s (uid %s) пропал из каталога, но ещё в работе", user.name, uid)
+                    continue
+                if (row[2], row[3]) != self._records.get(uid):
+                    cred = self._make(row).cred
+                    with self._lock:
+                        user.cred = cred
+                        self._records[uid] = (row[2], row[3])
+        logger.info("Каталог пользователей %s перечитан: %s пользователей, в памяти %s",
+                    self.store.source, len(self), len(kept))
+
+    def try_reload(self) -> bool:
+        """reload() для сигнала или таймера: ошибка в источнике не роняет сервер."""
+        try:
+            self.reload()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.error("Не удалось перечитать каталог пользователей: %s", e)
+            return False
+        return True
+
+    def watch_forever(self, stop: threading.Event, interval: float) -> None:
+        """Перечитывает каталог, когда меняется файл-источник."""
+        while not stop.wait(interval):
+            if self.store.changed():
+                self.try_reload()
+
+
+def open_directory(source: str = USERS_FILE, cache_size: int = USERS_CACHE_SIZE,
+                   factory: Callable[..., Any] = User) -> Directory:
+    return Directory(UserStore(source), cache_size, factory)
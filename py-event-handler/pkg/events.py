@@ -0,0 +1,185 @@
+import importlib
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import metrics
+from models import EVENT_CODES, Event
+
+logger = logging.getLogger()
+
+# Реестр типов событий. Тип регистрируется один раз: имя, поля, разбор
+# строки текстового файла, проверка JSON-объекта и обработчик. Парсер,
+# декодер JSON, TCP-кадры и журнал получают из реестра код типа
+# (Event.code), а обработчики вызывают dispatch_table(cls)[event.code] без
+# сравнения строк: новый тип не требует правок ни в одном из серверов.
+#
+# Коды раздаются по порядку регистрации и попадают в журнал (wal.py) и в
+# TCP-кадры (wire.py): ssh, sudo и dir - всегда 1, 2, 3, код 0 не занят
+# (конец потока в wire.py, "прочие" в метриках). Дополнительные типы
+# регистрируются модулями из EVENT_PLUGINS (через запятую, в sys.path) при
+# импорте реестра; чтобы журнал читался после перезапуска, список и порядок
+# модулей должны оставаться теми же.
+#
+# handler - имя метода CurrentUser ("handle_ssh"), который есть у каждого
+# варианта пользователя (session.CurrentUser, SharedCurrentUser,
+# CurrentUser asyncio-обработчика), или функция (cu, stream_id, event).
+# У класса без такого метода событие только считается.
+
+EVENT_PLUGINS = os.environ.get("EVENT_PLUGINS", "")
+
+FIELDS = ("name", "passwd")
+
+
+class EventType:
+    __slots__ = ("name", "code", "fields", "parse", "validate", "handler", "counter")
+
+    def __init__(self, name: str, code: int, fields: Sequence[str],
+                 parse: Callable[[List[str]], Optional[Event]],
+                 validate: Callable[[dict], Optional[str]],
+                 handler: Union[str, Callable[[Any, str, Event], None]], counter: int):
+        self.name = name
+        self.code = code
+        self.fields = tuple(fields)
+        # части строки файла "type,..." -> Event или None, если строка неполная
+        self.parse = parse
+        # JSON-объект события -> текст ошибки или None
+        self.validate = validate
+        self.handler = handler
+        # столбец events_total в строке метрик
+        self.counter = counter
+
+    def __repr__(self):
+        return f"EventType(name='{self.name}', code={self.code}, fields={self.fields})"
+
+
+# индекс - код типа; 0 - заглушка
+EVENT_TYPES: List[Optional[EventType]] = [None]
+_by_name: Dict[str, EventType] = {}
+# таблицы вызовов по классу пользователя, см. dispatch_table
+_tables: Dict[type, List[Callable[[Any, str, Event], None]]] = {}
+# обёртки обработчиков по коду типа, см. wrap
+_wrappers: Dict[int, List[Callable]] = {}
+
+
+def positional(name: str, fields: Sequence[str]) -> Callable[[List[str]], Optional[Event]]:
+    """Разбор строки файла: поля события идут после типа по порядку."""
+    need = len(fields) + 1
+    name_at = fields.index("name") + 1 if "name" in fields else 0
+    passwd_at = fields.index("passwd") + 1 if "passwd" in fields else 0
+
+    def parse(parts: List[str]) -> Optional[Event]:
+        if len(parts) < need:
+            return None
+        return Event(name, parts[name_at] if name_at else "", parts[passwd_at] if passwd_at else "")
+    return parse
+
+
+def required(fields: Sequence[str]) -> Callable[[dict], Optional[str]]:
+    """Проверка JSON: все поля события есть и это строки."""
+    def validate(ev: dict) -> Optional[str]:
+        for key in fields:
+            if not isinstance(ev.get(key), str):
+                return f"requires string field {key}"
+        return None
+    return validate
+
+
+def register(name: str, fields: Sequence[str] = (),
+             handler: Union[str, Callable[[Any, str, Event], None], None] = None,
+             parse: Optional[Callable[[List[str]], Optional[Event]]] = None,
+             validate: Optional[Callable[[dict], Optional[str]]] = None) -> EventType:
+    """Новый тип события; код - следующий свободный.
+
+    По умолчанию строка файла разбирается по fields (positional), JSON
+    проверяется на строковые fields (required), обработчик - метод
+    handle_<name> пользователя. Событие хранит только name и passwd, поэтому
+    fields - из них.
+    """
+    if name in _by_name:
+        raise ValueError(f"event type {name} is already registered")
+    if not name or "," in name:
+        raise ValueError(f"bad event type name {name!r}")
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"event type {name}: unknown fields {sorted(unknown)}")
+    if len(EVENT_TYPES) > 0xFF:
+        raise ValueError("too many event types: the code is one byte in the log and TCP frames")
+
+    counter = metrics.EVENT_COUNTER_BY_TYPE.get(name, metrics.EVENTS_OTHER)
+    etype = EventType(
+        name, len(EVENT_TYPES), fields,
+        parse if parse is not None else positional(name, fields),
+        validate if validate is not None else required(fields),
+        handler if handler is not None else f"handle_{name}",
+        counter,
+    )
+    EVENT_TYPES.append(etype)
+    _by_name[name] = etype
+    EVENT_CODES[name] = etype.code
+    metrics.EVENT_COUNTERS.append(counter)
+    return etype
+
+
+def lookup(name: str) -> Optional[EventType]:
+    return _by_name.get(name)
+
+
+def name_of(code: int) -> str:
+    """Имя типа по коду; "" для кода, которого нет в реестре (например,
+    журнал записан с другим EVENT_PLUGINS): такое событие только считается."""
+    return EVENT_TYPES[code].name if 0 < code < len(EVENT_TYPES) else ""
+
+
+def _noop(cu, stream_id: str, event: Event) -> None:
+    pass
+
+
+def _bind(etype: Optional[EventType], cls: type) -> Callable[[Any, str, Event], None]:
+    if etype is None:
+        return _noop
+    if callable(etype.handler):
+        handler = etype.handler
+    else:
+        # метод класса как функция (cu, stream_id, event): без связывания на каждом вызове
+        handler = getattr(cls, etype.handler, _noop)
+    for wrapper in _wrappers.get(etype.code, ()):
+        handler = wrapper(handler)
+    return handler
+
+
+def wrap(etype: EventType, wrapper: Callable[[Callable], Callable]) -> None:
+    """Обернуть обработчик типа во всех таблицах: wrapper(handler) -> handler.
+
+    Так в обработку встраиваются сквозные проверки (detector.py), не трогая
+    ни обработчики типов, ни серверы. Вызывать до обработки событий: уже
+    выданные таблицы не меняются, новые строятся с обёрткой.
+    """
+    _wrappers.setdefault(etype.code, []).append(wrapper)
+    _tables.clear()
+
+
+def dispatch_table(cls: type) -> List[Callable[[Any, str, Event], None]]:
+    """Обработчики для пользователей класса cls, индекс - код типа.
+
+    Строится один раз на класс и перестраивается, если после этого
+    зарегистрировали новые типы.
+    """
+    table = _tables.get(cls)
+    if table is None or len(table) != len(EVENT_TYPES):
+        table = _tables[cls] = [_bind(etype, cls) for etype in EVENT_TYPES]
+    return table
+
+
+def load_plugins(modules: str = EVENT_PLUGINS) -> None:
+    for module in filter(None, (m.strip() for m in modules.split(","))):
+        importlib.import_module(module)
+        logger.info("Типы событий из %s зарегистрированы", module)
+
+
+# как и go-data-handler: аргумент sudo - это пароль
+SSH = register("ssh", ("name", "passwd"))
+SUDO = register("sudo", ("passwd",))
+DIR = register("dir", ())
+
+load_plugins()
@@ -0,0 +1,16 @@
+# Типы событий сверх ssh/sudo/dir, подключаются через EVENT_PLUGINS=extra_events.
+#
+#   logout        - выход из текущего пользователя, не дожидаясь конца потока;
+#   scp,<passwd>  - копирование файла: как и sudo, только с паролем текущего
+#                   пользователя; обработчика у пользователей нет, событие
+#                   проверяется при разборе и считается в events_total{type="other"}.
+
+from events import register
+
+
+def logout(cu, stream_id: str, event) -> None:
+    cu.logout(stream_id)
+
+
+LOGOUT = register("logout", (), handler=logout)
+SCP = register("scp", ("passwd",))
@@ -0,0 +1,117 @@
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from typing import Optional
+
+# Режимы логирования обработчиков (LOG_MODE):
+#   sync  - как раньше, StreamHandler пишет в stderr прямо из обработчика;
+#   queue - обработчик только кладёт запись в очередь, форматирует и пишет
+#           пачками отдельный поток-писатель;
+#   off   - логирование выключено (для замеров без логов).
+# LOG_LEVEL=ERROR отсекает info-сообщения горячего пути ещё до создания записи.
+
+FORMAT = "%(levelname)s: %(message)s"
+LOG_MODE = os.environ.get("LOG_MODE", "sync")
+LOG_LEVEL = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+LOG_BATCH = int(os.environ.get("LOG_BATCH", 256))
+LOG_FLUSH_MS = int(os.environ.get("LOG_FLUSH_MS", 50))
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в горячем пути.
+
+    Стандартный prepare() собирает сообщение сразу; здесь запись уходит
+    в очередь как есть, а msg % args выполняет писатель.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # traceback не переживает передачу в другой процесс
+            return super().prepare(record)
+        return record
+
+
+class BatchingListener:
+    def __init__(self, q, handler: logging.Handler, batch_size: int = 256, flush_interval: float = 0.05):
+        self.queue = q
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                done = True
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch) -> None:
+        handler = self.handler
+        lines = []
+        for record in batch:
+            if record.levelno >= handler.level:
+                lines.append(handler.format(record))
+        if not lines:
+            return
+        stream = handler.stream
+        with handler.lock:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+
+def setup_logging(mode: str = LOG_MODE, level: int = LOG_LEVEL, batch_size: int = LOG_BATCH,
+                  flush_interval: float = LOG_FLUSH_MS / 1000, stream=None,
+                  multiprocess: bool = False) -> Optional[BatchingListener]:
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.setLevel(level)
+    logging.disable(logging.NOTSET)
+
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    if mode == "off":
+        logging.disable(logging.CRITICAL)
+        root.addHandler(handler)
+        return None
+    if mode == "sync":
+        root.addHandler(handler)
+        return None
+    if mode != "queue":
+        raise ValueError(f"unknown log mode {mode}")
+
+    # воркеры-процессы пишут в ту же очередь, поэтому она межпроцессная
+    q = multiprocessing.Queue() if multiprocess else queue.SimpleQueue()
+    root.addHandler(LazyQueueHandler(q))
+    listener = BatchingListener(q, handler, batch_size, flush_interval)
+    listener.start()
+    return listener
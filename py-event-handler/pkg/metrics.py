@@ -0,0 +1,419 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger()
+
+# Метрики обработчиков для /metrics в текстовом формате Prometheus.
+#
+# Счётчики и гистограммы лежат в плоской строке целых чисел фиксированной
+# раскладки. Каждый поток (Metrics) пишет только в свою строку-шард без
+# блокировок; /metrics складывает строки по столбцам. Строка умершего потока
+# возвращается в пул и достаётся новому потоку вместе с накопленными
+# значениями, так что счётчики не теряются. У SharedMetrics строка одна на
+# процесс, а пишут в неё все его потоки (сервер Flask, пул asyncio), поэтому
+# её шард берёт блокировку: += над общей памятью не атомарен.
+#
+# Гистограммы в духе HDR: значения в наносекундах раскладываются по
+# степеням двойки, каждая из которых делится на 2**SUB_BITS линейных
+# корзин, то есть относительная ошибка не больше 1/2**SUB_BITS. В /metrics
+# уходят не все корзины, а постоянный набор границ RENDER_BUCKETS.
+
+PREFIX = "event_handler_"
+
+COUNTERS = (
+    ("streams_accepted_total", ""),
+    ("streams_rejected_total", 'reason="decode"'),
+    ("streams_rejected_total", 'reason="limit"'),
+    ("streams_rejected_total", 'reason="queue_full"'),
+    ("streams_rejected_total", 'reason="shutdown"'),
+    ("events_total", 'type="ssh"'),
+    ("events_total", 'type="sudo"'),
+    ("events_total", 'type="dir"'),
+    ("events_total", 'type="other"'),
+    ("auth_failures_total", 'event="ssh"'),
+    ("auth_failures_total", 'event="sudo"'),
+    ("lockouts_total", ""),
+    ("streams_offloaded_total", ""),
+    ("detector_alerts_total", 'kind="user"'),
+    ("detector_alerts_total", 'kind="stream"'),
+    ("detector_alerts_total", 'kind="spray"'),
+    ("detector_blocked_total", ""),
+)
+(STREAMS_ACCEPTED, REJECTED_DECODE, REJECTED_LIMIT, REJECTED_QUEUE_FULL, REJECTED_SHUTDOWN,
+ EVENTS_SSH, EVENTS_SUDO, EVENTS_DIR, EVENTS_OTHER, SSH_FAILURES, SUDO_FAILURES, LOCKOUTS,
+ STREAMS_OFFLOADED, ALERTS_USER, ALERTS_STREAM, ALERTS_SPRAY, DETECTOR_BLOCKED) = range(len(COUNTERS))
+# столбец events_total по коду типа события; дополняет events.register,
+# типы без своего столбца считаются в type="other"
+EVENT_COUNTER_BY_TYPE = {"ssh": EVENTS_SSH, "sudo": EVENTS_SUDO, "dir": EVENTS_DIR}
+EVENT_COUNTERS: List[int] = [EVENTS_OTHER]
+
+HISTOGRAMS = (
+    ("request_duration_seconds", 'path="/"'),
+    ("request_duration_seconds", 'path="/batch"'),
+    ("handle_stream_duration_seconds", ""),
+    ("event_append_duration_seconds", ""),
+    ("event_loop_lag_seconds", ""),
+    # пишутся только в окне трассировки (tracing.py)
+    ("trace_stage_duration_seconds", 'stage="decode"'),
+    ("trace_stage_duration_seconds", 'stage="dispatch"'),
+    ("trace_stage_duration_seconds", 'stage="lock_wait"'),
+    ("trace_stage_duration_seconds", 'stage="log"'),
+    ("trace_handler_duration_seconds", 'type="ssh"'),
+    ("trace_handler_duration_seconds", 'type="sudo"'),
+    ("trace_handler_duration_seconds", 'type="dir"'),
+    ("trace_handler_duration_seconds", 'type="other"'),
+)
+(REQUEST_STREAM, REQUEST_BATCH, HANDLE_STREAM, EVENT_APPEND, LOOP_LAG,
+ STAGE_DECODE, STAGE_DISPATCH, STAGE_LOCK_WAIT, STAGE_LOG,
+ HANDLER_SSH, HANDLER_SUDO, HANDLER_DIR, HANDLER_OTHER) = range(len(HISTOGRAMS))
+# гистограмма обработчика по столбцу events_total типа
+HANDLER_BY_COUNTER = {EVENTS_SSH: HANDLER_SSH, EVENTS_SUDO: HANDLER_SUDO, EVENTS_DIR: HANDLER_DIR,
+                      EVENTS_OTHER: HANDLER_OTHER}
+
+HELP = {
+    "streams_accepted_total": "Принятые потоки",
+    "streams_rejected_total": "Отклонённые потоки по причине",
+    "events_total": "Обработанные события по типу",
+    "auth_failures_total": "Неверные пароли",
+    "lockouts_total": "Блокировки пользователей после трёх ошибок",
+    "request_duration_seconds": "Время обработки HTTP-запроса",
+    "handle_stream_duration_seconds": "Время handle_stream",
+    "event_append_duration_seconds": "Время обработки события, дописанного в открытый поток",
+    "streams_offloaded_total": "Потоки, обработанные в пуле потоков, а не в цикле событий",
+    "detector_alerts_total": "Срабатывания детектора подбора паролей (detector.py)",
+    "detector_blocked_total": "Входы, отклонённые блокировкой детектора",
+    "event_loop_lag_seconds": "Опоздание пробуждения цикла событий: сколько он был занят",
+    "trace_stage_duration_seconds": "Время этапа обработки в окнах трассировки",
+    "trace_handler_duration_seconds": "Время обработчика события по типу в окнах трассировки",
+    "queue_depth": "Потоки, принятые, но ещё не обработанные",
+    "sessions_open": "Открытые потоки с поштучной подачей событий",
+}
+
+SUB_BITS = 4
+SUB = 1 << SUB_BITS
+MAX_BITS = 40  # ~18 минут в наносекундах, всё дольше - в последнюю корзину
+NBUCKETS = (MAX_BITS - SUB_BITS + 1) * SUB
+# корзины гистограммы и сумма значений
+HIST_SIZE = NBUCKETS + 1
+HIST_OFF = len(COUNTERS)
+ROW_SIZE = HIST_OFF + len(HISTOGRAMS) * HIST_SIZE
+
+
+def bucket_of(ns: int) -> int:
+    if ns < SUB:
+        return ns if ns > 0 else 0
+    shift = ns.bit_length() - SUB_BITS - 1
+    i = (shift + 1) * SUB + (ns >> shift) - SUB
+    return i if i < NBUCKETS else NBUCKETS - 1
+
+
+def bucket_upper(i: int) -> int:
+    """Верхняя граница корзины (не включительно), нс."""
+    if i < SUB:
+        return i + 1
+    shift = i // SUB - 1
+    return (i % SUB + SUB + 1) << shift
+
+
+class Shard:
+    __slots__ = ("row", "__weakref__")
+
+    def __init__(self, row):
+        self.row = row
+
+    def inc(self, counter: int, n: int = 1) -> None:
+        self.row[counter] += n
+
+    def observe(self, hist: int, ns: int) -> None:
+        row = self.row
+        base = HIST_OFF + hist * HIST_SIZE
+        row[base + bucket_of(ns)] += 1
+        row[base + NBUCKETS] += ns
+
+    def count_events(self, counts: List[int], cu) -> None:
+        """События по кодам типов (counts[code]) и ошибки из CurrentUser."""
+        row = self.row
+        for counter, n in zip(EVENT_COUNTERS, counts):
+            if n:
+                row[counter] += n
+        self.count_failures(cu)
+
+    def count_failures(self, cu) -> None:
+        row = self.row
+        if cu.ssh_failures:
+            row[SSH_FAILURES] += cu.ssh_failures
+            row[LOCKOUTS] += cu.lockouts
+        if cu.sudo_failures:
+            row[SUDO_FAILURES] += cu.sudo_failures
+
+    def stream_done(self, elapsed_ns: int, counts: List[int], cu) -> None:
+        """Итог одного handle_stream: время, события по типам и ошибки из CurrentUser."""
+        self.count_events(counts, cu)
+        self.observe(HANDLE_STREAM, elapsed_ns)
+
+
+class LockedShard(Shard):
+    """Шард строки, в которую пишут несколько потоков одного процесса."""
+
+    __slots__ = ("lock",)
+
+    def __init__(self, row):
+        super().__init__(row)
+        # RLock: stream_done и count_events вызывают остальные методы
+        self.lock = threading.RLock()
+
+    def inc(self, counter: int, n: int = 1) -> None:
+        with self.lock:
+            self.row[counter] += n
+
+    def observe(self, hist: int, ns: int) -> None:
+        with self.lock:
+            super().observe(hist, ns)
+
+    def count_events(self, counts: List[int], cu) -> None:
+        with self.lock:
+            super().count_events(counts, cu)
+
+    def count_failures(self, cu) -> None:
+        with self.lock:
+            super().count_failures(cu)
+
+    def stream_done(self, elapsed_ns: int, counts: List[int], cu) -> None:
+        with self.lock:
+            super().stream_done(elapsed_ns, counts, cu)
+
+
+class Metrics:
+    """Шарды по потокам внутри одного процесса."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._rows: List[List[int]] = []
+        self._free: List[List[int]] = []
+        self._lock = threading.Lock()
+
+    def shard(self) -> Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+        try:
+            row = self._free.pop()
+        except IndexError:
+            row = [0] * ROW_SIZE
+            with self._lock:
+                self._rows.append(row)
+        shard = self._local.shard = Shard(row)
+        # поток завершился - строка освобождается вместе с его threading.local
+        weakref.finalize(shard, self._free.append, row)
+        return shard
+
+    def snapshot(self) -> List[int]:
+        with self._lock:
+            rows = list(self._rows)
+        return _sum_rows(rows)
+
+
+class SharedMetrics:
+    """Шарды по процессам-воркерам: строка на процесс в общей памяти.
+
+    Строки выделяются по порядку первого shard() в процессе, rows - число
+    процессов, которые будут писать (воркеры и, если пишет, главный).
+    """
+
+    def __init__(self, rows: int):
+        self.rows = rows
+        self._raw = multiprocessing.RawArray("Q", rows * ROW_SIZE)
+        self._next = multiprocessing.Value("i", 0)
+        self._pid: Optional[int] = None
+        self._shard: Optional[Shard] = None
+
+    def __getstate__(self):
+        return {"rows": self.rows, "raw": self._raw, "next": self._next}
+
+    def __setstate__(self, state):
+        self.rows = state["rows"]
+        self._raw = state["raw"]
+        self._next = state["next"]
+        self._pid = None
+        self._shard = None
+
+    def shard(self) -> Shard:
+        if self._pid == os.getpid():
+            return self._shard
+        with self._next.get_lock():
+            i = self._next.value
+            self._next.value += 1
+        # воркеров больше, чем строк, быть не должно; иначе делим строку
+        i %= self.rows
+        view = memoryview(self._raw).cast("B").cast("Q")
+        self._shard = LockedShard(view[i * ROW_SIZE:(i + 1) * ROW_SIZE])
+        self._pid = os.getpid()
+        return self._shard
+
+    def snapshot(self) -> List[int]:
+        view = memoryview(self._raw).cast("B").cast("Q")
+        return _sum_rows([view[i * ROW_SIZE:(i + 1) * ROW_SIZE] for i in range(self.rows)])
+
+
+def _sum_rows(rows) -> List[int]:
+    total = [0] * ROW_SIZE
+    for row in rows:
+        for i, v in enumerate(row):
+            if v:
+                total[i] += v
+    return total
+
+
+def merge(*snapshots: List[int]) -> List[int]:
+    return [sum(col) for col in zip(*snapshots)]
+
+
+def hist_count(snapshot: List[int], hist: int) -> int:
+    base = HIST_OFF + hist * HIST_SIZE
+    return sum(snapshot[base:base + NBUCKETS])
+
+
+def hist_sum_ns(snapshot: List[int], hist: int) -> int:
+    return snapshot[HIST_OFF + hist * HIST_SIZE + NBUCKETS]
+
+
+def quantile_ns(snapshot: List[int], hist: int, q: float) -> int:
+    """Оценка квантиля сверху: граница корзины, в которую он попал."""
+    base = HIST_OFF + hist * HIST_SIZE
+    buckets = snapshot[base:base + NBUCKETS]
+    total = sum(buckets)
+    if not total:
+        return 0
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if n and seen >= rank:
+            return bucket_upper(i)
+    return bucket_upper(NBUCKETS - 1)
+
+
+def summary(snapshot: List[int]) -> str:
+    """Строка итогов handle_stream для лога при завершении."""
+    count = hist_count(snapshot, HANDLE_STREAM)
+    total = hist_sum_ns(snapshot, HANDLE_STREAM)
+    return (
+        f"Полное чистое время обработки: {total/1e3:.3f} мкс, "
+        f"среднее на поток: {total/max(count, 1)/1e3:.3f} мкс, "
+        f"p50 {quantile_ns(snapshot, HANDLE_STREAM, 0.5)/1e3:.3f} мкс, "
+        f"p99 {quantile_ns(snapshot, HANDLE_STREAM, 0.99)/1e3:.3f} мкс"
+    )
+
+
+def window_summary(snapshot: List[int], seconds: float) -> str:
+    """Строка за окно отчёта: snapshot - разность двух снимков."""
+    count = hist_count(snapshot, HANDLE_STREAM)
+    rejected = sum(snapshot[REJECTED_DECODE:REJECTED_SHUTDOWN + 1])
+    line = (
+        f"За {seconds:.0f} с: принято {snapshot[STREAMS_ACCEPTED]}, отклонено {rejected}, "
+        f"обработано {count} ({count/max(seconds, 1e-9):.1f}/с), "
+        f"среднее {hist_sum_ns(snapshot, HANDLE_STREAM)/max(count, 1)/1e3:.3f} мкс, "
+        f"p50 {quantile_ns(snapshot, HANDLE_STREAM, 0.5)/1e3:.3f} мкс, "
+        f"p99 {quantile_ns(snapshot, HANDLE_STREAM, 0.99)/1e3:.3f} мкс"
+    )
+    # задержку цикла событий меряет только asyncio-обработчик
+    if hist_count(snapshot, LOOP_LAG):
+        line += (f", в пул {snapshot[STREAMS_OFFLOADED]}, задержка цикла "
+                 f"p99 {quantile_ns(snapshot, LOOP_LAG, 0.99)/1e6:.3f} мс, "
+                 f"макс. {quantile_ns(snapshot, LOOP_LAG, 1.0)/1e6:.3f} мс")
+    return line
+
+
+class WindowReporter:
+    """Периодический отчёт о времени обработки за последнее окно.
+
+    Хранит только предыдущий снимок, так что память не растёт со временем
+    работы. interval=0 отключает отчёты.
+    """
+
+    def __init__(self, snapshot: Callable[[], List[int]], interval: float):
+        self.snapshot = snapshot
+        self.interval = interval
+        self._prev = snapshot()
+        self._prev_t = time.monotonic()
+
+    def report(self) -> None:
+        cur = self.snapshot()
+        now = time.monotonic()
+        delta = [c - p for c, p in zip(cur, self._prev)]
+        logger.info(window_summary(delta, now - self._prev_t))
+        self._prev, self._prev_t = cur, now
+
+    def wait(self, event, timeout: Optional[float] = None) -> bool:
+        """Ждёт event (threading или multiprocessing), отчитываясь каждые interval секунд.
+
+        Возвращает False, если вышел timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            step = self.interval or None
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                step = min(step, left) if step else left
+            if event.wait(step):
+                return True
+            if self.interval and time.monotonic() - self._prev_t >= self.interval:
+                self.report()
+
+
+INF = 'le="+Inf"'
+# границы le в /metrics: конец каждой степени двойки от 16 нс до 2**39 нс,
+# последняя корзина собирает и всё дольше, её покрывает +Inf. Набор один и
+# тот же на каждом опросе, иначе rate() и histogram_quantile() по корзинам
+# видят появление и пропажу рядов
+RENDER_BUCKETS = [(i, f'le="{bucket_upper(i) / 1e9:.9g}"') for i in range(SUB - 1, NBUCKETS - 1, SUB)]
+
+
+def _labels(labels: str, extra: str = "") -> str:
+    inner = ",".join(s for s in (labels, extra) if s)
+    return "{" + inner + "}" if inner else ""
+
+
+def render(snapshot: List[int], gauges: Dict[str, float] = None) -> str:
+    lines = []
+    seen = set()
+    for i, (name, labels) in enumerate(COUNTERS):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {PREFIX}{name} {HELP[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+        lines.append(f"{PREFIX}{name}{_labels(labels)} {snapshot[i]}")
+
+    for name, value in (gauges or {}).items():
+        lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        lines.append(f"{PREFIX}{name} {value}")
+
+    for h, (name, labels) in enumerate(HISTOGRAMS):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {PREFIX}{name} {HELP[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+        base = HIST_OFF + h * HIST_SIZE
+        cumulative = 0
+        start = base
+        for i, le in RENDER_BUCKETS:
+            cumulative += sum(snapshot[start:base + i + 1])
+            start = base + i + 1
+            lines.append(f"{PREFIX}{name}_bucket{_labels(labels, le)} {cumulative}")
+        cumulative += sum(snapshot[start:base + NBUCKETS])
+        lines.append(f"{PREFIX}{name}_bucket{_labels(labels, INF)} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {snapshot[base + NBUCKETS] / 1e9:.9f}")
+        lines.append(f"{PREFIX}{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
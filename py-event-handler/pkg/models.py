@@ -1,41 +1,68 @@
-from dataclasses import dataclass, field
-from typing import List, Dict
-import asyncio
+import sys
+import threading
+from dataclasses import InitVar, dataclass, field
+from typing import Dict, List, Optional
+
+from credentials import Credential
+
+# Event и Stream общие для парсера и всех обработчиков, User - для каталога
+# пользователей (directory.py). __slots__ убирает __dict__ у каждого события,
+# а повторяющиеся строки хранятся одной копией: тип события интернируется,
+# если он есть в реестре, имя берётся из NAMES, если такой пользователь уже
+# загружен из каталога. Имена, которых в каталоге нет, и пароли не
+# интернируются: таблица росла бы с каждой попыткой (на 3.12+ интернированные
+# строки бессмертны), а пароли перебора жили бы в памяти до конца процесса.
+# code - код типа из реестра (events.py), 0 у незарегистрированного типа.
+
+# заполняет events.register
+EVENT_CODES: Dict[str, int] = {}
+# имена загруженных пользователей каталога, заполняет User
+NAMES: Dict[str, str] = {}
+
 
 class Event:
+    __slots__ = ("type", "name", "passwd", "code")
+
     def __init__(self, type_: str, name: str = "", passwd: str = ""):
-        self.type = type_
-        self.name = name
+        code = EVENT_CODES.get(type_, 0)
+        self.type = sys.intern(type_) if code else type_
+        self.code = code
+        self.name = NAMES.get(name, name)
         self.passwd = passwd
 
     def __repr__(self):
         return f"Event(type='{self.type}', name='{self.name}', passwd='{self.passwd}')"
 
 class Stream:
+    __slots__ = ("stream_id", "events", "accepted_ns")
+
     def __init__(self, stream_id: str, events: List[Event]):
         self.stream_id = stream_id
         self.events = events if events is not None else []
+        # время приёма (perf_counter_ns) в окне трассировки, иначе 0; см. tracing.py
+        self.accepted_ns = 0
 
     def __repr__(self):
         return f"Stream(stream_id='{self.stream_id}', events={self.events})"
 
+
 @dataclass
 class User:
+    """Пользователь каталога (directory.py) с состоянием авторизации.
+
+    Пароль в открытом виде только на входе, хранится PBKDF2 (credentials);
+    каталог, где лежат уже хеши, передаёт готовый cred.
+    """
     name: str
-    passwd: str
+    passwd: InitVar[str] = ""
     authd: str = ""
     auth_retries: int = 0
-    mu: asyncio.Lock = field(default_factory=asyncio.Lock)
-
-USERS: Dict[int, User] = {
-    0: User(name="superadmin", passwd="P@ssw0rd!"),
-    1: User(name="auditor", passwd="Secur3!2023"),
-    2: User(name="dev_user", passwd="d3v3l0p3r"),
-    3: User(name="tester", passwd="t3st3r!123"),
-    4: User(name="analyst", passwd="Data2023!"),
-    5: User(name="support", passwd="HelpDesk!"),
-    6: User(name="reports", passwd="R3port$"),
-    7: User(name="backup", passwd="B@ckUp123"),
-    8: User(name="api_user", passwd="Ap1K3y!2023"),
-    9: User(name="guest", passwd="T3mpPass!")
-}
+    # блокировка asyncio-обработчика; threading и multiprocessing берут
+    # полосы блокировок по uid
+    mu: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    cred: Optional[Credential] = field(default=None, repr=False)
+
+    def __post_init__(self, passwd: str):
+        self.name = NAMES.setdefault(self.name, self.name)
+        if self.cred is None:
+            self.cred = Credential.create(passwd)
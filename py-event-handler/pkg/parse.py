@@ -1,8 +1,7 @@
 import logging
-from typing import List
-from dataclasses import dataclass, field
-import asyncio
-from models import Event, Stream, USERS
+from typing import Iterator, List, Optional, Tuple
+from events import lookup
+from models import Event, Stream
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,6 +9,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_event(line: str) -> Optional[Event]:
+    parts = line.split(',')
+    etype = lookup(parts[0])
+    return etype.parse(parts) if etype is not None else None
+
+
 def parse_streams(data: str) -> List[Stream]:
     streams = []
     stream_blocks = data.strip().split('#')[1:]
@@ -27,21 +35,65 @@ def parse_streams(data: str) -> List[Stream]:
             if not line.strip():
                 continue
 
-            parts = line.split(',')
-            if parts[0] == 'ssh':
-                if len(parts) >= 3:
-                    events.append(Event(type_='ssh', name=parts[1], passwd=parts[2]))
-            elif parts[0] == 'sudo':
-                if len(parts) >= 2:
-                    events.append(Event(type_='sudo', name=parts[1]))
-            elif parts[0] == 'dir':
-                events.append(Event(type_='dir'))
+            event = parse_event(line.strip())
+            if event is not None:
+                events.append(event)
 
         streams.append(Stream(stream_id=stream_id, events=events))
 
     return streams
 
 
+def iter_events(file_path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[str, Optional[Event]]]:
+    """Читает файл кусками по chunk_size и отдаёт (stream_id, event) по мере разбора.
+
+    Начало каждого потока отдаётся как (stream_id, None), поэтому пустые потоки
+    не теряются. Строка, разрезанная границей куска, доклеивается к следующему.
+    Память ограничена размером куска и одной строки, а не размером файла.
+    """
+    stream_id = None
+    tail = ""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line.startswith('#'):
+                    stream_id = line[1:]
+                    yield stream_id, None
+                elif line and stream_id is not None:
+                    event = parse_event(line)
+                    if event is not None:
+                        yield stream_id, event
+
+    line = tail.strip()
+    if line.startswith('#'):
+        yield line[1:], None
+    elif line and stream_id is not None:
+        event = parse_event(line)
+        if event is not None:
+            yield stream_id, event
+
+
+def iter_streams(file_path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Stream]:
+    """Отдаёт Stream, как только встречен заголовок следующего потока."""
+    stream = None
+    for stream_id, event in iter_events(file_path, chunk_size):
+        if event is None:
+            if stream is not None:
+                yield stream
+            stream = Stream(stream_id=stream_id, events=[])
+        else:
+            stream.events.append(event)
+
+    if stream is not None:
+        yield stream
+
+
 def read_and_parse_file(file_path: str) -> List[Stream]:
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
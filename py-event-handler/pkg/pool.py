@@ -0,0 +1,145 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger()
+
+# Пулы заранее запущенных воркеров с ограниченной очередью. По умолчанию
+# submit() не блокируется: если очередь заполнена, возвращает False, и сервер
+# отвечает 503 вместо того, чтобы плодить новые потоки/процессы на каждый
+# запрос. block=True нужен чтению из файла, где ждать воркеров - нормально.
+#
+# shutdown(timeout) - мягкая остановка: уже принятое дорабатывается, но не
+# дольше timeout секунд; возвращается число воркеров, которые не успели.
+
+
+class ThreadWorkerPool:
+    def __init__(self, target: Callable, workers: int, queue_size: int, args: Tuple = ()):
+        self.target = target
+        self.args = args
+        self.size = workers
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers: List[threading.Thread] = []
+
+    def start(self) -> None:
+        for i in range(self.size):
+            t = threading.Thread(target=self._run, name=f"worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, item: Any, block: bool = False) -> bool:
+        try:
+            self._queue.put(item, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def full(self) -> bool:
+        return self._queue.full()
+
+    def shutdown(self, timeout: Optional[float] = None) -> int:
+        # стоп-маркеры встают в очередь после уже принятых задач,
+        # так что всё принятое будет обработано
+        deadline = None if timeout is None else time.monotonic() + timeout
+        _put_sentinels(self._queue, len(self._workers), deadline)
+        left = 0
+        for t in self._workers:
+            t.join(_remaining(deadline))
+            if t.is_alive():
+                # потоки-демоны, процесс завершится и без них
+                left += 1
+        self._workers.clear()
+        return left
+
+    def _run(self) -> None:
+        _worker_loop(self._queue, self.target, self.args)
+
+
+class ProcessWorkerPool:
+    def __init__(self, target: Callable, workers: int, queue_size: int, args: Tuple = ()):
+        self.target = target
+        self.args = args
+        self.size = workers
+        self._queue = multiprocessing.Queue(maxsize=queue_size)
+        self._workers: List[multiprocessing.Process] = []
+
+    def start(self) -> None:
+        for i in range(self.size):
+            p = multiprocessing.Process(
+                target=_process_loop,
+                args=(self._queue, self.target, self.args),
+                name=f"worker-{i}",
+                daemon=True,
+            )
+            p.start()
+            self._workers.append(p)
+
+    def submit(self, item: Any, block: bool = False) -> bool:
+        try:
+            self._queue.put(item, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def full(self) -> bool:
+        return self._queue.full()
+
+    def shutdown(self, timeout: Optional[float] = None) -> int:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        _put_sentinels(self._queue, len(self._workers), deadline)
+        left = 0
+        for p in self._workers:
+            p.join(_remaining(deadline))
+            if p.is_alive():
+                # SIGTERM воркеры игнорируют, см. _process_loop
+                p.kill()
+                p.join()
+                left += 1
+        if left:
+            # недоставленные в очередь задачи не должны держать выход
+            self._queue.cancel_join_thread()
+        self._workers.clear()
+        return left
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def _put_sentinels(q, n: int, deadline: Optional[float]) -> None:
+    for _ in range(n):
+        try:
+            q.put(None, timeout=_remaining(deadline))
+        except queue.Full:
+            return
+
+
+def _process_loop(q, target: Callable, args: Tuple) -> None:
+    # останавливает воркеры родитель через стоп-маркеры: сигнал, пришедший
+    # всей группе процессов, не должен обрывать недоработанные потоки;
+    # SIGUSR1 (трассировка, tracing.py) тоже обрабатывает родитель
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    _worker_loop(q, target, args)
+
+
+def _worker_loop(q, target: Callable, args: Tuple) -> None:
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        try:
+            target(item, *args)
+        except Exception as e:
+            logger.error(f"Ошибка в воркере: {e}")
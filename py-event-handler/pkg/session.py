@@ -0,0 +1,168 @@
+import logging
+import threading
+from typing import List
+
+from credentials import VERIFIER
+from tracing import TRACER
+from user_index import UserIndex
+
+logger = logging.getLogger()
+
+# Состояние сессий для threading-обработчика.
+#
+# Блокировки не висят на каждом пользователе, а раздаются полосами:
+# пользователь uid защищается stripes[uid % N]. Только переходы авторизации
+# (вход, неверный пароль, выход из предыдущего пользователя) идут под
+# блокировкой; при входе берутся сразу обе полосы - нового и предыдущего
+# пользователя - всегда в порядке возрастания номера, так что взаимных
+# блокировок нет, а выход из предыдущего пользователя больше не гонка.
+#
+# Проверки без блокировок:
+#   - "уже вошёл": authd == stream_id может выставить и снять только сам
+#     этот поток, поэтому чтение без блокировки даёт точный ответ;
+#   - "занят другим потоком" и "заблокирован" отказывают по снимку состояния
+#     и перепроверяются под блокировкой перед входом;
+#   - sudo и dir читают только неизменяемые name/cred.
+# Каждая смена authd или auth_retries под полосой отмечается users.mark():
+# каталог (directory.py) держит грязных пользователей вне LRU.
+# Пароль проверяется (PBKDF2 или кэш, см. credentials) до захвата полос:
+# cred не меняется, а держать полосу миллисекунды хеширования незачем.
+# Полосы захватываются в горячем пути напрямую, без вызова методов, а
+# захваты с ожиданием считаются, чтобы конкуренцию можно было измерить.
+
+LOCK_STRIPES = 64
+
+
+class LockStripes:
+    def __init__(self, n: int = LOCK_STRIPES):
+        self.locks = [threading.Lock() for _ in range(n)]
+        # счётчики меняются только под своей полосой
+        self.acquired: List[int] = [0] * n
+        self.contended: List[int] = [0] * n
+
+    def stats(self):
+        return sum(self.acquired), sum(self.contended)
+
+
+class CurrentUser:
+    def __init__(self, users: UserIndex, stripes: LockStripes):
+        self.users = users
+        self.stripes = stripes
+        self.cuid = -1
+        # для метрик: обработчик забирает их после потока
+        self.ssh_failures = 0
+        self.sudo_failures = 0
+        self.lockouts = 0
+
+    def handle_ssh(self, stream_id: str, event) -> None:
+        users = self.users
+        prevCuid = self.cuid
+        uid = users.lookup(event.name)
+        if uid != -1:
+            self.cuid = uid
+
+        if self.cuid == -1:
+            logger.error("Couldn't find a user with a name %s (%s)", event.name, stream_id)
+            return
+
+        cuid = self.cuid
+        user = users[cuid]
+        # отказы без блокировки: снимок authd читается атомарно, а блокировка
+        # после трёх ошибок не снимается никогда (сброс счётчика возможен
+        # только при успешном входе, а он при retries >= 3 невозможен)
+        authd = user.authd
+        if authd == stream_id:
+            logger.info("You are already logged in (%s)", stream_id)
+            return
+
+        if authd:
+            logger.error("User %s already authd from %s (%s)", user.name, authd, stream_id)
+            self.cuid = -1
+            return
+
+        if user.auth_retries >= 3:
+            logger.error("Can't access user %s, user is blocked (%s)", user.name, stream_id)
+            self.cuid = -1
+            return
+
+        passwd_ok = VERIFIER.verify(cuid, user.cred, event.passwd)
+
+        stripes = self.stripes
+        locks = stripes.locks
+        first = cuid % len(locks)
+        second = prevCuid % len(locks) if prevCuid != -1 else first
+        if second < first:
+            first, second = second, first
+        lock = locks[first]
+        if not lock.acquire(blocking=False):
+            TRACER.wait(lock)
+            stripes.contended[first] += 1
+        stripes.acquired[first] += 1
+        if second != first:
+            lock = locks[second]
+            if not lock.acquire(blocking=False):
+                TRACER.wait(lock)
+                stripes.contended[second] += 1
+            stripes.acquired[second] += 1
+        try:
+            # пока ждали блокировку, состояние могло измениться
+            if user.authd:
+                logger.error("User %s already authd from %s (%s)", user.name, user.authd, stream_id)
+                self.cuid = -1
+                return
+
+            if user.auth_retries >= 3:
+                logger.error("Can't access user %s, user is blocked (%s)", user.name, stream_id)
+                self.cuid = -1
+                return
+
+            if not passwd_ok:
+                user.auth_retries += 1
+                users.mark(cuid, user)
+                self.ssh_failures += 1
+                if user.auth_retries == 3:
+                    self.lockouts += 1
+                logger.error("Wrong password for user %s (%s)", user.name, stream_id)
+                self.cuid = -1
+                return
+
+            if prevCuid != -1 and prevCuid != cuid:
+                prev = users[prevCuid]
+                if prev.authd == stream_id:
+                    prev.authd = ""
+                    users.mark(prevCuid, prev)
+            user.authd = stream_id
+            user.auth_retries = 0
+            users.mark(cuid, user)
+            logger.info("User %s authd (%s)", user.name, stream_id)
+        finally:
+            if second != first:
+                locks[second].release()
+            locks[first].release()
+
+    def logout(self, stream_id: str) -> None:
+        """Выход из текущего пользователя при закрытии потока."""
+        cuid = self.cuid
+        if cuid == -1:
+            return
+        with self.stripes.locks[cuid % len(self.stripes.locks)]:
+            user = self.users[cuid]
+            if user.authd == stream_id:
+                user.authd = ""
+                self.users.mark(cuid, user)
+        self.cuid = -1
+
+    def handle_sudo(self, stream_id: str, event) -> None:
+        if self.cuid == -1:
+            return
+        user = self.users[self.cuid]
+        if VERIFIER.verify(self.cuid, user.cred, event.passwd):
+            logger.info("Accepted sudo on user %s (%s)", user.name, stream_id)
+        else:
+            self.sudo_failures += 1
+            logger.error("Bad password for sudo on user %s (%s)", user.name, stream_id)
+
+    def handle_dir(self, stream_id: str, event) -> None:
+        if self.cuid == -1:
+            return
+        logger.info("Accepted dir on user %s (%s)", self.users[self.cuid].name, stream_id)
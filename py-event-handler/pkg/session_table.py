@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+from tracing import TRACER
+from metrics import EVENT_APPEND, EVENT_COUNTERS
+
+# Таблица открытых потоков для поштучной подачи событий. Поток больше не
+# обязан приходить целиком: события дописываются в открытую сессию, а её
+# CurrentUser живёт здесь между запросами.
+#
+# Память на сессию постоянна: хранится только CurrentUser (cuid и счётчики),
+# сами события после обработки не держатся. Число сессий ограничено
+# max_sessions, простаивающие дольше idle_timeout закрываются; при закрытии
+# вызывается on_close (обработчики выходят из пользователя сессии).
+# Порядок - LRU: каждое обращение переносит сессию в конец, так что
+# истёкшие всегда в начале и вытесняются за O(1) на сессию.
+#
+# open() отдаёт сессию уже после выхода из блокировки таблицы, и до захвата
+# session.lock её может закрыть DELETE или истечение. Закрытие ставит
+# session.closed под session.lock (для threading.Lock - дождавшись текущего
+# запроса), поэтому сессию берут через open_locked(): она захватывает
+# блокировку, проверяет closed и при необходимости открывает поток заново.
+# asyncio.Lock синхронно не захватить: на цикле событий closed ставится
+# сразу, и держатель блокировки проверяет его ещё и после каждого await.
+
+
+class Session:
+    __slots__ = ("stream_id", "cu", "lock", "last_seen", "events", "closed")
+
+    def __init__(self, stream_id: str, cu: Any, lock: Any):
+        self.stream_id = stream_id
+        self.cu = cu
+        # события одной сессии обрабатываются строго по очереди
+        self.lock = lock
+        self.last_seen = time.monotonic()
+        self.events = 0
+        # ставится под lock при закрытии; закрытая сессия больше не обрабатывает событий
+        self.closed = False
+
+
+class SessionTable:
+    def __init__(self, factory: Callable[[], Any], idle_timeout: float, max_sessions: int,
+                 on_close: Optional[Callable[[Session], None]] = None,
+                 lock_factory: Callable[[], Any] = threading.Lock):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.on_close = on_close
+        self.lock_factory = lock_factory
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def open(self, stream_id: str) -> Optional[Session]:
+        """Открытая сессия потока или новая; None, если таблица заполнена."""
+        closed = []
+        with self._lock:
+            session = self._sessions.get(stream_id)
+            if session is not None:
+                self._sessions.move_to_end(stream_id)
+            else:
+                if len(self._sessions) >= self.max_sessions:
+                    closed = self._expire(time.monotonic())
+                if len(self._sessions) < self.max_sessions:
+                    session = Session(stream_id, self.factory(), self.lock_factory())
+                    self._sessions[stream_id] = session
+            if session is not None:
+                session.last_seen = time.monotonic()
+        self._close_all(closed)
+        return session
+
+    def open_locked(self, stream_id: str) -> Optional[Session]:
+        """open() с захваченной session.lock (threading.Lock); освобождает вызывающий."""
+        while True:
+            session = self.open(stream_id)
+            if session is None:
+                return None
+            session.lock.acquire()
+            if not session.closed:
+                return session
+            # закрыта между open() и блокировкой: поток открывается заново
+            session.lock.release()
+
+    async def open_locked_async(self, stream_id: str) -> Optional[Session]:
+        """То же для asyncio.Lock."""
+        while True:
+            session = self.open(stream_id)
+            if session is None:
+                return None
+            await session.lock.acquire()
+            if not session.closed:
+                return session
+            session.lock.release()
+
+    def open_sessions(self) -> List[Session]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def touch(self, session: Session) -> None:
+        session.last_seen = time.monotonic()
+
+    def close(self, stream_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(stream_id, None)
+        if session is None:
+            return False
+        self._close_all([session])
+        return True
+
+    def expire(self) -> int:
+        with self._lock:
+            closed = self._expire(time.monotonic())
+        self._close_all(closed)
+        return len(closed)
+
+    def _expire(self, now: float) -> List[Session]:
+        closed = []
+        sessions = self._sessions
+        while sessions:
+            stream_id, session = next(iter(sessions.items()))
+            if now - session.last_seen < self.idle_timeout:
+                break
+            if session.lock.locked():
+                # сессия занята запросом: продлеваем, а не закрываем посреди обработки
+                session.last_seen = now
+                sessions.move_to_end(stream_id)
+                continue
+            del sessions[stream_id]
+            closed.append(session)
+        return closed
+
+    def _close_all(self, sessions: List[Session]) -> None:
+        for session in sessions:
+            if hasattr(session.lock, "__enter__"):
+                with session.lock:
+                    self._close(session)
+            else:
+                self._close(session)
+
+    def _close(self, session: Session) -> None:
+        session.closed = True
+        if self.on_close is not None:
+            self.on_close(session)
+
+    def sweep_forever(self, stop: threading.Event, interval: float) -> None:
+        while not stop.wait(interval):
+            self.expire()
+
+
+def handle_event(session: Session, event, shard) -> None:
+    """Одно событие сессии для синхронных CurrentUser (threading, multiprocessing)."""
+    cu = session.cu
+    stream_id = session.stream_id
+    start_ns = time.perf_counter_ns()
+    TRACER.handlers(type(cu))[event.code](cu, stream_id, event)
+    shard.observe(EVENT_APPEND, time.perf_counter_ns() - start_ns)
+    count_event(session, EVENT_COUNTERS[event.code], shard)
+
+
+def count_event(session: Session, counter: int, shard) -> None:
+    cu = session.cu
+    session.events += 1
+    shard.inc(counter)
+    if cu.ssh_failures or cu.sudo_failures:
+        # счётчики CurrentUser копятся за всю сессию, в метрики уходит прирост
+        shard.count_failures(cu)
+        cu.ssh_failures = cu.sudo_failures = cu.lockouts = 0
@@ -0,0 +1,553 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from credentials import DIGEST_SIZE, SALT_SIZE, VERIFIER, Credential
+from directory import plain_passwd
+from events import SSH, name_of
+from metrics import EVENT_APPEND, EVENT_COUNTERS, SharedMetrics
+from models import Event, Stream
+from session_table import count_event
+from tracing import TRACER
+from user_index import UserIndex
+
+logger = logging.getLogger()
+
+# Шардированный движок: пользователи разбиты по N процессам-шардам по
+# crc32(name) % N, и каждый шард владеет состоянием своих пользователей
+# единолично - без блокировок и без общей памяти.
+#
+# Поток выполняется на шарде, которому принадлежит его текущий пользователь.
+# Шард идёт по событиям, пока не встретит ssh к чужому пользователю; тогда
+# он отдаёт остаток потока вместе с cuid обратно, и диспетчер пересылает его
+# шарду-владельцу. Следующая часть потока уходит только после того, как
+# вернулась предыдущая, так что порядок событий внутри потока сохраняется.
+# Выход из предыдущего пользователя на другом шарде - отдельное сообщение
+# его владельцу (как и в SharedCurrentUser, не атомарно со входом).
+#
+# В родителе работают два потока: router раскладывает сообщения по очередям
+# шардов пачками, collector принимает от шардов завершения, продолжения и
+# ответы. Снаружи движок выглядит как пул из pool.py
+# (start/submit/qsize/shutdown), поэтому приём потоков, журнал и
+# HTTP-приложение у него общие с остальными обработчиками (stream_server.py).
+#
+# События уходят в шарды кортежами (код типа, имя, пароль): так они
+# сериализуются в разы быстрее, чем Event. На шарде событие обрабатывает
+# ShardCurrentUser через таблицу вызовов реестра (events.py), поэтому типы
+# из EVENT_PLUGINS, детектор и трассировка работают и здесь.
+#
+# Открытые потоки (session_table.py) живут в процессе сервера: у сессии
+# только cuid (ShardSessionUser), а каждое её событие - синхронный вызов
+# call() к шарду-владельцу. Выходы, которые шард шлёт другим шардам, идут
+# через collector раньше ответа и раньше завершения потока, поэтому запрос
+# состояния для снимка журнала (dirty()) видит их уже применёнными.
+#
+# Шарды раскладываются из Directory.credentials() без загрузки пользователей:
+# пароль, заданный в каталоге открытым текстом, хеширует шард-владелец при
+# первой проверке, как и в общей таблице shm_users.py.
+
+RUN = 0
+LOGOUT = 1
+DIRTY = 2
+ROUTER_BATCH = 256
+# адресат ответа в результатах шарда: не шард, а ждущий вызов в родителе
+REPLY = -1
+
+
+def shard_of(name: str, shards: int) -> int:
+    return zlib.crc32(name.encode()) % shards
+
+
+def _event(code: int, name: str, passwd: str) -> Event:
+    # без Event.__init__: код уже есть, а имя и тип интернировать незачем
+    event = Event.__new__(Event)
+    event.type = name_of(code)
+    event.code = code
+    event.name = name
+    event.passwd = passwd
+    return event
+
+
+class ShardUser:
+    __slots__ = ("name", "cred", "authd", "auth_retries")
+
+    # cred None - пароль в каталоге открытым текстом, ещё не хеширован
+    def __init__(self, name: str, cred: Optional[Credential], authd: str = "", auth_retries: int = 0):
+        self.name = name
+        self.cred = cred
+        self.authd = authd
+        self.auth_retries = auth_retries
+
+
+class ShardCurrentUser:
+    """CurrentUser одного прохода по потоку на шарде; пользователи - только свои."""
+
+    __slots__ = ("worker", "cuid", "ssh_failures", "sudo_failures", "lockouts")
+
+    def __init__(self, worker: "ShardWorker", cuid: int = -1):
+        self.worker = worker
+        self.cuid = cuid
+        self.ssh_failures = 0
+        self.sudo_failures = 0
+        self.lockouts = 0
+
+    def handle_ssh(self, stream_id: str, event) -> None:
+        # та же логика, что в session.CurrentUser.handle_ssh, но без блокировок
+        worker = self.worker
+        prevCuid = self.cuid
+        uid = worker.names.get(event.name, -1)
+        if uid != -1:
+            self.cuid = uid
+
+        if self.cuid == -1:
+            logger.error("Couldn't find a user with a name %s (%s)", event.name, stream_id)
+            return
+
+        cuid = self.cuid
+        user = worker.users[cuid]
+        if user.authd == stream_id:
+            logger.info("You are already logged in (%s)", stream_id)
+            return
+
+        if user.authd:
+            logger.error("User %s already authd from %s (%s)", user.name, user.authd, stream_id)
+            self.cuid = -1
+            return
+
+        if user.auth_retries >= 3:
+            logger.error("Can't access user %s, user is blocked (%s)", user.name, stream_id)
+            self.cuid = -1
+            return
+
+        if not VERIFIER.verify(cuid, worker.cred(cuid), event.passwd):
+            user.auth_retries += 1
+            worker.mark(cuid, user)
+            self.ssh_failures += 1
+            if user.auth_retries == 3:
+                self.lockouts += 1
+            logger.error("Wrong password for user %s (%s)", user.name, stream_id)
+            self.cuid = -1
+            return
+
+        if prevCuid != -1 and prevCuid != cuid:
+            worker.release(prevCuid, stream_id)
+        user.authd = stream_id
+        user.auth_retries = 0
+        worker.mark(cuid, user)
+        logger.info("User %s authd (%s)", user.name, stream_id)
+
+    def logout(self, stream_id: str) -> None:
+        if self.cuid == -1:
+            return
+        self.worker.release(self.cuid, stream_id)
+        self.cuid = -1
+
+    def handle_sudo(self, stream_id: str, event) -> None:
+        if self.cuid == -1:
+            return
+        user = self.worker.users[self.cuid]
+        if VERIFIER.verify(self.cuid, self.worker.cred(self.cuid), event.passwd):
+            logger.info("Accepted sudo on user %s (%s)", user.name, stream_id)
+        else:
+            self.sudo_failures += 1
+            logger.error("Bad password for sudo on user %s (%s)", user.name, stream_id)
+
+    def handle_dir(self, stream_id: str, event) -> None:
+        if self.cuid == -1:
+            return
+        logger.info("Accepted dir on user %s (%s)", self.worker.users[self.cuid].name, stream_id)
+
+
+class ShardWorker:
+    """Состояние и обработка событий одного шарда (живёт в его процессе)."""
+
+    def __init__(self, shard: int, names: Dict[str, int], owner: List[int], users: Dict[int, ShardUser],
+                 source: str = ""):
+        self.shard = shard
+        self.names = names
+        self.owner = owner
+        self.users = users
+        # SQLite-каталог, из которого берутся пароли в открытом виде
+        self.source = source
+        # пользователи с состоянием входа - для снимков журнала, как Directory.dirty()
+        self._dirty: Dict[int, ShardUser] = {uid: user for uid, user in users.items()
+                                             if user.authd or user.auth_retries}
+        # выходы из пользователей других шардов, накопленные за сообщение
+        self.logouts: List[tuple] = []
+
+    def mark(self, uid: int, user: ShardUser) -> None:
+        if user.authd or user.auth_retries:
+            self._dirty[uid] = user
+        else:
+            self._dirty.pop(uid, None)
+
+    def dirty(self) -> List[list]:
+        return [[user.name, user.authd, user.auth_retries] for user in self._dirty.values()]
+
+    def logout(self, uid: int, stream_id: str) -> None:
+        user = self.users[uid]
+        if user.authd == stream_id:
+            user.authd = ""
+            self.mark(uid, user)
+
+    def release(self, uid: int, stream_id: str) -> None:
+        """Выход из пользователя uid: своего - сразу, чужого - сообщением владельцу."""
+        target = self.owner[uid]
+        if target == self.shard:
+            self.logout(uid, stream_id)
+        else:
+            self.logouts.append((target, (LOGOUT, uid, stream_id)))
+
+    def cred(self, uid: int) -> Credential:
+        user = self.users[uid]
+        if user.cred is None:
+            # пользователь принадлежит только этому шарду, блокировка не нужна
+            passwd = plain_passwd(self.source, uid) if self.source else None
+            if passwd is None:
+                logger.error("Пароль пользователя uid %s не найден в каталоге, вход невозможен", uid)
+                # нулевой дайджест PBKDF2 не выдаёт: ни один пароль не подойдёт
+                user.cred = Credential(bytes(SALT_SIZE), bytes(DIGEST_SIZE), 1)
+            else:
+                user.cred = Credential.create(passwd)
+        return user.cred
+
+    def run(self, msg: tuple, metrics) -> Optional[Tuple[int, tuple]]:
+        """Обрабатывает поток с позиции pos.
+
+        Возвращает (шард, продолжение), если поток надо передать другому
+        шарду, (REPLY, (token, cuid)) по концу вызова call() или None, если
+        поток закончен.
+        """
+        stream_id, events, pos, cuid, elapsed_ns, accepted_ns, token = msg
+        names = self.names
+        owner = self.owner
+        me = self.shard
+        cu = ShardCurrentUser(self, cuid)
+        stream = None
+        if accepted_ns:
+            # отметка приёма есть только у потоков, принятых в окне трассировки:
+            # ожидание в очередях меряется как dispatch, один раз на поток
+            stream = Stream(stream_id, None)
+            stream.accepted_ns = accepted_ns
+        handlers = TRACER.handlers(ShardCurrentUser, stream)
+        counts = [0] * len(handlers)
+        ssh_code = SSH.code
+        start_ns = time.perf_counter_ns()
+        handoff = -1
+
+        n = len(events)
+        while pos < n:
+            code, name, passwd = events[pos]
+            if code == ssh_code:
+                uid = names.get(name, -1)
+                target = uid if uid != -1 else cu.cuid
+                if target != -1 and owner[target] != me:
+                    handoff = owner[target]
+                    break
+            counts[code] += 1
+            handlers[code](cu, stream_id, _event(code, name, passwd))
+            pos += 1
+
+        elapsed_ns += time.perf_counter_ns() - start_ns
+        shard = metrics.shard()
+        if token:
+            # события сессии считает процесс сервера, шард - только ошибки паролей
+            shard.count_failures(cu)
+        elif handoff != -1:
+            shard.count_events(counts, cu)
+        else:
+            shard.stream_done(elapsed_ns, counts, cu)
+            logger.info("Завершение потока %s за %.3f мкс", stream_id, elapsed_ns/1e3)
+        if handoff != -1:
+            return handoff, (RUN, (stream_id, events, pos, cu.cuid, elapsed_ns, 0, token))
+        if token:
+            return REPLY, (token, cu.cuid)
+        return None
+
+
+def _shard_loop(worker: ShardWorker, inbox, results, metrics: SharedMetrics) -> None:
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        out = []
+        for item in batch:
+            kind = item[0]
+            try:
+                if kind == RUN:
+                    result = worker.run(item[1], metrics)
+                elif kind == LOGOUT:
+                    worker.logout(item[1], item[2])
+                    continue
+                else:
+                    result = REPLY, (item[1], worker.dirty())
+            except Exception as e:
+                logger.error(f"Ошибка в шарде {worker.shard}: {e}")
+                if kind == LOGOUT:
+                    continue
+                # поток считается законченным, вызов получает пустой ответ
+                token = item[1][6] if kind == RUN else item[1]
+                result = (REPLY, (token, None)) if token else None
+            # выходы на других шардах - раньше завершения, см. ShardedEngine._collect
+            if worker.logouts:
+                out.extend(worker.logouts)
+                worker.logouts.clear()
+            out.append(result)
+        if out:
+            results.put(out)
+
+
+class ShardedEngine:
+    def __init__(self, users: UserIndex, shards: int, queue_size: int):
+        self.size = shards
+        self.queue_size = queue_size
+        # строка на шард и одна на процесс сервера: детектор и трассировка его потоков
+        self.metrics = SharedMetrics(shards + 1)
+        # один проход; у каталога (directory.Directory) - без создания User и
+        # PBKDF2, состояние входов (в том числе восстановленное по журналу)
+        # берётся из его грязных пользователей
+        self._source = ""
+        if hasattr(users, "credentials"):
+            self._source = users.store.path
+            state = {name: (authd, retries) for name, authd, retries in users.dirty()}
+            rows = ((uid, name, cred) + state.get(name, ("", 0)) for uid, name, cred in users.credentials())
+        else:
+            rows = ((uid, user.name, user.cred, user.authd, user.auth_retries) for uid, user in users.items())
+        self._names: Dict[str, int] = {}
+        owner: Dict[int, int] = {}
+        self._parts: List[Dict[int, ShardUser]] = [{} for _ in range(shards)]
+        for uid, name, cred, authd, auth_retries in rows:
+            s = shard_of(name, shards)
+            self._names[name] = uid
+            owner[uid] = s
+            self._parts[s][uid] = ShardUser(name, cred, authd, auth_retries)
+        self._owner = [-1] * (max(owner, default=-1) + 1)
+        for uid, s in owner.items():
+            self._owner[uid] = s
+        self._inboxes = [multiprocessing.Queue() for _ in range(shards)]
+        self._results = multiprocessing.Queue()
+        self._router_q: queue.SimpleQueue = queue.SimpleQueue()
+        self._inflight = 0
+        self._cond = threading.Condition()
+        # ответы шардов на call() и dirty() по номеру вызова
+        self._tokens = itertools.count(1)
+        self._replies: Dict[int, Any] = {}
+        self._stopped = False
+        # состояние на момент остановки: снимок журнала снимается уже после неё
+        self._final_dirty: Optional[List[list]] = None
+        self._workers: List[multiprocessing.Process] = []
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        for s in range(self.size):
+            worker = ShardWorker(s, self._names, self._owner, self._parts[s], self._source)
+            p = multiprocessing.Process(
+                target=_shard_loop,
+                args=(worker, self._inboxes[s], self._results, self.metrics),
+                name=f"shard-{s}",
+                daemon=True,
+            )
+            p.start()
+            self._workers.append(p)
+        for target, name in ((self._route, "shard-router"), (self._collect, "shard-collector")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, stream, block: bool = False) -> bool:
+        with self._cond:
+            while self._inflight >= self.queue_size:
+                if not block:
+                    return False
+                self._cond.wait()
+            self._inflight += 1
+        events = tuple((e.code, e.name, e.passwd) for e in stream.events)
+        self._router_q.put((self._first_shard(stream.stream_id, events),
+                            (RUN, (stream.stream_id, events, 0, -1, 0, stream.accepted_ns, 0))))
+        return True
+
+    def qsize(self) -> int:
+        return self._inflight
+
+    def call(self, stream_id: str, events: tuple, cuid: int) -> int:
+        """События открытого потока на шарде-владельце cuid; возвращает новый cuid.
+
+        Синхронно и мимо очереди потоков: запрос сессии ждёт ответа сам.
+        """
+        token = next(self._tokens)
+        target = self._owner[cuid] if cuid != -1 else self._first_shard(stream_id, events)
+        self._router_q.put((target, (RUN, (stream_id, events, 0, cuid, 0, 0, token))))
+        cuid = self._wait(token)
+        if cuid is None:
+            raise RuntimeError(f"stream {stream_id} failed on shard {target}")
+        return cuid
+
+    def logout(self, uid: int, stream_id: str) -> None:
+        """Выход из пользователя при закрытии открытого потока, без ожидания."""
+        self._router_q.put((self._owner[uid], (LOGOUT, uid, stream_id)))
+
+    def name(self, uid: int) -> str:
+        return self._parts[self._owner[uid]][uid].name
+
+    def dirty(self) -> List[list]:
+        """[name, authd, auth_retries] пользователей с состоянием со всех шардов (для снимков wal)."""
+        with self._cond:
+            # принятые потоки дорабатываются: их выходы на других шардах ещё в пути
+            while self._inflight and not self._stopped:
+                self._cond.wait()
+        if self._final_dirty is not None:
+            return self._final_dirty
+        return self._ask_dirty()
+
+    def shutdown(self, timeout: Optional[float] = None) -> int:
+        # ждём завершения принятых потоков, затем останавливаем шарды
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._inflight:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    break
+                self._cond.wait(left)
+            unfinished = self._inflight
+        if not unfinished:
+            self._final_dirty = self._ask_dirty()
+        self._router_q.put(None)
+        self._results.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads.clear()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for q in self._inboxes:
+            q.put(None)
+        left = 0
+        for p in self._workers:
+            p.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if p.is_alive():
+                p.kill()
+                p.join()
+                left += 1
+        if left or unfinished:
+            for q in self._inboxes:
+                q.cancel_join_thread()
+        self._workers.clear()
+        return left
+
+    def _ask_dirty(self) -> List[list]:
+        tokens = [next(self._tokens) for _ in range(self.size)]
+        for s, token in enumerate(tokens):
+            self._router_q.put((s, (DIRTY, token)))
+        rows = []
+        for token in tokens:
+            rows.extend(self._wait(token) or ())
+        return rows
+
+    def _wait(self, token: int) -> Any:
+        with self._cond:
+            while token not in self._replies:
+                if self._stopped:
+                    raise RuntimeError("sharded engine is stopped")
+                self._cond.wait()
+            return self._replies.pop(token)
+
+    def _first_shard(self, stream_id: str, events: tuple) -> int:
+        # до первого ssh к известному пользователю события ничего не меняют,
+        # поэтому поток сразу идёт владельцу этого пользователя
+        names = self._names
+        ssh_code = SSH.code
+        for etype, name, _ in events:
+            if etype == ssh_code:
+                uid = names.get(name, -1)
+                if uid != -1:
+                    return self._owner[uid]
+        return shard_of(stream_id, self.size)
+
+    def _route(self) -> None:
+        inboxes = self._inboxes
+        get = self._router_q.get
+        get_nowait = self._router_q.get_nowait
+        while True:
+            item = get()
+            batches: Dict[int, list] = {}
+            done = False
+            n = 0
+            while True:
+                if item is None:
+                    done = True
+                    break
+                target, msg = item
+                batches.setdefault(target, []).append(msg)
+                n += 1
+                if n >= ROUTER_BATCH:
+                    break
+                try:
+                    item = get_nowait()
+                except queue.Empty:
+                    break
+            for target, batch in batches.items():
+                inboxes[target].put(batch)
+            if done:
+                return
+
+    def _collect(self) -> None:
+        put = self._router_q.put
+        while True:
+            out = self._results.get()
+            if out is None:
+                return
+            finished = 0
+            replies = []
+            for result in out:
+                if result is None:
+                    finished += 1
+                elif result[0] == REPLY:
+                    replies.append(result[1])
+                else:
+                    # продолжения и выходы - в router до ответов и завершений
+                    put(result)
+            if finished or replies:
+                with self._cond:
+                    self._inflight -= finished
+                    self._replies.update(replies)
+                    self._cond.notify_all()
+
+
+class ShardSessionUser:
+    """Пользователь открытого потока в процессе сервера: только cuid.
+
+    События обрабатывает шард-владелец (handle_event), ошибки паролей он же
+    и считает, поэтому счётчики здесь всегда нулевые.
+    """
+
+    __slots__ = ("engine", "cuid", "ssh_failures", "sudo_failures", "lockouts")
+
+    def __init__(self, engine: ShardedEngine):
+        self.engine = engine
+        self.cuid = -1
+        self.ssh_failures = 0
+        self.sudo_failures = 0
+        self.lockouts = 0
+
+    def logout(self, stream_id: str) -> None:
+        if self.cuid == -1:
+            return
+        self.engine.logout(self.cuid, stream_id)
+        self.cuid = -1
+
+
+def handle_event(session, event, shard) -> None:
+    """Одно событие сессии для ShardSessionUser: вызов шарда-владельца."""
+    cu = session.cu
+    start_ns = time.perf_counter_ns()
+    cu.cuid = cu.engine.call(session.stream_id, ((event.code, event.name, event.passwd),), cu.cuid)
+    shard.observe(EVENT_APPEND, time.perf_counter_ns() - start_ns)
+    count_event(session, EVENT_COUNTERS[event.code], shard)
@@ -0,0 +1,302 @@
+import hashlib
+import logging
+import multiprocessing
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Optional
+
+from credentials import DIGEST_SIZE, SALT_SIZE, VERIFIER, Credential
+from directory import plain_passwd
+from tracing import TRACER
+
+logger = logging.getLogger()
+
+# Таблица пользователей в multiprocessing.shared_memory с фиксированной
+# раскладкой слота:
+#   name_len:B name:64s salt:16s passwd_hash:32s iterations:I authd_len:B authd:64s retries:i
+# Пароль хранится как PBKDF2 (credentials.Credential) и проверяется через
+# кэш проверок процесса. Пароли в открытом виде при создании таблицы не
+# хешируются (PBKDF2 на весь каталог задерживал бы старт): слот остаётся с
+# iterations=0, и первая проверка читает пароль из SQLite-каталога
+# (directory.plain_passwd), хеширует его и записывает в слот для всех
+# процессов.
+#
+# Таблица раскладывается один раз при старте: размер и индекс имён у
+# каждого процесса свои, поэтому перечитать каталог (SIGHUP у threading и
+# asyncio с PROCS=1) на ходу нельзя - изменения каталога требуют перезапуска.
+# Воркеры читают и меняют состояние напрямую в общей памяти, без IPC.
+# Изменения authd/retries делаются под блокировкой слота; блокировки
+# раздаются полосами (uid % LOCK_STRIPES), чтобы не держать по семафору
+# на каждого пользователя.
+#
+# streamId длиннее AUTHD_SIZE байт (декодер длину не ограничивает) лежит в
+# слоте authd дайджестом фиксированной длины (slot_id): сравнение "тот же
+# поток" идёт по нему, в логах виден дайджест. Имя длиннее NAME_SIZE в слот
+# не помещается: такой пользователь пропускается с ошибкой в логе, а не
+# роняет старт.
+
+NAME_SIZE = 64
+AUTHD_SIZE = 64
+LOCK_STRIPES = 64
+
+SLOT = struct.Struct(f"<B{NAME_SIZE}s{SALT_SIZE}s32sIB{AUTHD_SIZE}si")
+NAME_OFF = 0
+SALT_OFF = 1 + NAME_SIZE
+HASH_OFF = SALT_OFF + SALT_SIZE
+AUTHD_OFF = HASH_OFF + 32 + 4
+RETRIES_OFF = AUTHD_OFF + 1 + AUTHD_SIZE
+
+_authd = struct.Struct(f"<B{AUTHD_SIZE}s")
+_retries = struct.Struct("<i")
+_name = struct.Struct(f"<B{NAME_SIZE}s")
+_passwd = struct.Struct(f"<{SALT_SIZE}s32sI")
+
+
+def slot_id(stream_id: str) -> str:
+    """streamId в том виде, в каком он хранится в слоте authd.
+
+    Короткий - как есть, длинный - "#" и blake2b в hex (63 символа). Повторное
+    применение ничего не меняет, так что authd из снимка (wal) можно
+    записать обратно через set_authd.
+    """
+    raw = stream_id.encode()
+    if len(raw) <= AUTHD_SIZE:
+        return stream_id
+    return "#" + hashlib.blake2b(raw, digest_size=(AUTHD_SIZE - 1) // 2).hexdigest()
+
+
+class SharedUserTable:
+    def __init__(self, shm: shared_memory.SharedMemory, locks: List[Any], capacity: int, source: str = ""):
+        self._shm = shm
+        self._buf = shm.buf
+        self._locks = locks
+        self.capacity = capacity
+        # SQLite-каталог с паролями в открытом виде для ленивого хеширования
+        self.source = source
+        self._index: Dict[str, int] = {}
+        for uid in range(capacity):
+            name = self.name(uid)
+            if name:
+                self._index[name] = uid
+
+    @classmethod
+    def create(cls, users: Dict[int, Any], stripes: int = LOCK_STRIPES,
+               capacity: Optional[int] = None) -> "SharedUserTable":
+        # users - словарь пользователей или каталог (directory.Directory);
+        # у каталога capacity передаётся явно, чтобы не обходить его дважды
+        if capacity is None:
+            capacity = max(users) + 1 if users else 0
+        source = ""
+        if hasattr(users, "credentials"):
+            rows = users.credentials()
+            source = users.store.path
+        else:
+            rows = ((uid, user.name, user.cred) for uid, user in users.items())
+        shm = shared_memory.SharedMemory(create=True, size=max(1, capacity * SLOT.size))
+        shm.buf[:capacity * SLOT.size] = bytes(capacity * SLOT.size)
+        skipped = 0
+        for uid, name, cred in rows:
+            raw = name.encode()
+            if len(raw) > NAME_SIZE:
+                logger.error("Пользователь %r (uid %s) пропущен: имя %s байт, в общей таблице "
+                             "не больше %s", name, uid, len(raw), NAME_SIZE)
+                skipped += 1
+                continue
+            if cred is None:
+                # пароль в открытом виде: хешируется при первой проверке
+                SLOT.pack_into(shm.buf, uid * SLOT.size, len(raw), raw, b"", b"", 0, 0, b"", 0)
+            else:
+                SLOT.pack_into(shm.buf, uid * SLOT.size, len(raw), raw, cred.salt,
+                               cred.digest, cred.iterations, 0, b"", 0)
+        if skipped:
+            logger.error("%s пользователей с длинными именами не войдут в систему", skipped)
+        locks = [multiprocessing.Lock() for _ in range(stripes)]
+        return cls(shm, locks, capacity, source)
+
+    # таблица передаётся воркерам аргументом Process: переподключаемся по имени
+    def __getstate__(self):
+        return {"name": self._shm.name, "locks": self._locks, "capacity": self.capacity, "source": self.source}
+
+    def __setstate__(self, state):
+        shm = shared_memory.SharedMemory(name=state["name"])
+        # сегментом владеет создатель, дочерний процесс не должен его удалять
+        resource_tracker.unregister(shm._name, "shared_memory")
+        self.__init__(shm, state["locks"], state["capacity"], state["source"])
+
+    def close(self) -> None:
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self) -> None:
+        self._shm.unlink()
+
+    def lookup(self, name: str) -> int:
+        return self._index.get(name, -1)
+
+    def lock(self, uid: int):
+        return self._locks[uid % len(self._locks)]
+
+    def name(self, uid: int) -> str:
+        n, raw = _name.unpack_from(self._buf, uid * SLOT.size + NAME_OFF)
+        return raw[:n].decode()
+
+    def cred(self, uid: int) -> Credential:
+        salt, digest, iterations = _passwd.unpack_from(self._buf, uid * SLOT.size + SALT_OFF)
+        if not iterations:
+            return self._hash(uid)
+        return Credential(salt, digest, iterations)
+
+    def _hash(self, uid: int) -> Credential:
+        # PBKDF2 - вне блокировки слота; если другой процесс успел раньше, берём его хеш
+        passwd = plain_passwd(self.source, uid) if self.source else None
+        if passwd is None:
+            logger.error("Пароль пользователя uid %s не найден в каталоге, вход невозможен", uid)
+            # нулевой дайджест PBKDF2 не выдаёт: ни один пароль не подойдёт
+            return Credential(bytes(SALT_SIZE), bytes(DIGEST_SIZE), 1)
+        cred = Credential.create(passwd)
+        off = uid * SLOT.size + SALT_OFF
+        with self.lock(uid):
+            salt, digest, iterations = _passwd.unpack_from(self._buf, off)
+            if iterations:
+                return Credential(salt, digest, iterations)
+            _passwd.pack_into(self._buf, off, cred.salt, cred.digest, cred.iterations)
+        return cred
+
+    def check_passwd(self, uid: int, passwd: str) -> bool:
+        return VERIFIER.verify(uid, self.cred(uid), passwd)
+
+    def authd(self, uid: int) -> str:
+        n, raw = _authd.unpack_from(self._buf, uid * SLOT.size + AUTHD_OFF)
+        return raw[:n].decode()
+
+    def has_authd(self, uid: int) -> bool:
+        # один байт длины читается атомарно, годится для проверки без блокировки
+        return self._buf[uid * SLOT.size + AUTHD_OFF] != 0
+
+    def set_authd(self, uid: int, stream_id: str) -> None:
+        raw = slot_id(stream_id).encode()
+        _authd.pack_into(self._buf, uid * SLOT.size + AUTHD_OFF, len(raw), raw)
+
+    def retries(self, uid: int) -> int:
+        return _retries.unpack_from(self._buf, uid * SLOT.size + RETRIES_OFF)[0]
+
+    def set_retries(self, uid: int, retries: int) -> None:
+        _retries.pack_into(self._buf, uid * SLOT.size + RETRIES_OFF, retries)
+
+    def dirty(self) -> List[list]:
+        """[name, authd, retries] занятых или заблокированных (для снимков wal)."""
+        out = []
+        for uid in range(self.capacity):
+            if self.has_authd(uid) or self.retries(uid):
+                with self.lock(uid):
+                    out.append([self.name(uid), self.authd(uid), self.retries(uid)])
+        return out
+
+    def restore(self, name: str, authd: str, retries: int) -> bool:
+        uid = self.lookup(name)
+        if uid == -1:
+            return False
+        with self.lock(uid):
+            self.set_authd(uid, authd)
+            self.set_retries(uid, retries)
+        return True
+
+
+class SharedCurrentUser:
+    """CurrentUser из threading-обработчика поверх SharedUserTable."""
+
+    def __init__(self, users: SharedUserTable):
+        self.users = users
+        self.cuid = -1
+        self.ssh_failures = 0
+        self.sudo_failures = 0
+        self.lockouts = 0
+
+    def handle_ssh(self, stream_id: str, event) -> None:
+        users = self.users
+        prevCuid = self.cuid
+        uid = users.lookup(event.name)
+        if uid != -1:
+            self.cuid = uid
+
+        if self.cuid == -1:
+            logger.error("Couldn't find a user with a name %s (%s)", event.name, stream_id)
+            return
+
+        cuid = self.cuid
+        name = users.name(cuid)
+        # PBKDF2 считается до захвата блокировки полосы; для занятого или
+        # заблокированного пользователя пароль не понадобится
+        passwd_ok = None
+        if not users.has_authd(cuid) and users.retries(cuid) < 3:
+            passwd_ok = users.check_passwd(cuid, event.passwd)
+        # ожидание занятой полосы - этап lock_wait трассировки (tracing.py)
+        lock = users.lock(cuid)
+        if not lock.acquire(False):
+            TRACER.wait(lock)
+        try:
+            authd = users.authd(cuid)
+            if authd == slot_id(stream_id):
+                logger.info("You are already logged in (%s)", stream_id)
+                return
+
+            if authd:
+                logger.error("User %s already authd from %s (%s)", name, authd, stream_id)
+                self.cuid = -1
+                return
+
+            if users.retries(cuid) >= 3:
+                logger.error("Can't access user %s, user is blocked (%s)", name, stream_id)
+                self.cuid = -1
+                return
+
+            if passwd_ok is None:
+                # пока ждали блокировку, пользователь освободился
+                passwd_ok = users.check_passwd(cuid, event.passwd)
+            if not passwd_ok:
+                retries = users.retries(cuid) + 1
+                users.set_retries(cuid, retries)
+                self.ssh_failures += 1
+                if retries == 3:
+                    self.lockouts += 1
+                logger.error("Wrong password for user %s (%s)", name, stream_id)
+                self.cuid = -1
+                return
+
+            users.set_authd(cuid, stream_id)
+            users.set_retries(cuid, 0)
+            logger.info("User %s authd (%s)", name, stream_id)
+        finally:
+            lock.release()
+
+        # выходим из предыдущего пользователя после освобождения текущей
+        # блокировки, чтобы не держать две сразу
+        if prevCuid != -1 and prevCuid != cuid:
+            with users.lock(prevCuid):
+                if users.authd(prevCuid) == slot_id(stream_id):
+                    users.set_authd(prevCuid, "")
+
+    def logout(self, stream_id: str) -> None:
+        """Выход из текущего пользователя при закрытии потока."""
+        cuid = self.cuid
+        if cuid == -1:
+            return
+        with self.users.lock(cuid):
+            if self.users.authd(cuid) == slot_id(stream_id):
+                self.users.set_authd(cuid, "")
+        self.cuid = -1
+
+    def handle_sudo(self, stream_id: str, event) -> None:
+        if self.cuid == -1:
+            return
+        name = self.users.name(self.cuid)
+        if self.users.check_passwd(self.cuid, event.passwd):
+            logger.info("Accepted sudo on user %s (%s)", name, stream_id)
+        else:
+            self.sudo_failures += 1
+            logger.error("Bad password for sudo on user %s (%s)", name, stream_id)
+
+    def handle_dir(self, stream_id: str, event) -> None:
+        if self.cuid == -1:
+            return
+        logger.info("Accepted dir on user %s (%s)", self.users.name(self.cuid), stream_id)
@@ -0,0 +1,266 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, List, Optional, Union
+
+from decode import DecodeError, decode_stream, decode_batch, decode_events, try_decode_stream
+from models import Stream
+from session_table import SessionTable, handle_event
+from tracing import PROFILE, STAGES, TRACER, window_seconds
+from wal import WAL_COMMIT_TIMEOUT, EventLog
+from metrics import (Metrics, CONTENT_TYPE, render, STREAMS_ACCEPTED, REJECTED_DECODE, REJECTED_LIMIT,
+                     REJECTED_QUEUE_FULL, REJECTED_SHUTDOWN, REQUEST_STREAM, REQUEST_BATCH, STAGE_DECODE)
+
+logger = logging.getLogger()
+
+# Приём потоков и HTTP-сервер Flask, общие для threading-, multiprocessing-
+# и sharded-обработчиков: они отличаются только пулом (потоки, процессы или
+# шарды), CurrentUser и тем, откуда берутся метрики воркеров.
+# Обработчик создаёт StreamServer со своим пулом и снимком метрик, а
+# сессии (sessions) и журнал (wal) назначает в main, когда они готовы.
+
+BATCH_CHUNK = 256
+REQUEST_HISTOGRAMS = {"/": REQUEST_STREAM, "/batch": REQUEST_BATCH}
+
+
+class StreamServer:
+    def __init__(self, pool: Any, metrics: Metrics, snapshot: Callable[[], List[int]], done: threading.Event,
+                 max_streams: int, queue_size: int, handle_event: Callable = handle_event):
+        # pool - pool.ThreadWorkerPool, ProcessWorkerPool или shard.ShardedEngine;
+        # metrics - шарды потоков сервера, snapshot - они же вместе с метриками
+        # воркеров; handle_event - событие сессии (у шардов - shard.handle_event)
+        self.pool = pool
+        self.metrics = metrics
+        self.snapshot = snapshot
+        self.done = done
+        self.max_streams = max_streams
+        self.queue_size = queue_size
+        self.handle_event = handle_event
+        self.total = 0
+        self.lock = threading.Lock()
+        self.sessions: Optional[SessionTable] = None
+        # журнал принятых событий (WAL_DIR), None - без журнала
+        self.wal: Optional[EventLog] = None
+        # потоки, записанные в журнал и ждущие commit(), - их место в очереди занято
+        self._reserved = 0
+
+    def close_session(self, session) -> None:
+        if self.wal is None:
+            session.cu.logout(session.stream_id)
+            return
+        # запись о закрытии и сам выход - под блокировкой журнала, чтобы снимок не встал между ними
+        with self.wal.lock:
+            self.wal.append_close(session.stream_id)
+            session.cu.logout(session.stream_id)
+
+    def handle_session_event(self, session, event, shard) -> None:
+        if self.wal is not None:
+            self.wal.append_event(session.stream_id, event)
+        self.handle_event(session, event, shard)
+
+    def accept_streams(self, streams: List[Union[Stream, DecodeError]]) -> List[tuple]:
+        # вся пачка проверяется и пишется в журнал под одним захватом блокировки;
+        # с журналом в очередь воркеров она встаёт после commit()
+        wal = self.wal
+        max_streams = self.max_streams
+        results = []
+        logged = []
+        shard = self.metrics.shard()
+        accepted_ns = TRACER.now()
+        with self.lock:
+            for stream in streams:
+                if isinstance(stream, DecodeError):
+                    shard.inc(REJECTED_DECODE)
+                    results.append(({"error": str(stream)}, 400))
+                    continue
+                if max_streams and self.total >= max_streams:
+                    shard.inc(REJECTED_LIMIT)
+                    results.append(({"error": "Maximum streams limit reached", "stream_id": stream.stream_id}, 429))
+                    continue
+                # идёт остановка: новые потоки не берём, доделываем принятые
+                if self.done.is_set():
+                    shard.inc(REJECTED_SHUTDOWN)
+                    results.append(({"error": "Server is shutting down", "stream_id": stream.stream_id}, 503))
+                    continue
+                stream.accepted_ns = accepted_ns
+                if wal is None:
+                    queued = self.pool.submit(stream)
+                else:
+                    # место в очереди держится за потоком до commit(): кладут в неё
+                    # только под self.lock, а воркеры её лишь освобождают
+                    queued = self.pool.qsize() + self._reserved < self.queue_size
+                if not queued:
+                    shard.inc(REJECTED_QUEUE_FULL)
+                    results.append(({"error": "Stream queue is full", "stream_id": stream.stream_id}, 503))
+                    continue
+                if wal is not None:
+                    wal.append_stream(stream)
+                    logged.append(stream)
+                    self._reserved += 1
+                shard.inc(STREAMS_ACCEPTED)
+                self.total += 1
+                results.append(({
+                    "status": "processing_started",
+                    "stream_id": stream.stream_id,
+                    "count": f"{self.total}/{max_streams}" if max_streams else str(self.total),
+                }, 200))
+            if max_streams and self.total >= max_streams:
+                self.done.set()
+        if logged:
+            # воркерам - только то, что уже на диске; ждущие запросы делят один fsync
+            if not wal.commit():
+                logger.error("Журнал не записан за %.0f с, потоки обрабатываются без него", WAL_COMMIT_TIMEOUT)
+            with self.lock:
+                self._reserved -= len(logged)
+                for stream in logged:
+                    if not self.pool.submit(stream):
+                        # только при остановке, когда место заняли стоп-маркеры
+                        logger.warning("Поток %s не поставлен в очередь, он повторится из журнала",
+                                       stream.stream_id)
+        return results
+
+    def accept_frames(self, streams: List[Union[Stream, DecodeError]]) -> List[int]:
+        # двоичный приём по TCP (wire.py): клиенту уходят только коды
+        return [code for _, code in self.accept_streams(streams)]
+
+    def create_app(self):
+        # Flask импортируется только для HTTP-сервера: в режиме --file и в
+        # воркерах пула (multiprocessing создаёт приложение после их fork) его нет
+        from flask import Flask, Response, request, jsonify
+
+        app = Flask(__name__)
+        metrics = self.metrics
+        sessions = self.sessions
+        accept_streams = self.accept_streams
+        handle_session_event = self.handle_session_event
+
+        @app.before_request
+        def start_request_timer():
+            request.environ["start_ns"] = time.perf_counter_ns()
+
+        @app.after_request
+        def observe_request(response):
+            hist = REQUEST_HISTOGRAMS.get(request.path)
+            if hist is not None:
+                metrics.shard().observe(hist, time.perf_counter_ns() - request.environ["start_ns"])
+            return response
+
+        @app.route("/metrics", methods=["GET"])
+        def metrics_page():
+            body = render(self.snapshot(), {"queue_depth": self.pool.qsize(), "sessions_open": len(sessions)})
+            return Response(body, content_type=CONTENT_TYPE)
+
+        @app.route("/", methods=["POST"])
+        def receive_stream():
+            try:
+                stream = TRACER.call(STAGE_DECODE, decode_stream, request.get_data())
+            except DecodeError as e:
+                metrics.shard().inc(REJECTED_DECODE)
+                return jsonify({"error": str(e)}), 400
+
+            body, code = accept_streams([stream])[0]
+            if code == 503:
+                return jsonify(body), code, {"Retry-After": "1"}
+            return jsonify(body), code
+
+        @app.route("/batch", methods=["POST"])
+        def receive_batch():
+            # массив потоков в JSON или NDJSON (по потоку на строку), который
+            # разбирается и ставится в очередь пачками по мере чтения тела запроса
+            results = []
+            if request.mimetype == "application/x-ndjson":
+                batch = []
+                tail = b""
+                while True:
+                    chunk = request.stream.read(64 * 1024)
+                    if not chunk:
+                        break
+                    lines = (tail + chunk).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        if line.strip():
+                            batch.append(TRACER.call(STAGE_DECODE, try_decode_stream, line))
+                    if len(batch) >= BATCH_CHUNK:
+                        results.extend(accept_streams(batch))
+                        batch = []
+                if tail.strip():
+                    batch.append(TRACER.call(STAGE_DECODE, try_decode_stream, tail))
+                results.extend(accept_streams(batch))
+            else:
+                try:
+                    streams = TRACER.call(STAGE_DECODE, decode_batch, request.get_data())
+                except DecodeError as e:
+                    metrics.shard().inc(REJECTED_DECODE)
+                    return jsonify({"error": str(e)}), 400
+                results = accept_streams(streams)
+
+            return jsonify({
+                "accepted": sum(1 for _, code in results if code == 200),
+                "results": [dict(body, code=code) for body, code in results],
+            })
+
+        # --------- поштучная подача событий ---------
+        @app.route("/streams/<stream_id>/events", methods=["POST"])
+        def append_events(stream_id):
+            # события дописываются в открытый поток и обрабатываются сразу;
+            # в NDJSON (в том числе chunked) - по мере прихода строк
+            if self.done.is_set():
+                return jsonify({"error": "Server is shutting down", "stream_id": stream_id}), 503
+            session = sessions.open_locked(stream_id)
+            if session is None:
+                return jsonify({"error": "Too many open streams", "stream_id": stream_id}), 503
+
+            shard = metrics.shard()
+            accepted = 0
+            try:
+                if request.mimetype == "application/x-ndjson":
+                    while True:
+                        line = request.stream.readline()
+                        if not line:
+                            break
+                        if not line.strip():
+                            continue
+                        # строка - объект или массив событий, как и тело целиком
+                        for event in TRACER.call(STAGE_DECODE, decode_events, line, stream_id, session.events):
+                            handle_session_event(session, event, shard)
+                            accepted += 1
+                else:
+                    for event in TRACER.call(STAGE_DECODE, decode_events, request.get_data(), stream_id,
+                                             session.events):
+                        handle_session_event(session, event, shard)
+                        accepted += 1
+            except DecodeError as e:
+                return jsonify({"error": str(e), "stream_id": stream_id, "accepted": accepted}), 400
+            finally:
+                sessions.touch(session)
+                session.lock.release()
+            return jsonify({"stream_id": stream_id, "accepted": accepted, "events": session.events})
+
+        @app.route("/streams/<stream_id>", methods=["DELETE"])
+        def close_stream(stream_id):
+            if not sessions.close(stream_id):
+                return jsonify({"error": "Stream is not open", "stream_id": stream_id}), 404
+            return jsonify({"stream_id": stream_id, "status": "closed"})
+
+        # --------- трассировка (tracing.py) ---------
+        @app.route("/admin/trace", methods=["POST"])
+        def admin_trace():
+            return trace_window(STAGES)
+
+        @app.route("/admin/profile", methods=["POST"])
+        def admin_profile():
+            return trace_window(PROFILE)
+
+        def trace_window(mode):
+            # ответ - после окна в ?seconds=N секунд (по умолчанию 10); у multiprocessing
+            # и sharded этапы и стеки воркеров собираются через общую память и TRACE_DIR
+            try:
+                seconds = window_seconds(request.args.get("seconds"))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            body = TRACER.record(mode, seconds)
+            if body is None:
+                return jsonify({"error": "Trace window is already open"}), 409
+            return Response(body, content_type="text/plain; charset=utf-8")
+
+        return app
@@ -0,0 +1,366 @@
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from events import dispatch_table
+from metrics import (EVENT_COUNTERS, HANDLER_BY_COUNTER, HISTOGRAMS, REQUEST_STREAM, REQUEST_BATCH, HANDLE_STREAM,
+                     STAGE_DECODE, STAGE_DISPATCH, STAGE_LOCK_WAIT, STAGE_LOG, HANDLER_SSH, HANDLER_SUDO, HANDLER_DIR,
+                     HANDLER_OTHER, hist_count, hist_sum_ns, quantile_ns)
+
+logger = logging.getLogger()
+
+# Трассировка этапов и профиль по запросу, пока сервер работает.
+#
+# Итог handle_stream в метриках не говорит, куда ушло время. В окне
+# трассировки (STAGES) пишутся гистограммы trace_* (metrics.py):
+#   decode    - разбор JSON потоков и событий из запроса (TRACER.call);
+#   dispatch  - от приёма потока до начала handle_stream: очередь и ожидание
+#               воркера (Stream.accepted_ns);
+#   обработчик по типу события - таблица вызовов с замером на каждом вызове,
+#               включая user lookup, PBKDF2 и обёртки детектора;
+#   lock_wait - ожидание занятой блокировки пользователя (TRACER.wait);
+#   log       - обработка записи корневым логгером (форматирование и запись
+#               при LOG_MODE=sync, постановка в очередь при queue).
+# Профиль (PROFILE) - поток-семплер, который каждые TRACE_SAMPLE_MS
+# снимает стеки всех потоков процесса (sys._current_frames) и копит их в
+# свёрнутом виде для flame graph: "процесс/поток;функция (файл:строка);... N".
+#
+# Вне окна хуки почти ничего не стоят: на поток и на запрос - сравнение
+# номера окна с локальным (TRACER.handlers, TRACER.call), ожидание
+# блокировки меряется, только если она уже занята, а логгер и таблицы
+# вызовов подменяются лишь на время окна.
+#
+# Окно открывают:
+#   POST /admin/trace?seconds=N   - ответ: таблица этапов за N секунд;
+#   POST /admin/profile?seconds=N - ответ: свёрнутые стеки за N секунд;
+#   SIGUSR1 - этапы и профиль до следующего SIGUSR1 (не дольше
+#             TRACE_MAX_SECONDS), таблица - в лог, стеки - в TRACE_DIR.
+# Одновременно открыто одно окно. Состояние окна при shared=True лежит в
+# общей памяти: процессы multiprocessing и asyncio с PROCS > 1 замечают
+# новое окно на следующем потоке или запросе и переключают у себя
+# логгер, таблицы и семплер; стеки каждый процесс пишет в свой файл в
+# TRACE_DIR, а открывший окно процесс их собирает.
+
+TRACE_DIR = os.environ.get("TRACE_DIR", tempfile.gettempdir())
+TRACE_SAMPLE_MS = float(os.environ.get("TRACE_SAMPLE_MS", 5))
+TRACE_MAX_SECONDS = float(os.environ.get("TRACE_MAX_SECONDS", 300))
+
+STAGES = 1
+PROFILE = 2
+
+# строки отчёта: запросы и handle_stream - для сравнения с этапами
+REPORT = (REQUEST_STREAM, REQUEST_BATCH, STAGE_DECODE, STAGE_DISPATCH, HANDLE_STREAM,
+          HANDLER_SSH, HANDLER_SUDO, HANDLER_DIR, HANDLER_OTHER, STAGE_LOCK_WAIT, STAGE_LOG)
+
+
+def window_seconds(value: Optional[str], default: float = 10) -> float:
+    """Длина окна из параметра запроса ?seconds=; ValueError, если не подходит."""
+    seconds = default if value is None else float(value)
+    if not 0 < seconds <= TRACE_MAX_SECONDS:
+        raise ValueError(f"seconds must be in (0, {TRACE_MAX_SECONDS:g}]")
+    return seconds
+
+
+def stage_name(hist: int) -> str:
+    name, labels = HISTOGRAMS[hist]
+    if name == "trace_handler_duration_seconds":
+        return "handler " + labels[len('type="'):-1]
+    if name == "trace_stage_duration_seconds":
+        return labels[len('stage="'):-1]
+    if name == "request_duration_seconds":
+        return "request " + labels[len('path="'):-1]
+    return name[:-len("_duration_seconds")]
+
+
+def stage_report(delta: List[int], seconds: float) -> str:
+    """Таблица этапов за окно: delta - разность снимков метрик."""
+    lines = [f"Трассировка за {seconds:.1f} с:",
+             f"{'этап':<16}{'вызовов':>10}{'всего, мс':>12}{'среднее, мкс':>14}{'p50, мкс':>12}{'p99, мкс':>12}"]
+    for hist in REPORT:
+        count = hist_count(delta, hist)
+        total = hist_sum_ns(delta, hist)
+        lines.append(f"{stage_name(hist):<16}{count:>10}{total / 1e6:>12.3f}{total / max(count, 1) / 1e3:>14.3f}"
+                     f"{quantile_ns(delta, hist, 0.5) / 1e3:>12.3f}{quantile_ns(delta, hist, 0.99) / 1e3:>12.3f}")
+    return "\n".join(lines)
+
+
+def merge_stacks(paths: List[str]) -> Counter:
+    stacks: Counter = Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, n = line.rstrip("\n").rpartition(" ")
+                if stack:
+                    stacks[stack] += int(n)
+    return stacks
+
+
+def render_stacks(stacks: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+class Sampler(threading.Thread):
+    """Стеки всех потоков процесса раз в interval секунд, пока окно generation открыто."""
+
+    def __init__(self, tracer: "Tracer", generation: int, token: int, interval: float):
+        super().__init__(name="trace-sampler", daemon=True)
+        self.tracer = tracer
+        self.generation = generation
+        self.token = token
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        # подпись кадра по объекту кода: строки собираются один раз
+        self._labels: Dict[Any, str] = {}
+
+    def run(self) -> None:
+        state = self.tracer.state
+        own = threading.get_ident()
+        process = multiprocessing.current_process().name
+        while state[1] == self.generation:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(f"{process}/{names.get(ident, ident)}", frame)
+            time.sleep(self.interval)
+        self._write()
+
+    def _sample(self, root: str, frame) -> None:
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = (f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                                        f"{code.co_firstlineno})").replace(";", ":")
+            stack.append(label)
+            frame = frame.f_back
+        stack.append(root)
+        stack.reverse()
+        self.stacks[";".join(stack)] += 1
+
+    def _write(self) -> None:
+        if not self.stacks:
+            return
+        path = os.path.join(TRACE_DIR, f"trace-{self.token}-{os.getpid()}.folded")
+        with open(path, "w") as f:
+            f.write(render_stacks(self.stacks))
+
+
+class Tracer:
+    """Окно трассировки: общее состояние, локальные хуки процесса."""
+
+    def __init__(self):
+        self.metrics = None
+        # снимок для отчёта: у multiprocessing запросы считает процесс сервера отдельно
+        self.snapshot: Optional[Callable[[], List[int]]] = None
+        self.shared = False
+        # режим окна, номер (меняется при открытии и закрытии) и метка файлов стеков
+        self.state = [0, 0, 0]
+        self._lock = threading.Lock()
+        # что уже включено в этом процессе
+        self.mode = 0
+        self.generation = 0
+        self._sync_lock = threading.Lock()
+        self._tables: Dict[type, Tuple[list, list]] = {}
+        self._sampler: Optional[Sampler] = None
+        # открытое окно: (режим, метка, снимок метрик, начало)
+        self._window: Optional[tuple] = None
+        self._toggled: Optional[threading.Event] = None
+
+    # --------- хуки ---------
+    def handlers(self, cls: type, stream=None) -> List[Callable]:
+        """dispatch_table(cls), в окне - с замером обработчиков и ожидания в очереди."""
+        if self.state[1] != self.generation:
+            self._sync()
+        if not self.mode & STAGES:
+            return dispatch_table(cls)
+        if stream is not None and stream.accepted_ns:
+            self.observe(STAGE_DISPATCH, time.perf_counter_ns() - stream.accepted_ns)
+        return self._table(cls)
+
+    def call(self, hist: int, fn: Callable, *args):
+        """fn(*args), в окне - с замером в гистограмму hist."""
+        if self.state[1] != self.generation:
+            self._sync()
+        if not self.mode & STAGES:
+            return fn(*args)
+        start_ns = time.perf_counter_ns()
+        try:
+            return fn(*args)
+        finally:
+            self.observe(hist, time.perf_counter_ns() - start_ns)
+
+    def now(self) -> int:
+        """Отметка приёма потока для dispatch: perf_counter_ns в окне, иначе 0."""
+        if self.state[1] != self.generation:
+            self._sync()
+        return time.perf_counter_ns() if self.mode & STAGES else 0
+
+    def wait(self, lock) -> None:
+        """Захват блокировки, которую не удалось взять без ожидания."""
+        if not self.mode & STAGES:
+            lock.acquire()
+            return
+        start_ns = time.perf_counter_ns()
+        lock.acquire()
+        self.observe(STAGE_LOCK_WAIT, time.perf_counter_ns() - start_ns)
+
+    def observe(self, hist: int, ns: int) -> None:
+        self.metrics.shard().observe(hist, ns)
+
+    # --------- окно ---------
+    def begin(self, mode: int) -> Optional[int]:
+        """Открыть окно; метка окна или None, если уже открыто."""
+        state = self.state
+        with self._lock:
+            if state[0]:
+                return None
+            token = time.time_ns() // 1000
+            state[2] = token
+            state[0] = mode
+            state[1] += 1
+        self._window = (mode, token, self.snapshot(), time.monotonic())
+        self._sync()
+        return token
+
+    def end(self) -> Tuple[str, str]:
+        """Закрыть окно, открытое этим процессом: (таблица этапов, свёрнутые стеки)."""
+        mode, token, start, started = self._window
+        self._window = None
+        with self._lock:
+            self.state[0] = 0
+            self.state[1] += 1
+        self._sync()
+        seconds = time.monotonic() - started
+        delta = [c - p for c, p in zip(self.snapshot(), start)]
+        report = stage_report(delta, seconds) if mode & STAGES else ""
+        stacks = render_stacks(self._collect(token)) if mode & PROFILE else ""
+        return report, stacks
+
+    def record(self, mode: int, seconds: float) -> Optional[str]:
+        """Окно на seconds секунд для /admin/*: таблица этапов или, для PROFILE,
+        свёрнутые стеки; None, если окно уже открыто."""
+        if self.begin(mode) is None:
+            return None
+        time.sleep(seconds)
+        report, stacks = self.end()
+        return stacks if mode & PROFILE else report + "\n"
+
+    def toggle(self) -> None:
+        """SIGUSR1: открыть окно этапов и профиля или закрыть открытое этим же сигналом."""
+        # событие занимается до открытия окна: сигнал, пришедший, пока
+        # открывается это, закроет его, а не попробует открыть второе
+        with self._lock:
+            opened = self._toggled
+            if opened is None:
+                stop = self._toggled = threading.Event()
+        if opened is not None:
+            opened.set()
+            return
+        token = self.begin(STAGES | PROFILE)
+        if token is None:
+            with self._lock:
+                self._toggled = None
+            logger.warning("Окно трассировки уже открыто, SIGUSR1 пропущен")
+            return
+        logger.info("Трассировка включена до следующего SIGUSR1 (не дольше %.0f с)", TRACE_MAX_SECONDS)
+        stop.wait(TRACE_MAX_SECONDS)
+        with self._lock:
+            self._toggled = None
+        report, stacks = self.end()
+        logger.info("%s", report)
+        if stacks:
+            path = os.path.join(TRACE_DIR, f"profile-{token}.folded")
+            with open(path, "w") as f:
+                f.write(stacks)
+            logger.info("Профиль записан в %s", path)
+
+    # --------- переключение в процессе ---------
+    def _sync(self) -> None:
+        with self._sync_lock:
+            state = self.state
+            generation = state[1]
+            if generation == self.generation:
+                return
+            mode = state[0]
+            self.generation = generation
+            if mode & STAGES and not self.mode & STAGES:
+                self._hook_logging()
+            elif self.mode & STAGES and not mode & STAGES:
+                logging.getLogger().__dict__.pop("handle", None)
+            self.mode = mode
+            self._tables.clear()
+            if mode & PROFILE:
+                # семплер прошлого окна выходит сам, увидев новый номер
+                self._sampler = Sampler(self, generation, state[2], TRACE_SAMPLE_MS / 1000)
+                self._sampler.start()
+
+    def _hook_logging(self) -> None:
+        root = logging.getLogger()
+        handle = root.handle
+        observe = self.observe
+
+        def traced(record):
+            start_ns = time.perf_counter_ns()
+            handle(record)
+            observe(STAGE_LOG, time.perf_counter_ns() - start_ns)
+        root.handle = traced
+
+    def _table(self, cls: type) -> List[Callable]:
+        base = dispatch_table(cls)
+        entry = self._tables.get(cls)
+        if entry is None or entry[0] is not base:
+            # код 0 - заглушка для незарегистрированных типов, её не меряем
+            table = [base[0]] + [self._timed(handler, HANDLER_BY_COUNTER[EVENT_COUNTERS[code]])
+                                 for code, handler in enumerate(base) if code]
+            entry = self._tables[cls] = (base, table)
+        return entry[1]
+
+    def _timed(self, handler: Callable, hist: int) -> Callable:
+        observe = self.observe
+
+        def traced(cu, stream_id: str, event) -> None:
+            start_ns = time.perf_counter_ns()
+            try:
+                handler(cu, stream_id, event)
+            finally:
+                observe(hist, time.perf_counter_ns() - start_ns)
+        return traced
+
+    def _collect(self, token: int) -> Counter:
+        sampler = self._sampler
+        if sampler is not None and sampler.token == token:
+            sampler.join()
+        if self.shared:
+            # семплеры других процессов замечают закрытие окна за один шаг
+            time.sleep(2 * TRACE_SAMPLE_MS / 1000 + 0.1)
+        paths = glob.glob(os.path.join(TRACE_DIR, f"trace-{token}-*.folded"))
+        stacks = merge_stacks(paths)
+        for path in paths:
+            os.unlink(path)
+        return stacks
+
+
+# один на процесс: хуки в session.py и обработчиках обращаются к нему напрямую
+TRACER = Tracer()
+
+
+def open_tracer(metrics, shared: bool = False,
+                snapshot: Optional[Callable[[], List[int]]] = None) -> Tracer:
+    """Настроить TRACER: куда писать этапы и откуда брать снимок для отчёта
+    (по умолчанию metrics.snapshot); shared=True - до fork воркеров."""
+    TRACER.metrics = metrics
+    TRACER.snapshot = snapshot if snapshot is not None else metrics.snapshot
+    TRACER.shared = shared
+    if shared:
+        TRACER.state = multiprocessing.RawArray("q", 3)
+        TRACER._lock = multiprocessing.Lock()
+    return TRACER
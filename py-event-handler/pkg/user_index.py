@@ -0,0 +1,61 @@
+from typing import Dict, List, Optional, Iterator, Tuple, Any
+
+
+class UserIndex:
+    """Реестр пользователей: хеш-индекс name -> uid и массив uid -> User.
+
+    Поиск по имени за O(1) вместо линейного прохода по USERS.items().
+    Удалённые uid не переиспользуются, чтобы cuid в текущих потоках
+    не начал указывать на другого пользователя.
+    """
+
+    def __init__(self, users: Optional[Dict[int, Any]] = None):
+        self._by_name: Dict[str, int] = {}
+        self._users: List[Any] = []
+        if users:
+            for uid in sorted(users):
+                self.insert(users[uid], uid)
+
+    def insert(self, user: Any, uid: int = -1) -> int:
+        if user.name in self._by_name:
+            raise KeyError(f"user {user.name} already exists")
+        if uid == -1:
+            uid = len(self._users)
+        if uid < len(self._users) and self._users[uid] is not None:
+            raise KeyError(f"uid {uid} already taken")
+        while len(self._users) <= uid:
+            self._users.append(None)
+        self._users[uid] = user
+        self._by_name[user.name] = uid
+        return uid
+
+    def remove(self, uid: int) -> None:
+        user = self._users[uid]
+        if user is None:
+            raise KeyError(uid)
+        del self._by_name[user.name]
+        self._users[uid] = None
+
+    def mark(self, uid: int, user: Any) -> None:
+        # все пользователи и так в памяти, см. directory.Directory.mark
+        pass
+
+    def lookup(self, name: str) -> int:
+        return self._by_name.get(name, -1)
+
+    def __getitem__(self, uid: int) -> Any:
+        user = self._users[uid]
+        if user is None:
+            raise KeyError(uid)
+        return user
+
+    def __contains__(self, uid: int) -> bool:
+        return 0 <= uid < len(self._users) and self._users[uid] is not None
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def items(self) -> Iterator[Tuple[int, Any]]:
+        for uid, user in enumerate(self._users):
+            if user is not None:
+                yield uid, user
@@ -0,0 +1,516 @@
+import glob
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from events import dispatch_table, name_of
+from metrics import EVENT_APPEND, HANDLE_STREAM, hist_count
+from models import Event, Stream
+
+logger = logging.getLogger()
+
+# Журнал принятых событий (write-ahead log) и снимки состояния пользователей.
+#
+# Обработчик дописывает в журнал каждый принятый поток, каждое событие
+# открытого потока и каждое закрытие потока - в том порядке, в каком он их
+# принял, и до того, как отдать их на обработку. append() только кладёт
+# запись в очередь; кодирует, пишет пачками и делает fsync отдельный
+# поток-писатель, раз в WAL_FSYNC_INTERVAL секунд или сразу, если кто-то ждёт
+# в commit() (групповой коммит: один fsync на всех ждущих). Принятые потоки
+# обработчик ставит в очередь воркеров только после commit(), так что
+# клиент не получит ответ о приёме потока, которого нет на диске; события
+# открытых потоков обрабатываются сразу, и после падения из них теряется не
+# больше окна WAL_FSYNC_INTERVAL.
+#
+# Журнал - сегменты wal-<seq>.log, где seq - номер первой записи сегмента.
+# Запись: длина:I crc32:I, затем тело
+#   kind:B id_len:I id [n:I] n * (type:B name_len:I name passwd_len:I passwd)
+# type - код типа из реестра (events.py)
+# (n и события - у потока, у события открытого потока - одно событие без n,
+# у закрытия событий нет). Оборванная или испорченная запись в конце сегмента
+# отбрасывается при восстановлении.
+#
+# Снимок snapshot-<seq>.json - authd и auth_retries всех "грязных"
+# пользователей после первых seq записей и открытые потоки с их текущим
+# пользователем (capture). Снимок снимается только в покое:
+# под блокировкой журнала (новые записи не добавляются) и когда все
+# записанные потоки и события уже обработаны, иначе в снимок попало бы
+# полсостояния. Под постоянной нагрузкой снимок откладывается до паузы; при
+# штатной остановке он снимается всегда. После снимка старые сегменты и
+# снимки удаляются.
+#
+# Восстановление: последний снимок, затем записи после него по одной, в
+# порядке журнала (порядке приёма), через CurrentUser обработчика. Вживую
+# принятые потоки обрабатываются параллельно, так что у потоков, которые
+# спорят за одного пользователя (два входа, ошибки пароля вперемешку с
+# входом), исход при повторе - как если бы они шли строго по очереди приёма,
+# и может отличаться от того, что было: например, войдёт другой из двух
+# потоков. Снимок снимается в покое и точен; расхождение возможно только в
+# хвосте журнала после него. Потоки, которые при остановке или падении ещё
+# были открыты, в конце закрываются, как при простое: сессии не переживают
+# перезапуск.
+
+WAL_DIR = os.environ.get("WAL_DIR", "")  # пусто - журнал выключен
+WAL_FSYNC_INTERVAL = float(os.environ.get("WAL_FSYNC_INTERVAL", 0.05))
+WAL_FSYNC = os.environ.get("WAL_FSYNC", "1") != "0"
+# сколько ждать commit(), если диск не отвечает: дальше поток обрабатывается без гарантии
+WAL_COMMIT_TIMEOUT = float(os.environ.get("WAL_COMMIT_TIMEOUT", 5))
+WAL_SEGMENT_SIZE = int(os.environ.get("WAL_SEGMENT_SIZE", 64 * 2**20))
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", 60))
+
+KIND_STREAM, KIND_EVENT, KIND_CLOSE = 1, 2, 3
+
+_frame = struct.Struct("<II")
+_head = struct.Struct("<BI")
+_count = struct.Struct("<I")
+_event = struct.Struct("<BI")
+_len = struct.Struct("<I")
+
+
+class Record(NamedTuple):
+    seq: int
+    kind: int
+    stream_id: str
+    events: List[Event]
+
+
+# --------- кодирование ---------
+def encode(kind: int, stream_id: str, events) -> bytes:
+    raw_id = stream_id.encode()
+    parts = [_head.pack(kind, len(raw_id)), raw_id]
+    if kind == KIND_STREAM:
+        parts.append(_count.pack(len(events)))
+    for event in events:
+        name = event.name.encode()
+        passwd = event.passwd.encode()
+        parts += (_event.pack(event.code, len(name)), name, _len.pack(len(passwd)), passwd)
+    body = b"".join(parts)
+    return _frame.pack(len(body), zlib.crc32(body)) + body
+
+
+def _decode_event(body: memoryview, off: int) -> Tuple[Event, int]:
+    code, n = _event.unpack_from(body, off)
+    off += _event.size
+    name = str(body[off:off + n], "utf-8")
+    off += n
+    n, = _len.unpack_from(body, off)
+    off += _len.size
+    passwd = str(body[off:off + n], "utf-8")
+    return Event(name_of(code), name, passwd), off + n
+
+
+def decode(seq: int, body: memoryview) -> Record:
+    kind, n = _head.unpack_from(body, 0)
+    off = _head.size
+    stream_id = str(body[off:off + n], "utf-8")
+    off += n
+    events = []
+    if kind == KIND_STREAM:
+        count, = _count.unpack_from(body, off)
+        off += _count.size
+        for _ in range(count):
+            event, off = _decode_event(body, off)
+            events.append(event)
+    elif kind == KIND_EVENT:
+        events.append(_decode_event(body, off)[0])
+    return Record(seq, kind, stream_id, events)
+
+
+# --------- файлы ---------
+def _segment_path(directory: str, seq: int) -> str:
+    return os.path.join(directory, f"wal-{seq:016d}.log")
+
+
+def _numbered(directory: str, pattern: str) -> List[Tuple[int, str]]:
+    found = []
+    for path in glob.glob(os.path.join(directory, pattern)):
+        try:
+            found.append((int(os.path.basename(path).split("-")[1].split(".")[0]), path))
+        except ValueError:
+            continue
+    return sorted(found)
+
+
+def segments(directory: str) -> List[Tuple[int, str]]:
+    return _numbered(directory, "wal-*.log")
+
+
+def _fsync_dir(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_segment(path: str, first_seq: int) -> Iterator[Tuple[Record, int]]:
+    """Записи сегмента и смещение конца каждой; на испорченной записи - стоп."""
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+    off = 0
+    seq = first_seq
+    while off + _frame.size <= len(data):
+        length, crc = _frame.unpack_from(data, off)
+        body = data[off + _frame.size:off + _frame.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        off += _frame.size + length
+        yield decode(seq, body), off
+        seq += 1
+
+
+def read_log(directory: str, start: int = 0) -> Iterator[Record]:
+    """Записи журнала с номера start по порядку."""
+    for first, path in segments(directory):
+        for record, _ in read_segment(path, first):
+            if record.seq >= start:
+                yield record
+
+
+def read_snapshot(directory: str) -> Optional[Tuple[int, Dict[str, list]]]:
+    snaps = _numbered(directory, "snapshot-*.json")
+    for seq, path in reversed(snaps):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            return data["seq"], data
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Снимок %s не читается: %s", path, e)
+    return None
+
+
+def write_snapshot(directory: str, seq: int, state: Dict[str, list]) -> str:
+    path = os.path.join(directory, f"snapshot-{seq:016d}.json")
+    tmp = path + ".tmp"
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+        json.dump(dict(state, seq=seq, time=time.time()), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(directory)
+    return path
+
+
+def capture(users, sessions) -> Dict[str, list]:
+    """Состояние для снимка: грязные пользователи и открытые потоки.
+
+    users - каталог (directory.Directory) или shm_users.SharedUserTable, у
+    обоих есть dirty() и name(); sessions - session_table.SessionTable.
+    """
+    return {
+        "users": users.dirty(),
+        "sessions": [[s.stream_id, users.name(s.cu.cuid) if s.cu.cuid != -1 else ""]
+                     for s in sessions.open_sessions()],
+    }
+
+
+def processed(snapshot: List[int]) -> int:
+    """Доведённые до конца потоки и события открытых потоков по метрикам."""
+    return hist_count(snapshot, HANDLE_STREAM) + hist_count(snapshot, EVENT_APPEND)
+
+
+# --------- восстановление ---------
+def apply(record: Record, make_cu: Callable[[], Any], sessions: Dict[str, Any]) -> None:
+    """Одна запись журнала через CurrentUser обработчика."""
+    stream_id = record.stream_id
+    if record.kind == KIND_CLOSE:
+        cu = sessions.pop(stream_id, None)
+        if cu is not None:
+            cu.logout(stream_id)
+        return
+    if record.kind == KIND_STREAM:
+        cu = make_cu()
+    else:
+        cu = sessions.get(stream_id)
+        if cu is None:
+            cu = sessions[stream_id] = make_cu()
+    handlers = dispatch_table(type(cu))
+    for event in record.events:
+        handlers[event.code](cu, stream_id, event)
+
+
+class Replay(NamedTuple):
+    snapshot_seq: Optional[int]  # None - снимка не было
+    next_seq: int
+    replayed: int
+    sessions: Dict[str, Any]     # stream_id -> CurrentUser ещё открытых потоков
+
+
+def replay(directory: str, users, make_cu: Callable[[], Any], use_snapshot: bool = True,
+           truncate: bool = False) -> Replay:
+    """Снимок (если есть и use_snapshot) и записи после него через make_cu().
+
+    users - каталог или SharedUserTable (restore() и lookup()). truncate -
+    обрезать испорченный хвост сегмента, чтобы новые записи шли сразу за
+    последней целой; без него журнал только читается.
+    """
+    seq = 0
+    sessions: Dict[str, Any] = {}
+    snap = read_snapshot(directory) if use_snapshot else None
+    if snap is not None:
+        seq, state = snap
+        for name, authd, retries in state["users"]:
+            if not users.restore(name, authd, retries):
+                logger.warning("Пользователя %s из снимка нет в каталоге", name)
+        # открытые на момент снимка потоки продолжаются в журнале
+        for stream_id, name in state.get("sessions", ()):
+            cu = sessions[stream_id] = make_cu()
+            cu.cuid = users.lookup(name) if name else -1
+
+    replayed = 0
+    next_seq = seq
+    # при повторе обработка не логируется: журнал может быть длинным,
+    # а неверные пароли в нём - обычное дело; прежний уровень (LOG_MODE=off)
+    # возвращается как был
+    disabled = logging.root.manager.disable
+    logging.disable(max(disabled, logging.ERROR))
+    try:
+        for first, path in segments(directory):
+            # записи до снимка могли не успеть на диск: их действие уже в снимке
+            if first > next_seq and first > seq:
+                raise ValueError(f"{path}: записи {next_seq}..{first - 1} потеряны")
+            end = 0
+            for record, end in read_segment(path, first):
+                if record.seq >= seq:
+                    apply(record, make_cu, sessions)
+                    replayed += 1
+                next_seq = record.seq + 1
+            if truncate and end < os.path.getsize(path):
+                logger.warning("%s: испорченный хвост после %s байт отброшен", path, end)
+                os.truncate(path, end)
+            next_seq = max(next_seq, first)
+    finally:
+        logging.disable(disabled)
+    return Replay(seq if snap is not None else None, max(next_seq, seq), replayed, sessions)
+
+
+def recover(directory: str, users, make_cu: Callable[[], Any]) -> int:
+    """Состояние из снимка и хвоста журнала; возвращает номер следующей записи."""
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    result = replay(directory, users, make_cu, truncate=True)
+    # сессии не переживают перезапуск: закрываются, как при простое
+    for stream_id, cu in result.sessions.items():
+        cu.logout(stream_id)
+    if result.snapshot_seq is not None or result.replayed:
+        logger.info("Состояние восстановлено из %s: %s, повторено %s записей за %.2f с", directory,
+                    "без снимка" if result.snapshot_seq is None else f"снимок на записи {result.snapshot_seq}",
+                    result.replayed, time.perf_counter() - start)
+    return result.next_seq
+
+
+# --------- запись ---------
+class EventLog:
+    """Журнал с отдельным писателем; append() не трогает диск.
+
+    lock - точка упорядочения: под ним append() и снятие снимка. Обработчик
+    берёт его сам, если запись и её действие не должны разделяться снимком
+    (закрытие потока пишется и выполняется под одной блокировкой).
+    """
+
+    def __init__(self, directory: str, seq: int, fsync_interval: float = WAL_FSYNC_INTERVAL,
+                 fsync: bool = WAL_FSYNC, segment_size: int = WAL_SEGMENT_SIZE):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.lock = threading.RLock()
+        # номер следующей записи и число записей по видам с запуска
+        self.seq = seq
+        self.appended = {KIND_STREAM: 0, KIND_EVENT: 0, KIND_CLOSE: 0}
+        self.written = seq
+        # записи до этого номера уже на диске (после fsync)
+        self.durable = seq
+        self.bytes_written = 0
+        self.snapshot_seq = -1
+        self._queue: deque = deque()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._committed = threading.Condition()
+        self._file = None
+        self._file_size = 0
+        self._thread: Optional[threading.Thread] = None
+        self._snapshotter: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, name="wal-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, kind: int, stream_id: str, events=()) -> None:
+        with self.lock:
+            self._queue.append((kind, stream_id, events))
+            self.seq += 1
+            self.appended[kind] += 1
+
+    def append_stream(self, stream: Stream) -> None:
+        self.append(KIND_STREAM, stream.stream_id, stream.events)
+
+    def append_event(self, stream_id: str, event: Event) -> None:
+        self.append(KIND_EVENT, stream_id, (event,))
+
+    def append_close(self, stream_id: str) -> None:
+        self.append(KIND_CLOSE, stream_id)
+
+    def commit(self, timeout: float = WAL_COMMIT_TIMEOUT) -> bool:
+        """Дождаться, пока всё добавленное до вызова окажется на диске.
+
+        Будит писателя, не дожидаясь окна: ждущие одновременно делят один
+        fsync. False - не дождались за timeout (ошибка записи).
+        """
+        seq = self.seq
+        if self.durable >= seq:
+            return True
+        self._wake.set()
+        with self._committed:
+            return self._committed.wait_for(lambda: self.durable >= seq, timeout)
+
+    def pending(self, processed: int) -> int:
+        """Записанные, но ещё не обработанные потоки и события.
+
+        processed - сколько потоков и событий открытых потоков обработчик
+        довёл до конца с запуска (по его метрикам); закрытия выполняются сразу.
+        """
+        return self.appended[KIND_STREAM] + self.appended[KIND_EVENT] - processed
+
+    # --------- снимки ---------
+    def snapshot(self, processed: Callable[[], int], state: Callable[[], Dict[str, list]]) -> bool:
+        """Снимок, если всё записанное обработано; False - не в покое."""
+        with self.lock:
+            if self.seq == self.snapshot_seq:
+                return True
+            if self.pending(processed()) != 0:
+                return False
+            seq = self.seq
+            captured = state()
+        write_snapshot(self.directory, seq, captured)
+        self.snapshot_seq = seq
+        self._compact(seq)
+        logger.info("Снимок состояния на записи %s: %s пользователей, %s открытых потоков",
+                    seq, len(captured["users"]), len(captured["sessions"]))
+        return True
+
+    def start_snapshots(self, interval: float, processed: Callable[[], int],
+                        state: Callable[[], Dict[str, list]]) -> None:
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    if not self.snapshot(processed, state):
+                        logger.debug("Снимок отложен: есть необработанные записи")
+                except OSError as e:
+                    logger.error("Не удалось записать снимок: %s", e)
+        self._snapshotter = threading.Thread(target=run, name="wal-snapshot", daemon=True)
+        self._snapshotter.start()
+
+    def _compact(self, seq: int) -> None:
+        # сегмент не нужен, если следующий начинается не позже снимка;
+        # текущий сегмент писателя всегда последний и не удаляется
+        segs = segments(self.directory)
+        for (first, path), (next_first, _) in zip(segs, segs[1:]):
+            if next_first <= seq:
+                os.unlink(path)
+        for snap_seq, path in _numbered(self.directory, "snapshot-*.json"):
+            if snap_seq < seq:
+                os.unlink(path)
+
+    def shutdown(self, processed: Callable[[], int], state: Callable[[], Dict[str, list]]) -> None:
+        """Последний снимок и остановка писателя при штатном завершении."""
+        try:
+            if not self.snapshot(processed, state):
+                logger.warning("Снимок при остановке пропущен: %s записей не обработано, "
+                               "они повторятся при следующем запуске", self.pending(processed()))
+        except OSError as e:
+            logger.error("Не удалось записать снимок: %s", e)
+        self.close()
+
+    # --------- писатель ---------
+    def close(self) -> None:
+        """Дописать очередь, сделать fsync и остановить писателя."""
+        self._stop.set()
+        self._wake.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush()
+        self._file.close()
+
+    def _open_segment(self) -> None:
+        path = _segment_path(self.directory, self.written)
+        # в журнале пароли попыток входа; без буфера: кадры и так пишутся одним
+        # куском, а после ошибки в файле не остаётся недописанного буфера
+        new = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "ab", buffering=0)
+        # старый сегмент закрывается, только когда новый открыт: при ошибке
+        # писатель остаётся на нём и повторит переход со следующей записью
+        if self._file is not None:
+            self._file.close()
+        self._file = new
+        self._file_size = self._file.seek(0, os.SEEK_END)
+        _fsync_dir(self.directory)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.fsync_interval)
+            self._wake.clear()
+            try:
+                self._flush()
+            except OSError as e:
+                logger.error("Не удалось дописать журнал %s: %s", self.directory, e)
+
+    def _flush(self) -> None:
+        q = self._queue
+        if q:
+            # очередь забирается целиком: одна запись и один fsync на всё окно;
+            # записи снимаются с неё только после удачной записи, при ошибке
+            # остаток уходит следующей попыткой под теми же номерами
+            with self.lock:
+                batch = list(q)
+            chunk = []
+            size = 0
+            for kind, stream_id, events in batch:
+                frame = encode(kind, stream_id, events)
+                chunk.append(frame)
+                size += len(frame)
+                if self._file_size + size >= self.segment_size:
+                    self._write(chunk, size)
+                    chunk, size = [], 0
+                    self._open_segment()
+            if chunk:
+                self._write(chunk, size)
+        # после неудачного fsync записи уже в файле: повторяем fsync, не подтверждая их
+        if self.durable == self.written:
+            return
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        with self._committed:
+            self.durable = self.written
+            self._committed.notify_all()
+
+    def _write(self, chunk: List[bytes], size: int) -> None:
+        data = memoryview(b"".join(chunk))
+        try:
+            while data:
+                data = data[self._file.write(data):]
+        except OSError:
+            # недописанный кадр обрезается, иначе записи за ним не прочитать
+            os.ftruncate(self._file.fileno(), self._file_size)
+            raise
+        for _ in range(len(chunk)):
+            self._queue.popleft()
+        self._file_size += size
+        self.bytes_written += size
+        self.written += len(chunk)
+
+
+def open_log(directory: str, users, make_cu: Callable[[], Any]) -> EventLog:
+    """Восстановление по журналу и запуск нового писателя за его концом."""
+    log = EventLog(directory, recover(directory, users, make_cu))
+    log.start()
+    return log
@@ -0,0 +1,373 @@
+import asyncio
+import errno
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from decode import DecodeError
+from events import EVENT_TYPES, lookup
+from models import Event, Stream
+
+logger = logging.getLogger()
+
+# Приём потоков по TCP в двоичном виде, в обход HTTP и JSON (TCP_PORT,
+# 0 - выключен). Соединения долгие, в одном соединении идёт сколько угодно
+# потоков, события разных потоков могут перемежаться.
+#
+# Кадр (little-endian):
+#   len:I type:B id_len:H name_len:B passwd_len:B id name passwd
+# len - размер кадра без самого поля len. type - код типа из реестра
+# events.py (1/2/3 - ssh/sudo/dir) - событие потока id; type 0 (END) -
+# поток id закончен и уходит на обработку. На каждый END сервер отвечает кодом code:H, в порядке END и с
+# теми же значениями, что у HTTP: 200 принят, 400 неверное событие в потоке,
+# 429 лимит потоков, 503 очередь полна или идёт остановка.
+# Кадр с неверной длиной или stream_id не в UTF-8 - ошибка соединения: по
+# нему нельзя понять, где следующий кадр, соединение закрывается. Так же
+# закрывается соединение, превысившее TCP_MAX_OPEN потоков без END или
+# TCP_MAX_EVENTS событий в одном потоке: события копятся в памяти до END.
+# С закрытием соединения его недописанные потоки отбрасываются.
+#
+# Данные читаются прямо в буфер соединения (recv_into / BufferedProtocol),
+# кадры разбираются struct.unpack_from по memoryview этого буфера, строки
+# декодируются из него же без промежуточных bytes; после разбора в начало
+# буфера переносится только недочитанный хвост. Всё, что пришло за одно
+# чтение, передаётся обработчику одной пачкой (accept_streams), а коды
+# уходят одной записью.
+
+TCP_PORT = int(os.environ.get("TCP_PORT", 0))
+# потоков без END в одном соединении
+TCP_MAX_OPEN = int(os.environ.get("TCP_MAX_OPEN", 1024))
+# событий в одном потоке до END
+TCP_MAX_EVENTS = int(os.environ.get("TCP_MAX_EVENTS", 10000))
+# пачек, ждущих ответа обработчика, до паузы в чтении (asyncio)
+TCP_MAX_INFLIGHT = 8
+# пауза в приёме соединений при нехватке дескрипторов или памяти (selectors;
+# asyncio при этом ждёт сам)
+ACCEPT_BACKOFF = 0.1
+ACCEPT_EXHAUSTED = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+END = 0
+
+HEADER = struct.Struct("<IBHBB")
+ACK = struct.Struct("<H")
+# самый длинный кадр при предельных длинах полей: буфер вмещает его целиком
+MAX_FRAME = HEADER.size + 0xFFFF + 2 * 0xFF
+BUFFER_SIZE = 4 * MAX_FRAME
+
+
+def encode_frame(etype: int, stream_id: str, name: str = "", passwd: str = "") -> bytes:
+    sid, n, p = stream_id.encode(), name.encode(), passwd.encode()
+    if len(sid) > 0xFFFF or len(n) > 0xFF or len(p) > 0xFF:
+        raise ValueError(f"stream {stream_id}: field is too long")
+    return HEADER.pack(HEADER.size - 4 + len(sid) + len(n) + len(p), etype, len(sid), len(n), len(p)) + sid + n + p
+
+
+def encode_stream(stream_id: str, events: Iterable[dict]) -> bytes:
+    """Поток целиком: события в виде словарей, как в JSON, и END."""
+    frames = [encode_frame(lookup(e["type"]).code, stream_id, e.get("name", ""), e.get("passwd", ""))
+              for e in events]
+    frames.append(encode_frame(END, stream_id))
+    return b"".join(frames)
+
+
+class FrameReader:
+    """Буфер одного соединения и разбор кадров в нём."""
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self._view = memoryview(bytearray(size))
+        self._end = 0
+        # события потоков без END; None - в потоке было неверное событие
+        self._open: Dict[str, Optional[List[Event]]] = {}
+
+    def buffer(self) -> memoryview:
+        """Свободное место за принятыми данными: сюда читает сокет."""
+        return self._view[self._end:]
+
+    def feed(self, nbytes: int) -> List[Union[Stream, DecodeError]]:
+        """nbytes дописаны в buffer(); возвращает потоки, для которых пришёл END.
+
+        DecodeError наружу - ошибка соединения, продолжать его нельзя.
+        """
+        view = self._view
+        end = self._end + nbytes
+        off = 0
+        done: List[Union[Stream, DecodeError]] = []
+        while end - off >= HEADER.size:
+            size, etype, id_len, name_len, passwd_len = HEADER.unpack_from(view, off)
+            if size != HEADER.size - 4 + id_len + name_len + passwd_len:
+                raise DecodeError(f"frame length {size} does not match its fields")
+            if end - off < size + 4:
+                break
+            pos = off + HEADER.size
+            off += size + 4
+            try:
+                stream_id = str(view[pos:pos + id_len], "utf-8")
+            except UnicodeDecodeError:
+                raise DecodeError("stream id is not valid UTF-8") from None
+            pos += id_len
+            if etype == END:
+                events = self._open.pop(stream_id, [])
+                done.append(Stream(stream_id=stream_id, events=events) if events is not None
+                            else DecodeError(f"stream {stream_id} has invalid events"))
+                continue
+            events = self._open.get(stream_id, [])
+            if stream_id not in self._open:
+                if len(self._open) >= TCP_MAX_OPEN:
+                    raise DecodeError(f"more than {TCP_MAX_OPEN} open streams")
+                self._open[stream_id] = events
+            if events is None:
+                continue
+            if len(events) >= TCP_MAX_EVENTS:
+                raise DecodeError(f"stream {stream_id} has more than {TCP_MAX_EVENTS} events")
+            if etype >= len(EVENT_TYPES):
+                self._open[stream_id] = None
+                continue
+            try:
+                name = str(view[pos:pos + name_len], "utf-8")
+                passwd = str(view[pos + name_len:pos + name_len + passwd_len], "utf-8")
+            except UnicodeDecodeError:
+                self._open[stream_id] = None
+                continue
+            events.append(Event(type_=EVENT_TYPES[etype].name, name=name, passwd=passwd))
+
+        # недочитанный кадр - в начало буфера; размер буфера не меняется
+        rest = end - off
+        if off and rest:
+            view[:rest] = view[off:end]
+        self._end = rest
+        return done
+
+    def open_streams(self) -> int:
+        return len(self._open)
+
+    def drop(self) -> int:
+        """Отбрасывает потоки без END (соединение закрыто); возвращает их число."""
+        n = len(self._open)
+        self._open.clear()
+        return n
+
+
+def acks(codes: Iterable[int]) -> bytes:
+    return b"".join(ACK.pack(code) for code in codes)
+
+
+# --------- threading и multiprocessing: один поток на selectors ---------
+class _Conn:
+    __slots__ = ("sock", "peer", "reader", "out", "events")
+
+    def __init__(self, sock: socket.socket, peer):
+        self.sock = sock
+        self.peer = peer
+        self.reader = FrameReader()
+        self.out = bytearray()
+        self.events = selectors.EVENT_READ
+
+
+class SelectorServer:
+    """Все соединения в одном потоке: selectors, неблокирующие сокеты.
+
+    accept получает пачку потоков и возвращает их HTTP-коды (accept_streams
+    обработчика); обработка идёт в пуле обработчика, здесь только разбор и
+    постановка в очередь. Пока клиент не забрал ответы, его соединение не
+    читается.
+    """
+
+    def __init__(self, port: int, accept: Callable[[List[Union[Stream, DecodeError]]], List[int]],
+                 host: str = "0.0.0.0"):
+        self.accept = accept
+        self.sock = socket.create_server((host, port), backlog=socket.SOMAXCONN)
+        self.sock.setblocking(False)
+        self._sel = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._stop = threading.Event()
+        self._conns: Dict[int, _Conn] = {}
+        # когда снова слушать сокет после ACCEPT_EXHAUSTED, None - слушаем
+        self._resume_at: Optional[float] = None
+
+    def serve_forever(self) -> None:
+        sel = self._sel
+        sel.register(self.sock, selectors.EVENT_READ, None)
+        sel.register(self._wake_r, selectors.EVENT_READ, self._wake_r)
+        try:
+            while not self._stop.is_set():
+                timeout = None
+                if self._resume_at is not None:
+                    timeout = self._resume_at - time.monotonic()
+                    if timeout <= 0:
+                        sel.register(self.sock, selectors.EVENT_READ, None)
+                        self._resume_at = timeout = None
+                for key, mask in sel.select(timeout):
+                    if key.data is None:
+                        self._accept_conn()
+                    elif isinstance(key.data, _Conn):
+                        if mask & selectors.EVENT_WRITE:
+                            self._flush(key.data)
+                        elif mask & selectors.EVENT_READ:
+                            self._read(key.data)
+        finally:
+            for conn in list(self._conns.values()):
+                self._close(conn)
+            sel.close()
+            self.sock.close()
+            self._wake_r.close()
+            self._wake_w.close()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._wake_w.send(b"\0")
+
+    def _accept_conn(self) -> None:
+        try:
+            sock, peer = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # ECONNABORTED и т.п. касаются одного клиента; при нехватке дескрипторов
+            # сокет остаётся готовым к чтению, и цикл крутился бы вхолостую
+            logger.warning("TCP: соединение не принято: %s", e)
+            if e.errno in ACCEPT_EXHAUSTED:
+                self._sel.unregister(self.sock)
+                self._resume_at = time.monotonic() + ACCEPT_BACKOFF
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = _Conn(sock, peer)
+        self._conns[sock.fileno()] = conn
+        self._sel.register(sock, selectors.EVENT_READ, conn)
+
+    def _read(self, conn: _Conn) -> None:
+        try:
+            n = conn.sock.recv_into(conn.reader.buffer())
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self._close(conn)
+            return
+        try:
+            streams = conn.reader.feed(n)
+        except DecodeError as e:
+            logger.warning("TCP %s: %s, соединение закрыто", conn.peer, e)
+            self._close(conn)
+            return
+        if streams:
+            try:
+                codes = self.accept(streams)
+            except Exception:
+                # поток selectors общий: ошибка журнала или пула закрывает одно соединение, а не весь приём
+                logger.exception("TCP %s: ошибка приёма потоков, соединение закрыто", conn.peer)
+                self._close(conn)
+                return
+            conn.out += acks(codes)
+            self._flush(conn)
+
+    def _flush(self, conn: _Conn) -> None:
+        try:
+            sent = conn.sock.send(conn.out)
+            del conn.out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._close(conn)
+            return
+        events = selectors.EVENT_WRITE if conn.out else selectors.EVENT_READ
+        if events != conn.events:
+            conn.events = events
+            self._sel.modify(conn.sock, events, conn)
+
+    def _close(self, conn: _Conn) -> None:
+        if self._conns.pop(conn.sock.fileno(), None) is None:
+            return
+        self._sel.unregister(conn.sock)
+        conn.sock.close()
+        dropped = conn.reader.drop()
+        if dropped:
+            logger.warning("TCP %s: соединение закрыто, %s потоков без END отброшено", conn.peer, dropped)
+
+
+# --------- asyncio ---------
+class FrameProtocol(asyncio.BufferedProtocol):
+    """Соединение asyncio-обработчика: цикл событий читает прямо в буфер FrameReader.
+
+    accept - корутина обработчика (accept_streams), пачки передаются ей по
+    очереди, чтобы коды уходили в порядке END.
+    """
+
+    def __init__(self, accept: Callable[[List[Union[Stream, DecodeError]]], Awaitable[List[int]]]):
+        self.accept = accept
+        self.reader = FrameReader()
+        self.transport = None
+        self._last: Optional[asyncio.Future] = None
+        self._inflight = 0
+        self._paused = False
+        self._write_paused = False
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.reader.buffer()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        try:
+            streams = self.reader.feed(nbytes)
+        except DecodeError as e:
+            logger.warning("TCP %s: %s, соединение закрыто", self.transport.get_extra_info("peername"), e)
+            self.transport.close()
+            return
+        if streams:
+            self._inflight += 1
+            self._last = asyncio.ensure_future(self._reply(streams, self._last))
+            self._update_reading()
+
+    async def _reply(self, streams, prev: Optional[asyncio.Future]) -> None:
+        if prev is not None:
+            await prev
+        try:
+            codes = await self.accept(streams)
+        except Exception:
+            # без кодов клиент ждал бы ответа вечно, а исключение осталось бы в брошенной задаче
+            logger.exception("TCP %s: ошибка приёма потоков, соединение закрыто",
+                             self.transport.get_extra_info("peername"))
+            self.transport.close()
+            return
+        finally:
+            self._inflight -= 1
+        if not self.transport.is_closing():
+            self.transport.write(acks(codes))
+            self._update_reading()
+
+    def pause_writing(self) -> None:
+        self._write_paused = True
+        self._update_reading()
+
+    def resume_writing(self) -> None:
+        self._write_paused = False
+        self._update_reading()
+
+    def _update_reading(self) -> None:
+        # ответы не забираются или обработчик не успевает - не читаем дальше
+        pause = self._write_paused or self._inflight >= TCP_MAX_INFLIGHT
+        if pause != self._paused and not self.transport.is_closing():
+            self._paused = pause
+            if pause:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        # при обрыве, ошибке разбора и закрытии со своей стороны: события
+        # недописанных потоков больше не нужны
+        dropped = self.reader.drop()
+        if dropped:
+            logger.warning("TCP %s: соединение закрыто, %s потоков без END отброшено",
+                           self.transport.get_extra_info("peername"), dropped)
@@ -0,0 +1,147 @@
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from directory import open_directory
+from shard import ShardedEngine, ShardSessionUser, handle_event
+from parse import iter_streams
+from logs import setup_logging
+from session_table import SessionTable
+from session import CurrentUser, LockStripes
+from detector import open_detector
+from tracing import TRACER, open_tracer
+from wal import WAL_DIR, SNAPSHOT_INTERVAL, capture, open_log, processed
+from wire import TCP_PORT, SelectorServer
+from stream_server import StreamServer
+from metrics import Metrics, WindowReporter, merge, summary
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logger = logging.getLogger()
+
+# MAX_STREAMS=0 - режим сервиса: без лимита потоков, работа до SIGTERM
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 50))
+TIMEOUT = 30 * 60
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 30))
+REPORT_INTERVAL = float(os.environ.get("REPORT_INTERVAL", 60))
+# число процессов-шардов; пользователи делятся между ними по хешу имени
+SHARDS = int(os.environ.get("SHARDS", os.cpu_count() or 4))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 1024))
+done_event = threading.Event()
+# приём запросов и события открытых потоков считаются в процессе сервера, обработка - в шардах
+METRICS = Metrics()
+# открытые потоки: в процессе сервера только cuid, события идут шарду-владельцу
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 300))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10000))
+
+def main():
+    from werkzeug.serving import make_server
+
+    log_listener = setup_logging(multiprocess=True)
+    # пользователи - из каталога USERS_FILE (CSV, JSON или SQLite), в памяти только горячие
+    users = open_directory()
+    wal = None
+    if WAL_DIR:
+        # до раскладки по шардам: состояние из снимка и хвоста журнала - в каталог
+        wal = open_log(WAL_DIR, users, lambda: CurrentUser(users, LockStripes()))
+    # каждый шард получает своих пользователей и дальше владеет ими сам
+    engine = ShardedEngine(users, SHARDS, QUEUE_SIZE)
+    # приём потоков, журнал и HTTP-приложение - общие с threading (stream_server.py)
+    stream_server = StreamServer(engine, METRICS, lambda: merge(METRICS.snapshot(), engine.metrics.snapshot()),
+                                 done_event, MAX_STREAMS, QUEUE_SIZE, handle_event=handle_event)
+    stream_server.wal = wal
+    sessions = SessionTable(lambda: ShardSessionUser(engine), SESSION_IDLE_TIMEOUT, MAX_SESSIONS,
+                            on_close=stream_server.close_session)
+    stream_server.sessions = sessions
+    # потоки считают шарды, события открытых потоков - процесс сервера
+    wal_processed = lambda: processed(stream_server.snapshot())
+    # состояние пользователей - у шардов, имена - у движка
+    wal_state = lambda: capture(engine, sessions)
+    # после восстановления и до fork шардов: детектор у всех процессов общий
+    open_detector(engine.metrics, shared=True)
+    open_tracer(engine.metrics, shared=True, snapshot=stream_server.snapshot)
+    engine.start()
+    if wal is not None and SNAPSHOT_INTERVAL:
+        # состояние для снимка спрашивается у шардов, поэтому - после их старта
+        wal.start_snapshots(SNAPSHOT_INTERVAL, wal_processed, wal_state)
+    # запросы в своих потоках: долгий chunked-запрос не держит остальные
+    server = make_server("0.0.0.0", 8081, stream_server.create_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    tcp_server = None
+    if TCP_PORT:
+        tcp_server = SelectorServer(TCP_PORT, stream_server.accept_frames)
+        tcp_thread = threading.Thread(target=tcp_server.serve_forever, name="tcp")
+        tcp_thread.start()
+        logger.info("Двоичный приём потоков на :%s", TCP_PORT)
+    sweeper = threading.Thread(target=sessions.sweep_forever, args=(done_event, SESSION_IDLE_TIMEOUT / 4),
+                               daemon=True)
+    sweeper.start()
+    logger.info("Server starting on :8081 (%s shards, queue %s)", SHARDS, QUEUE_SIZE)
+
+    stop_signal = []
+    def on_signal(signum, frame):
+        stop_signal.append(signum)
+        done_event.set()
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    # SIGUSR1 - открыть или закрыть окно трассировки с профилем у всех процессов
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=TRACER.toggle, daemon=True).start())
+    # перечитать каталог на ходу нельзя: пользователи раскладываются по шардам
+    # один раз при старте, SIGHUP не роняет сервер
+    signal.signal(signal.SIGHUP, lambda signum, frame: logger.warning(
+        "SIGHUP: перечитывание каталога пользователей не поддерживается, нужен перезапуск"))
+
+    # ждём лимита (с таймаутом) или, в режиме сервиса, сигнала
+    reporter = WindowReporter(stream_server.snapshot, REPORT_INTERVAL)
+    if not reporter.wait(done_event, timeout=TIMEOUT if MAX_STREAMS else None):
+        logger.info("Таймаут, завершаем работу...")
+    elif stop_signal:
+        logger.info("Получен сигнал %s, завершаем работу...", signal.Signals(stop_signal[0]).name)
+    else:
+        logger.info("Достигнут лимит потоков, завершаем работу...")
+
+    # перестаём принимать соединения и дорабатываем очередь, но не дольше DRAIN_TIMEOUT
+    done_event.set()
+    server.shutdown()
+    thread.join()
+    if tcp_server is not None:
+        tcp_server.shutdown()
+        tcp_thread.join()
+
+    left = engine.shutdown(DRAIN_TIMEOUT)
+    if left:
+        logger.warning("За %.0f с не доработали %s шардов, остаток очереди брошен", DRAIN_TIMEOUT, left)
+    if wal is not None:
+        # движок отдаёт состояние шардов на момент остановки
+        wal.shutdown(wal_processed, wal_state)
+
+    logger.info(summary(engine.metrics.snapshot()))
+    if log_listener:
+        log_listener.stop()
+
+def process_file(file_path: str):
+    log_listener = setup_logging(multiprocess=True)
+    engine = ShardedEngine(open_directory(), SHARDS, QUEUE_SIZE)
+    open_detector(engine.metrics, shared=True)
+    engine.start()
+    # потоки уходят шардам по мере разбора файла, а не после чтения целиком
+    for stream in iter_streams(file_path):
+        engine.submit(stream, block=True)
+    engine.shutdown()
+
+    logger.info(summary(engine.metrics.snapshot()))
+    if log_listener:
+        log_listener.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", help="Путь к файлу с данными (вместо HTTP-сервера)")
+    args = parser.parse_args()
+    if args.file:
+        process_file(args.file)
+    else:
+        main()
@@ -1,197 +1,171 @@
+import argparse
 import logging
+import os
+import signal
+import sys
 import threading
 import time
-from typing import List, Dict
-from dataclasses import dataclass, field
-from flask import Flask, request, jsonify
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pkg"))
+from models import Stream
+from directory import USERS_RELOAD_INTERVAL, Directory, open_directory
+from pool import ThreadWorkerPool
+from parse import iter_streams
+from logs import setup_logging
+from session_table import SessionTable
+from session import CurrentUser, LockStripes
+from detector import open_detector
+from tracing import TRACER, open_tracer
+from wal import WAL_DIR, SNAPSHOT_INTERVAL, capture, open_log, processed
+from wire import TCP_PORT, SelectorServer
+from stream_server import StreamServer
+from metrics import Metrics, WindowReporter, summary
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger()
 
-# --------- модели ---------
-class Event:
-    def __init__(self, type_: str, name: str = "", passwd: str = ""):
-        self.type = type_
-        self.name = name
-        self.passwd = passwd
-
-    def __repr__(self):
-        return f"Event(type='{self.type}', name='{self.name}', passwd='{self.passwd}')"
-
-class Stream:
-    def __init__(self, stream_id: str, events: List[Event]):
-        self.stream_id = stream_id
-        self.events = events if events is not None else []
-
-    def __repr__(self):
-        return f"Stream(stream_id='{self.stream_id}', events={self.events})"
-
-@dataclass
-class User:
-    name: str
-    passwd: str
-    authd: str = ""
-    auth_retries: int = 0
-    mu: threading.Lock = field(default_factory=threading.Lock)
-
-USERS: Dict[int, User] = {
-    0: User(name="superadmin", passwd="P@ssw0rd!"),
-    1: User(name="auditor", passwd="Secur3!2023"),
-    2: User(name="dev_user", passwd="d3v3l0p3r"),
-    3: User(name="tester", passwd="t3st3r!123"),
-    4: User(name="analyst", passwd="Data2023!"),
-    5: User(name="support", passwd="HelpDesk!"),
-    6: User(name="reports", passwd="R3port$"),
-    7: User(name="backup", passwd="B@ckUp123"),
-    8: User(name="api_user", passwd="Ap1K3y!2023"),
-    9: User(name="guest", passwd="T3mpPass!")
-}
-
 # --------- обработка ---------
-class CurrentUser:
-    def __init__(self):
-        self.cuid = -1
-
-    def handle_ssh(self, stream_id: str, event: Event) -> None:
-        prevCuid = self.cuid
-        for uid, user in USERS.items():
-            if event.name == user.name:
-                self.cuid = uid
-                break
-
-        if self.cuid == -1:
-            logger.error(f"Couldn't find a user with a name {event.name} ({stream_id})")
-            return
-
-        user = USERS[self.cuid]
-        with user.mu:
-            if user.authd == stream_id:
-                logger.info(f"You are already logged in ({stream_id})")
-                return
-
-            if user.authd:
-                logger.error(f"User {user.name} already authd from {user.authd} ({stream_id})")
-                self.cuid = -1
-                return
-
-            if user.auth_retries >= 3:
-                logger.error(f"Can't access user {user.name}, user is blocked ({stream_id})")
-                self.cuid = -1
-                return
-
-            if event.passwd != user.passwd:
-                user.auth_retries += 1
-                logger.error(f"Wrong password for user {user.name} ({stream_id})")
-                self.cuid = -1
-                return
-
-            if not user.authd:
-                if prevCuid != -1:
-                    USERS[prevCuid].authd = ""
-                user.authd = stream_id
-                user.auth_retries = 0
-                logger.info(f"User {user.name} authd ({stream_id})")
-
-    def handle_sudo(self, stream_id: str, event: Event) -> None:
-        if self.cuid == -1:
-            return
-        user = USERS[self.cuid]
-        if event.passwd == user.passwd:
-            logger.info(f"Accepted sudo on user {user.name} ({stream_id})")
-        else:
-            logger.error(f"Bad password for sudo on user {user.name} ({stream_id})")
-
-    def handle_dir(self, stream_id: str, event: Event) -> None:
-        if self.cuid == -1:
-            return
-        logger.info(f"Accepted dir on user {USERS[self.cuid].name} ({stream_id})")
-
-def handle_stream(stream: Stream):
-    global total_time
-    cu = CurrentUser()
+# пользователи - из каталога USERS_FILE (CSV, JSON или SQLite), в памяти только
+# горячие; каталог и полосы блокировок создаются в main/process_file
+LOCK_STRIPES = int(os.environ.get("LOCK_STRIPES", 64))
+# метрики пишутся в шард текущего потока, без общей блокировки
+METRICS = Metrics()
+
+def handle_stream(stream: Stream, users: Directory, locks: LockStripes):
+    cu = CurrentUser(users, locks)
     stream_id = stream.stream_id
+    handlers = TRACER.handlers(CurrentUser, stream)
+    counts = [0] * len(handlers)
     start_ns = time.perf_counter_ns()  # старт в наносекундах
 
     for event in stream.events:
-        if event.type == "ssh":
-            cu.handle_ssh(stream_id, event)
-        elif event.type == "sudo":
-            cu.handle_sudo(stream_id, event)
-        elif event.type == "dir":
-            cu.handle_dir(stream_id, event)
+        code = event.code
+        counts[code] += 1
+        handlers[code](cu, stream_id, event)
 
     elapsed_ns = time.perf_counter_ns() - start_ns
+    METRICS.shard().stream_done(elapsed_ns, counts, cu)
 
-    with streams_lock:
-        total_time += elapsed_ns
-
-    # выводим в миллисекундах с 3 знаками после запятой
-    logger.info(f"Завершение потока {stream_id} за {elapsed_ns/1e3:.3f} мкс")
+    logger.info("Завершение потока %s за %.3f мкс", stream_id, elapsed_ns/1e3)
 
 # --------- сервер ---------
-app = Flask(__name__)
-MAX_STREAMS = 50
-total_streams = 0
-total_time = 0.0
-streams_lock = threading.Lock()
+# MAX_STREAMS=0 - режим сервиса: без лимита потоков, работа до SIGTERM
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 50))
+TIMEOUT = 30 * 60
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 30))
+REPORT_INTERVAL = float(os.environ.get("REPORT_INTERVAL", 60))
+WORKERS = int(os.environ.get("WORKERS", 8))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 1024))
 done_event = threading.Event()
-threads = []
-
-@app.route("/", methods=["POST"])
-def receive_stream():
-    global total_streams, total_time
-
-    data = request.get_json()
-    if not data or "streamId" not in data or "events" not in data:
-        return jsonify({"error": "Invalid JSON"}), 400
-
-    stream_id = data["streamId"]
-    events = [Event(ev.get("type", ""), ev.get("name", ""), ev.get("passwd", "")) for ev in data["events"]]
-    stream = Stream(stream_id, events)
-
-    with streams_lock:
-        if total_streams >= MAX_STREAMS:
-            return jsonify({"error": "Maximum streams limit reached"}), 429
-
-        total_streams += 1
-        current_count = total_streams
+# открытые потоки: CurrentUser живёт между запросами, при закрытии - выход
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 300))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10000))
 
-    t = threading.Thread(target=handle_stream, args=(stream,))
-    t.start()
-    threads.append(t)
-
-    if current_count == MAX_STREAMS:
-        done_event.set()
-
-    return jsonify({
-        "status": "processing_started",
-        "stream_id": stream.stream_id,
-        "count": f"{current_count}/{MAX_STREAMS}",
-    })
+def wal_processed():
+    return processed(METRICS.snapshot())
 
 def main():
     from werkzeug.serving import make_server
 
-    server = make_server("0.0.0.0", 8081, app)
+    log_listener = setup_logging()
+    users = open_directory()
+    locks = LockStripes(LOCK_STRIPES)
+    pool = ThreadWorkerPool(handle_stream, WORKERS, QUEUE_SIZE, args=(users, locks))
+    # приём потоков, журнал и HTTP-приложение - общие с multiprocessing (stream_server.py)
+    stream_server = StreamServer(pool, METRICS, METRICS.snapshot, done_event, MAX_STREAMS, QUEUE_SIZE)
+    sessions = SessionTable(lambda: CurrentUser(users, locks), SESSION_IDLE_TIMEOUT, MAX_SESSIONS,
+                            on_close=stream_server.close_session)
+    stream_server.sessions = sessions
+    wal_state = lambda: capture(users, sessions)
+    if WAL_DIR:
+        # до приёма запросов: состояние из снимка и хвоста журнала
+        stream_server.wal = open_log(WAL_DIR, users, lambda: CurrentUser(users, locks))
+        if SNAPSHOT_INTERVAL:
+            stream_server.wal.start_snapshots(SNAPSHOT_INTERVAL, wal_processed, wal_state)
+    # после восстановления: повтор журнала не должен поднимать тревоги
+    open_detector(METRICS)
+    open_tracer(METRICS)
+    pool.start()
+    # запросы в своих потоках: долгий chunked-запрос не держит остальные
+    server = make_server("0.0.0.0", 8081, stream_server.create_app(), threaded=True)
     thread = threading.Thread(target=server.serve_forever)
     thread.start()
-    logger.info("Server starting on :8081")
-
-    # ждём или лимита, или таймаута
-    if not done_event.wait(timeout=30*60):
+    tcp_server = None
+    if TCP_PORT:
+        tcp_server = SelectorServer(TCP_PORT, stream_server.accept_frames)
+        tcp_thread = threading.Thread(target=tcp_server.serve_forever, name="tcp")
+        tcp_thread.start()
+        logger.info("Двоичный приём потоков на :%s", TCP_PORT)
+    sweeper = threading.Thread(target=sessions.sweep_forever, args=(done_event, SESSION_IDLE_TIMEOUT / 4),
+                               daemon=True)
+    sweeper.start()
+    logger.info("Server starting on :8081 (%s workers, queue %s)", WORKERS, QUEUE_SIZE)
+
+    stop_signal = []
+    def on_signal(signum, frame):
+        stop_signal.append(signum)
+        done_event.set()
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    # SIGHUP - перечитать каталог пользователей без перезапуска
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=users.try_reload, daemon=True).start())
+    # SIGUSR1 - открыть или закрыть окно трассировки с профилем
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=TRACER.toggle, daemon=True).start())
+    if USERS_RELOAD_INTERVAL:
+        threading.Thread(target=users.watch_forever, args=(done_event, USERS_RELOAD_INTERVAL), daemon=True).start()
+
+    # ждём лимита (с таймаутом) или, в режиме сервиса, сигнала
+    reporter = WindowReporter(METRICS.snapshot, REPORT_INTERVAL)
+    if not reporter.wait(done_event, timeout=TIMEOUT if MAX_STREAMS else None):
         logger.info("Таймаут, завершаем работу...")
+    elif stop_signal:
+        logger.info("Получен сигнал %s, завершаем работу...", signal.Signals(stop_signal[0]).name)
     else:
         logger.info("Достигнут лимит потоков, завершаем работу...")
 
+    # перестаём принимать соединения и дорабатываем очередь, но не дольше DRAIN_TIMEOUT
+    done_event.set()
     server.shutdown()
-    for t in threads:
-        t.join()
-
-    logger.info(
-        f"Полное чистое время обработки: {total_time/1e3:.3f} мкс, "
-        f"среднее на поток: {(total_time/total_streams)/1e3:.3f} мкс"
-    )
+    thread.join()
+    if tcp_server is not None:
+        tcp_server.shutdown()
+        tcp_thread.join()
+    left = pool.shutdown(DRAIN_TIMEOUT)
+    if left:
+        logger.warning("За %.0f с не доработали %s воркеров, остаток очереди брошен", DRAIN_TIMEOUT, left)
+    if stream_server.wal is not None:
+        stream_server.wal.shutdown(wal_processed, wal_state)
+
+    logger.info(summary(METRICS.snapshot()))
+    acquired, contended = locks.stats()
+    logger.info("Блокировки пользователей: %s захватов, %s с ожиданием", acquired, contended)
     logger.info("Все потоки завершены")
+    if log_listener:
+        log_listener.stop()
+
+def process_file(file_path: str):
+    log_listener = setup_logging()
+    users = open_directory()
+    locks = LockStripes(LOCK_STRIPES)
+    open_detector(METRICS)
+    # потоки уходят воркерам по мере разбора файла, а не после чтения целиком
+    pool = ThreadWorkerPool(handle_stream, WORKERS, QUEUE_SIZE, args=(users, locks))
+    pool.start()
+    for stream in iter_streams(file_path):
+        pool.submit(stream, block=True)
+    pool.shutdown()
+
+    logger.info(summary(METRICS.snapshot()))
+    acquired, contended = locks.stats()
+    logger.info("Блокировки пользователей: %s захватов, %s с ожиданием", acquired, contended)
+    if log_listener:
+        log_listener.stop()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", help="Путь к файлу с данными (вместо HTTP-сервера)")
+    args = parser.parse_args()
+    if args.file:
+        process_file(args.file)
+    else:
+        main()